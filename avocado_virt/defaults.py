@@ -16,58 +16,130 @@
 Default values used in tests and plugin code.
 """
 
+import os
+import sys
+import json
+import types
+import tempfile
+
 from avocado.core import data_dir
 from avocado.core.settings import settings
 from avocado.core.settings import SettingsError
+from avocado.utils import path as utils_path
 from .qemu import path
 
 
-#: The name or path of the QEMU binary.  Hardcoded default is 'qemu',
-#: but will be overwritten by configuration value ("qemu_bin" under
-#: section [virt.qemu.paths]) or by a dynamic (run time) search for a
-#: suitable binary
-QEMU_BIN = 'qemu'
-try:
-    QEMU_BIN = settings.get_value('virt.qemu.paths', 'qemu_bin')
-except SettingsError:
-    try:
-        QEMU_BIN = path.get_qemu_binary()
-    except path.QEMUCmdNotFoundError:
-        pass
+#: Keys of the QEMU binaries in the [virt.qemu.paths] section, with the
+#: name used when no binary is found, the function finding one in the
+#: environment and in $PATH and the environment variable it looks at
+_QEMU_BINARIES = {'qemu_bin': ('qemu', path.get_qemu_binary, 'QEMU'),
+                  'qemu_dst_bin': ('qemu', path.get_qemu_dst_binary,
+                                   'QEMU_DST'),
+                  'qemu_img_bin': ('qemu-img', path.get_qemu_img_binary,
+                                   'QEMU_IMG'),
+                  'qemu_io_bin': ('qemu-io', path.get_qemu_io_binary,
+                                  'QEMU_IO')}
 
-#: The name or path of the QEMU binary used for the destination
-#: instance when doing migration.  Hardcoded default is 'qemu', but
-#: will be overwritten by configuration value ("qemu_bin" under section
-#: [virt.qemu.paths]) or by a dynamic (run time) search for a suitable
-#: binary
-QEMU_DST_BIN = 'qemu'
-try:
-    QEMU_DST_BIN = settings.get_value('virt.qemu.paths', 'qemu_dst_bin')
-except SettingsError:
-    try:
-        QEMU_DST_BIN = path.get_qemu_dst_binary()
-    except path.QEMUCmdNotFoundError:
-        pass
+#: Former names of the QEMU binaries, resolved on first use
+_COMPAT_NAMES = {'QEMU_BIN': 'qemu_bin',
+                 'QEMU_DST_BIN': 'qemu_dst_bin',
+                 'QEMU_IMG_BIN': 'qemu_img_bin',
+                 'QEMU_IO_BIN': 'qemu_io_bin'}
 
-#: The name or path of the qemu-img binary
-QEMU_IMG_BIN = 'qemu-img'
-try:
-    QEMU_IMG_BIN = settings.get_value('virt.qemu.paths', 'qemu_img_bin')
-except SettingsError:
-    try:
-        QEMU_IMG_BIN = path.get_qemu_img_binary()
-    except path.QEMUCmdNotFoundError:
-        pass
+#: QEMU binaries found so far in this process, by key
+_qemu_binaries = {}
 
-#: The name or path of the qemu-io binary
-QEMU_IO_BIN = 'qemu-io'
-try:
-    QEMU_IMG_BIN = settings.get_value('virt.qemu.paths', 'qemu_io_bin')
-except SettingsError:
+
+def _binary_cache_path():
+    return os.path.join(data_dir.get_data_dir(), 'cache', 'binaries.json')
+
+
+def _find_binary(key, cache_path=None):
+    """
+    Find a QEMU binary, looking it up in the environment and in $PATH only
+    when the on disk cache does not know where it is.
+
+    The cache is kept in the avocado data dir.  An entry is used as long as
+    $PATH and the environment variable of the binary are the ones it was
+    found with, and the binary still exists.
+
+    :param cache_path: path of the cache, in the data dir by default
+    """
+    _, find, env_variable = _QEMU_BINARIES[key]
+    env = [os.environ.get('PATH'), os.environ.get(env_variable)]
+    if cache_path is None:
+        cache_path = _binary_cache_path()
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        cache = {}
+    entry = cache.get(key)
+    if (isinstance(entry, dict) and entry.get('env') == env and
+            os.path.isfile(entry.get('path') or '')):
+        return str(entry['path'])
+    binary = find()
+    cache[key] = {'env': env, 'path': binary}
     try:
-        qemu_io_bin = path.get_qemu_io_binary()
-    except path.QEMUCmdNotFoundError:
+        utils_path.init_dir(os.path.dirname(cache_path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(cache, tmp_file)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # Not cached, found again next time
         pass
+    return binary
+
+
+def _qemu_binary(key):
+    binary = _qemu_binaries.get(key)
+    if binary is None:
+        try:
+            binary = settings.get_value('virt.qemu.paths', key)
+        except SettingsError:
+            try:
+                binary = _find_binary(key)
+            except path.QEMUCmdNotFoundError:
+                binary = _QEMU_BINARIES[key][0]
+        _qemu_binaries[key] = binary
+    return binary
+
+
+def get_qemu_bin():
+    """
+    The name or path of the QEMU binary: the "qemu_bin" value of the
+    [virt.qemu.paths] section, or else a suitable binary found at run time,
+    or else 'qemu'.
+
+    Looked up on first use, not when this module is imported.
+    """
+    return _qemu_binary('qemu_bin')
+
+
+def get_qemu_dst_bin():
+    """
+    The name or path of the QEMU binary used for the destination instance
+    when doing migration: the "qemu_dst_bin" value of the
+    [virt.qemu.paths] section, or else a suitable binary found at run time,
+    or else 'qemu'.
+    """
+    return _qemu_binary('qemu_dst_bin')
+
+
+def get_qemu_img_bin():
+    """
+    The name or path of the qemu-img binary.
+    """
+    return _qemu_binary('qemu_img_bin')
+
+
+def get_qemu_io_bin():
+    """
+    The name or path of the qemu-io binary.
+    """
+    return _qemu_binary('qemu_io_bin')
+
 
 #: The path to the guest image to be used
 GUEST_IMAGE_PATH = ''
@@ -91,6 +163,15 @@ DISABLE_RESTORE_IMAGE_TEST = settings.get_value('virt.restore', 'disable_for_tes
 DISABLE_RESTORE_IMAGE_JOB = settings.get_value('virt.restore', 'disable_for_job',
                                                default=False, key_type=bool)
 
+#: How the guest image is restored between tests: 'xz' decompresses the
+#: image again, 'overlay' runs the VMs on qcow2 overlays of the image
+RESTORE_IMAGE_MODE = settings.get_value('virt.restore', 'mode', default='xz')
+
+#: Maximum size of the cache of decompressed guest images, in MiB (0
+#: disables the cache)
+IMAGE_CACHE_QUOTA = settings.get_value('virt.restore', 'image_cache_quota',
+                                       default=2048, key_type=int)
+
 #: If the screendump thread should be enabled
 SCREENDUMP_THREAD_ENABLE = settings.get_value('virt.screendumps', 'enable',
                                               default=False, key_type=bool)
@@ -111,3 +192,85 @@ VIDEO_ENCODING_JPEG_QUALITY = settings.get_value('virt.videos',
 #: The timeout for migrations
 MIGRATE_TIMEOUT = settings.get_value('virt.qemu.migrate', 'timeout',
                                      default=60.0, key_type=float)
+
+#: Maximum number of pending QMP events kept per VM
+QMP_EVENT_CAPACITY = settings.get_value('virt.qemu.monitor', 'event_capacity',
+                                        default=1024, key_type=int)
+
+#: Per event type caps of pending QMP events, as NAME:CAP[,NAME:CAP...]
+QMP_EVENT_TYPE_CAPS = settings.get_value('virt.qemu.monitor',
+                                         'event_type_caps', default='')
+
+#: If the monitors and consoles of all VMs should be served by a single
+#: event loop (VM hub) instead of per VM threads and processes
+VM_HUB_ENABLE = settings.get_value('virt.qemu.hub', 'enable',
+                                   default=False, key_type=bool)
+
+#: If QMP commands should be checked against the QMP schema of the QEMU
+#: binary before being sent
+QMP_VALIDATE = settings.get_value('virt.qemu.monitor', 'validate',
+                                  default=False, key_type=bool)
+
+#: If the QMP traffic of every VM should be recorded in the test logdir
+QMP_RECORD = settings.get_value('virt.qemu.monitor', 'record',
+                                default=False, key_type=bool)
+
+#: Range of the host ports handed out to VMs (both ends included)
+PORT_RANGE_START = settings.get_value('virt.qemu.ports', 'start',
+                                      default=5000, key_type=int)
+PORT_RANGE_END = settings.get_value('virt.qemu.ports', 'end',
+                                    default=65535, key_type=int)
+
+#: Number of consecutive ports reserved at once by an avocado process
+PORT_BLOCK_SIZE = settings.get_value('virt.qemu.ports', 'block_size',
+                                     default=16, key_type=int)
+
+#: If VMs should resume the saved state of a previous VM with the same
+#: configuration instead of booting
+VM_STATE_CACHE = settings.get_value('virt.qemu.state', 'cache',
+                                    default=False, key_type=bool)
+
+#: Maximum size of the saved VM states and their overlays, in MiB
+VM_STATE_CACHE_QUOTA = settings.get_value('virt.qemu.state', 'quota',
+                                          default=4096, key_type=int)
+
+#: Number of QEMU command line parts (devices) from which the devices are
+#: given to QEMU in a -readconfig file rather than on the command line (0
+#: never uses a file)
+READCONFIG_THRESHOLD = settings.get_value('virt.qemu.cmdline',
+                                          'readconfig_threshold',
+                                          default=0, key_type=int)
+
+#: If the serial console of the VMs should be read in process, rather
+#: than through an 'nc' process driven by aexpect
+CONSOLE_NATIVE = settings.get_value('virt.qemu.console', 'native',
+                                    default=True, key_type=bool)
+
+#: Compression of the serial console logs: 'gzip', 'zstd' (needs the
+#: zstandard module) or empty for plain text logs
+CONSOLE_LOG_COMPRESSION = settings.get_value('virt.qemu.console',
+                                             'log_compression', default='')
+
+
+class _DefaultsModule(types.ModuleType):
+
+    """
+    This module, also answering to the QEMU_BIN, QEMU_DST_BIN, QEMU_IMG_BIN
+    and QEMU_IO_BIN names of former versions without looking the binaries
+    up at import time.
+    """
+
+    def __getattr__(self, name):
+        key = _COMPAT_NAMES.get(name)
+        if key is None:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 name)
+        return _qemu_binary(key)
+
+
+_module = _DefaultsModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# The functions above keep using the globals of the original module, which
+# must not be garbage collected
+_module.__dict__['_original_module'] = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -20,8 +20,6 @@ import logging
 import os
 from argparse import FileType
 
-from avocado.utils import process
-
 # Avocado's plugin interface module has changed location. Let's keep
 # compatibility with old for at, least, a new LTS release
 try:
@@ -30,14 +28,11 @@ except ImportError:
     from avocado.plugins.base import CLI
 
 from .. import defaults
+from ..utils import image_cache
+from ..utils import video_support
 
-try:
-    from ..utils import video
-    # We are not going to need this module for now
-    del video
-    VIDEO_ENCODING_SUPPORT = True
-except ImportError:
-    VIDEO_ENCODING_SUPPORT = False
+# Found without importing GStreamer, which is slow
+VIDEO_ENCODING_SUPPORT = video_support.is_supported()
 
 
 LOG = logging.getLogger("avocado.app")
@@ -59,22 +54,26 @@ class VirtRun(CLI):
 
         virt_parser = run_subcommand_parser.add_argument_group('virtualization '
                                                                'testing arguments')
+        # The binaries are looked up only when the run needs them, not
+        # every time avocado starts
         virt_parser.add_argument(
-            '--qemu-bin', type=str, default=defaults.QEMU_BIN,
-            help=('Path to a custom qemu binary to be tested. Current: '
-                  '%(default)s'))
+            '--qemu-bin', type=str, default=None,
+            help=('Path to a custom qemu binary to be tested. Default: '
+                  'the qemu_bin setting, $QEMU or a qemu binary in $PATH'))
         virt_parser.add_argument(
-            '--qemu-dst-bin', type=str, default=defaults.QEMU_DST_BIN,
+            '--qemu-dst-bin', type=str, default=None,
             help=('Path to a destination qemu binary to be tested. Used as '
-                  'incoming QEMU in migration tests. Current: %(default)s'))
+                  'incoming QEMU in migration tests. Default: the '
+                  'qemu_dst_bin setting, $QEMU_DST or a qemu binary in '
+                  '$PATH'))
         virt_parser.add_argument(
-            '--qemu-img-bin', type=str, default=defaults.QEMU_IMG_BIN,
-            help=('Path to a custom qemu-img binary to be tested. '
-                  'Current %(default)s'))
+            '--qemu-img-bin', type=str, default=None,
+            help=('Path to a custom qemu-img binary to be tested. Default: '
+                  'the qemu_img_bin setting, $QEMU_IMG or qemu-img in $PATH'))
         virt_parser.add_argument(
-            '--qemu-io-bin', type=str, default=defaults.QEMU_IO_BIN,
-            help=('Path to a custom qemu-io binary to be tested. '
-                  'Current: %(default)s'))
+            '--qemu-io-bin', type=str, default=None,
+            help=('Path to a custom qemu-io binary to be tested. Default: '
+                  'the qemu_io_bin setting, $QEMU_IO or qemu-io in $PATH'))
         virt_parser.add_argument(
             '--guest-image-path', type=str, default=defaults.GUEST_IMAGE_PATH,
             help=('Path to a guest image to be used in tests. Current: '
@@ -110,10 +109,18 @@ class VirtRun(CLI):
             app_args.avocado_variants.add_default_param("avocado-virt",
                                                         key, value, path)
 
-        set_value('/plugins/virt/qemu/paths', 'qemu_bin', arg='qemu_bin')
-        set_value('/plugins/virt/qemu/paths', 'qemu_dst_bin', arg='qemu_dst_bin')
-        set_value('/plugins/virt/qemu/paths', 'qemu_img_bin', arg='qemu_img_bin')
-        set_value('/plugins/virt/paths', 'qemu_io_bin', arg='qemu_io_bin')
+        set_value('/plugins/virt/qemu/paths', 'qemu_bin',
+                  value=(getattr(app_args, 'qemu_bin', None) or
+                         defaults.get_qemu_bin()))
+        set_value('/plugins/virt/qemu/paths', 'qemu_dst_bin',
+                  value=(getattr(app_args, 'qemu_dst_bin', None) or
+                         defaults.get_qemu_dst_bin()))
+        set_value('/plugins/virt/qemu/paths', 'qemu_img_bin',
+                  value=(getattr(app_args, 'qemu_img_bin', None) or
+                         defaults.get_qemu_img_bin()))
+        set_value('/plugins/virt/paths', 'qemu_io_bin',
+                  value=(getattr(app_args, 'qemu_io_bin', None) or
+                         defaults.get_qemu_io_bin()))
         set_value('/plugins/virt/guest', 'image_path', arg='guest_image_path')
         set_value('/plugins/virt/guest', 'user', arg='guest_user')
         set_value('/plugins/virt/guest', 'password', arg='guest_password')
@@ -123,6 +130,32 @@ class VirtRun(CLI):
                   value=defaults.SCREENDUMP_THREAD_INTERVAL)
         set_value('/plugins/virt/qemu/migrate', 'timeout', 'migrate_timeout',
                   value=defaults.MIGRATE_TIMEOUT)
+        set_value('/plugins/virt/qemu/monitor', 'event_capacity',
+                  value=defaults.QMP_EVENT_CAPACITY)
+        set_value('/plugins/virt/qemu/monitor', 'event_type_caps',
+                  value=defaults.QMP_EVENT_TYPE_CAPS)
+        set_value('/plugins/virt/qemu/monitor', 'validate',
+                  value=defaults.QMP_VALIDATE)
+        set_value('/plugins/virt/qemu/monitor', 'record',
+                  value=defaults.QMP_RECORD)
+        set_value('/plugins/virt/qemu/hub', 'enable',
+                  value=defaults.VM_HUB_ENABLE)
+        set_value('/plugins/virt/qemu/state', 'cache',
+                  value=defaults.VM_STATE_CACHE)
+        set_value('/plugins/virt/qemu/state', 'quota',
+                  value=defaults.VM_STATE_CACHE_QUOTA)
+        set_value('/plugins/virt/qemu/ports', 'start',
+                  value=defaults.PORT_RANGE_START)
+        set_value('/plugins/virt/qemu/ports', 'end',
+                  value=defaults.PORT_RANGE_END)
+        set_value('/plugins/virt/qemu/ports', 'block_size',
+                  value=defaults.PORT_BLOCK_SIZE)
+        set_value('/plugins/virt/qemu/cmdline', 'readconfig_threshold',
+                  value=defaults.READCONFIG_THRESHOLD)
+        set_value('/plugins/virt/qemu/console', 'native',
+                  value=defaults.CONSOLE_NATIVE)
+        set_value('/plugins/virt/qemu/console', 'log_compression',
+                  value=defaults.CONSOLE_LOG_COMPRESSION)
         if getattr(app_args, 'qemu_template', False):
             set_value('/plugins/virt/qemu/template', 'contents',
                       value=app_args.qemu_template.read())
@@ -131,6 +164,10 @@ class VirtRun(CLI):
                   value=defaults.VIDEO_ENCODING_JPEG_QUALITY)
         set_value('/plugins/virt/guest', 'disable_restore_image_test',
                   value=defaults.DISABLE_RESTORE_IMAGE_TEST)
+        set_value('/plugins/virt/guest', 'restore_mode',
+                  value=defaults.RESTORE_IMAGE_MODE)
+        set_value('/plugins/virt/guest', 'image_cache_quota',
+                  value=defaults.IMAGE_CACHE_QUOTA)
 
     def run(self, args):
         def app_using_human_output(args):
@@ -150,8 +187,5 @@ class VirtRun(CLI):
                 if app_using_human_output(args):
                     LOG.debug("Plugin setup (Restoring guest image backup). "
                               "Please wait...")
-                cwd = os.getcwd()
-                os.chdir(os.path.dirname(compressed_drive_file))
-                process.run('xz -d %s' %
-                            os.path.basename(compressed_drive_file))
-                os.chdir(cwd)
+                image_cache.restore_image(compressed_drive_file, drive_file,
+                                          defaults.IMAGE_CACHE_QUOTA)
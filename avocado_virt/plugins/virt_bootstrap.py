@@ -17,12 +17,13 @@ import os
 import urllib2
 
 from avocado.core import data_dir
-from avocado.utils import download
 from avocado.utils import path
 from avocado.utils import crypto
-from avocado.utils import process
 from avocado.utils import path as utils_path
 
+from avocado_virt.utils import fetch
+from avocado_virt.utils import image_cache
+
 # Avocado's plugin interface module has changed location. Let's keep
 # compatibility with old for at, least, a new LTS release
 try:
@@ -65,20 +66,21 @@ class VirtBootstrap(CLICmd):
         except Exception, exc:
             LOG.error('Failed to get SHA1 from file: %s', exc)
             fail = True
-            sha1 = "FAILED TO GET DOWNLOADED FROM AVOCADO-PROJECT"
+            sha1 = None
 
         jeos_dst_dir = path.init_dir(os.path.join(data_dir.get_data_dir(),
                                                   'images'))
         jeos_dst_path = os.path.join(jeos_dst_dir, 'jeos-25-64.qcow2.xz')
+        jeos_image_path = os.path.splitext(jeos_dst_path)[0]
 
         if os.path.isfile(jeos_dst_path):
             actual_sha1 = crypto.hash_file(filename=jeos_dst_path,
                                            algorithm="sha1")
         else:
-            actual_sha1 = 'FILE DOES NOT EXIST LOCALLY'
+            actual_sha1 = None
 
-        if actual_sha1 != sha1:
-            if actual_sha1 == 'FILE DOES NOT EXIST LOCALLY':
+        if actual_sha1 is None or actual_sha1 != sha1:
+            if actual_sha1 is None:
                 LOG.debug('JeOS could not be found at %s. Downloading '
                           'it (205 MB). Please wait...', jeos_dst_path)
             else:
@@ -87,25 +89,31 @@ class VirtBootstrap(CLICmd):
                           'Please wait...', jeos_dst_path)
             jeos_url = ("https://avocado-project.org/data/assets/jeos/25/"
                         "jeos-25-64.qcow2.xz")
+            # The image is verified and uncompressed while it downloads
             try:
-                download.url_download(jeos_url, jeos_dst_path)
-            except:
-                LOG.warn('Exiting upon user request (Download not finished)')
+                fetch.fetch_image(jeos_url, jeos_dst_path, jeos_image_path,
+                                  sha1)
+                LOG.debug('Successfully downloaded and uncompressed the '
+                          'image')
+            except KeyboardInterrupt:
+                LOG.warn('Exiting upon user request (Download not '
+                         'finished, it will be resumed next time)')
+                fail = True
+            except Exception, exc:
+                LOG.error('Failed to download the JeOS image: %s', exc)
+                fail = True
         else:
             LOG.debug('Compressed JeOS image found in %s, with proper SHA1',
                       jeos_dst_path)
-
-        LOG.debug('Uncompressing the JeOS image to restore pristine '
-                  'state. Please wait...')
-        os.chdir(os.path.dirname(jeos_dst_path))
-        cmd = 'xz --keep --force -d %s' % os.path.basename(jeos_dst_path)
-        result = process.run(cmd, ignore_status=True)
-        if result.exit_status != 0:
-            LOG.error('Error uncompressing the image (see details below):\n%s',
-                      result)
-            fail = True
-        else:
-            LOG.debug('Successfully uncompressed the image')
+            LOG.debug('Uncompressing the JeOS image to restore pristine '
+                      'state. Please wait...')
+            try:
+                image_cache.decompress(jeos_dst_path, jeos_image_path)
+                LOG.debug('Successfully uncompressed the image')
+            except Exception, exc:
+                LOG.error('Error uncompressing the image (see details '
+                          'below):\n%s', exc)
+                fail = True
 
         if fail:
             LOG.warn('Problems found probing this system for tests '
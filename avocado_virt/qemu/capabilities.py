@@ -0,0 +1,246 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Persistent cache of what a QEMU binary supports.
+
+The QMP commands, the QMP schema, the migration capabilities and the
+device types of a QEMU binary are probed once, by starting it without a
+guest, and stored in the avocado data dir.  The cache is keyed by the hash
+of the binary, and the hash itself is only computed again when the size
+or modification time of the binary change, so looking the capabilities
+up costs a couple of stat() calls.
+"""
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+
+from avocado.core import data_dir
+from avocado.utils import process
+from avocado.utils import path as utils_path
+from . import monitor
+
+
+class QMPArgumentError(monitor.QMPError):
+    pass
+
+
+def _cache_dir():
+    return utils_path.init_dir(os.path.join(data_dir.get_data_dir(),
+                                            'cache', 'qemu-capabilities'))
+
+
+def _write_json(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(data, tmp_file)
+    os.rename(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _update_index(index_path, key, entry):
+    """
+    Set an entry of the cache index, which other avocado processes may be
+    updating at the same time.
+    """
+    with open(index_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index = _read_json(index_path) or {}
+        index[key] = entry
+        _write_json(index_path, index)
+
+
+def _hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as binary:
+        while True:
+            data = binary.read(1 << 20)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+class QemuCapabilities(object):
+
+    """
+    What a given QEMU binary supports.
+    """
+
+    def __init__(self, qemu_bin, data):
+        self.qemu_bin = qemu_bin
+        self.commands = frozenset(data.get('commands', []))
+        self.migrate_capabilities = frozenset(
+            data.get('migrate_capabilities', []))
+        self.device_types = frozenset(data.get('device_types', []))
+        self._schema = dict((entity['name'], entity)
+                            for entity in data.get('schema', []))
+
+    def __repr__(self):
+        return ('%s(qemu_bin=%r, commands=%d, device_types=%d)' %
+                (self.__class__.__name__, self.qemu_bin, len(self.commands),
+                 len(self.device_types)))
+
+    def has_command(self, name):
+        return name in self.commands
+
+    def has_device_type(self, name):
+        return name in self.device_types
+
+    def has_migrate_capability(self, name):
+        return name in self.migrate_capabilities
+
+    def validate_qmp(self, cmd, args=None):
+        """
+        Check a QMP command and its arguments without sending it.
+
+        Arguments are checked against the QMP schema when the binary
+        provides one (QEMU 2.5 and later), otherwise only the command name
+        is checked.
+
+        :param cmd: QMP command name
+        :param args: dict with the command arguments
+        :raise: QMPArgumentError if QEMU would reject the command
+        """
+        if args is None:
+            args = {}
+        if self.commands and cmd not in self.commands:
+            raise QMPArgumentError('%s does not support the QMP command %s' %
+                                   (self.qemu_bin, cmd))
+        entity = self._schema.get(cmd)
+        if entity is None:
+            return
+        arg_type = self._schema.get(entity.get('arg-type'))
+        if arg_type is None or arg_type.get('meta-type') != 'object':
+            return
+        members = dict((member['name'], member)
+                       for member in arg_type.get('members', []))
+        missing = [name for name, member in members.items()
+                   if 'default' not in member and name not in args]
+        if missing:
+            raise QMPArgumentError('QMP command %s is missing the mandatory '
+                                   'argument(s) %s' %
+                                   (cmd, ', '.join(sorted(missing))))
+        # Union arguments get extra members from their variants
+        if 'variants' in arg_type:
+            return
+        unknown = [name for name in args if name not in members]
+        if unknown:
+            raise QMPArgumentError('QMP command %s does not take the '
+                                   'argument(s) %s' %
+                                   (cmd, ', '.join(sorted(unknown))))
+
+
+def probe(qemu_bin):
+    """
+    Start a QEMU binary without a guest and ask it what it supports.
+
+    :param qemu_bin: path to the QEMU binary
+    :return: dict with 'commands', 'schema', 'migrate_capabilities' and
+             'device_types'
+    """
+    data = {}
+    result = process.run('%s -device help' % qemu_bin, ignore_status=True)
+    data['device_types'] = re.findall(r'name "([^"]+)"',
+                                      result.stdout + result.stderr)
+
+    monitor_socket = tempfile.mktemp(dir=data_dir.get_tmp_dir())
+    qmp = monitor.QEMUMonitorProtocol(monitor_socket, server=True)
+    cmdline = ('%s -S -machine none -nodefaults -display none '
+               '-chardev socket,id=mon,path=%s '
+               '-mon chardev=mon,mode=control' % (qemu_bin, monitor_socket))
+    qemu = process.SubProcess(cmd=cmdline)
+    qemu.start()
+    try:
+        qmp.accept()
+        for key, cmd in (('commands', 'query-commands'),
+                         ('schema', 'query-qmp-schema'),
+                         ('migrate_capabilities',
+                          'query-migrate-capabilities')):
+            resp = qmp.cmd(cmd)
+            if resp is None or 'return' not in resp:
+                data[key] = []
+            elif key == 'commands':
+                data[key] = [command['name'] for command in resp['return']]
+            elif key == 'migrate_capabilities':
+                data[key] = [cap['capability'] for cap in resp['return']]
+            else:
+                data[key] = resp['return']
+        qmp.cmd('quit')
+        qemu.wait()
+    finally:
+        if qemu.result.exit_status is None:
+            qemu.kill()
+        qmp.close()
+        try:
+            os.remove(monitor_socket)
+        except OSError:
+            pass
+    return data
+
+
+_MEMO = {}
+_MEMO_LOCK = threading.Lock()
+
+
+def get_capabilities(qemu_bin, refresh=False):
+    """
+    Return the capabilities of a QEMU binary, probing it only once.
+
+    :param qemu_bin: path to the QEMU binary, such as the one returned by
+                     :func:`avocado_virt.qemu.path.get_qemu_binary`
+    :param refresh: probe the binary even if its capabilities are cached
+    :rtype: :class:`QemuCapabilities`
+    """
+    real_path = os.path.realpath(qemu_bin)
+    stat = os.stat(real_path)
+    stamp = [stat.st_size, stat.st_mtime]
+    memo_key = (real_path, stat.st_size, stat.st_mtime)
+    with _MEMO_LOCK:
+        if not refresh and memo_key in _MEMO:
+            return _MEMO[memo_key]
+
+        cache_dir = _cache_dir()
+        index_path = os.path.join(cache_dir, 'index.json')
+        index = _read_json(index_path) or {}
+        entry = index.get(real_path)
+        if entry is not None and entry.get('stamp') == stamp:
+            sha1 = entry['sha1']
+        else:
+            sha1 = _hash_file(real_path)
+            _update_index(index_path, real_path,
+                          {'stamp': stamp, 'sha1': sha1})
+
+        data_path = os.path.join(cache_dir, '%s.json' % sha1)
+        data = None
+        if not refresh:
+            data = _read_json(data_path)
+        if data is None:
+            data = probe(real_path)
+            _write_json(data_path, data)
+
+        capabilities = QemuCapabilities(qemu_bin, data)
+        _MEMO[memo_key] = capabilities
+        return capabilities
@@ -0,0 +1,445 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+In-process client for the VM serial console.
+
+The console is read by the :class:`avocado_virt.qemu.hub.VMHub` thread
+shared by all the VMs of the process, instead of an ``nc`` process and an
+aexpect reader per VM.  Its output is kept in a bounded buffer, matched
+incrementally by :meth:`SerialConsole.read_until`, and handed to the
+console log in blocks, one write per read from the socket.
+"""
+
+import re
+import time
+import errno
+import select
+import socket
+import threading
+
+import aexpect
+
+from . import hub as vm_hub
+
+
+class ConsoleError(aexpect.ShellError, aexpect.ExpectError):
+
+    """
+    Base of the console errors.
+
+    They are also the aexpect errors a ``ShellSession`` raises in the same
+    cases, so tests catch them the same way whichever console the VM uses.
+    """
+
+    def __init__(self, reason, cmd=None, output='', patterns=None,
+                 status=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.cmd = cmd
+        self.output = output
+        self.patterns = patterns
+        self.status = status
+
+    def __str__(self):
+        return self.reason
+
+
+class ConsoleTimeoutError(ConsoleError, aexpect.ShellTimeoutError,
+                          aexpect.ExpectTimeoutError):
+    pass
+
+
+class ConsoleClosedError(ConsoleError, aexpect.ShellProcessTerminatedError,
+                         aexpect.ExpectProcessTerminatedError):
+    pass
+
+
+class ConsoleStatusError(ConsoleError, aexpect.ShellStatusError):
+    pass
+
+
+class ConsoleCommandError(ConsoleError, aexpect.ShellCmdError):
+
+    def __init__(self, command, status, output):
+        ConsoleError.__init__(self, 'Command %r failed with status %s, '
+                              'output: %r' % (command, status, output),
+                              command, output, status=status)
+        self.command = command
+
+
+def _last_line_start(text, end=None):
+    """
+    Position of the start of the last line of text[:end].
+    """
+    if end is None:
+        end = len(text)
+    return text.rfind('\n', 0, end) + 1
+
+
+def _last_nonempty_line(text):
+    """
+    :return: (start, end) of the last line of text which is not blank
+    """
+    end = len(text)
+    while end > 0:
+        start = _last_line_start(text, end)
+        if text[start:end].strip():
+            return start, end
+        end = start - 1
+    return 0, 0
+
+
+class SerialConsole(object):
+
+    """
+    Client of a serial port QEMU exposes as a unix socket server.
+
+    The console is served by a :class:`avocado_virt.qemu.hub.VMHub`: its
+    output is written to ``log`` in timestamped lines, the way
+    ``genio.log_line`` writes them, handed line by line to ``output_func``
+    if any, and kept in a bounded buffer that the read methods look at.
+    The command methods, and the errors they raise, follow the aexpect
+    ``ShellSession`` ones.
+    """
+
+    def __init__(self, address, hub=None, output_func=None, output_params=(),
+                 prompt=r"[\#\$]", buffer_size=1 << 20, log=None):
+        """
+        :param address: path of the serial unix socket
+        :param hub: :class:`avocado_virt.qemu.hub.VMHub` serving the console
+                    (the one shared by the process if None)
+        :param output_func: function called with ``output_params`` and each
+                            line of output, such as ``genio.log_line`` when
+                            there is no ``log``
+        :param output_params: leading arguments to ``output_func``
+        :param prompt: regular expression matching the guest shell prompt
+        :param buffer_size: maximum amount of output kept for matching
+        :param log: file like object the output is written to, such as a
+                    :class:`avocado_virt.utils.log_sink.LogStream`, flushed
+                    on every hub tick and closed with the console
+        """
+        self.address = address
+        self.prompt = prompt
+        self.output_func = output_func
+        self.output_params = tuple(output_params)
+        self.buffer_size = buffer_size
+        self.log = log
+        if hub is None:
+            hub = vm_hub.VMHub()
+        self._hub = hub
+        self._cond = threading.Condition()
+        #: Extended in place, so reads do not copy the whole buffer
+        self._output = bytearray()
+        #: Position of the start of _output in the whole console output,
+        #: which does not move when the buffer is trimmed or consumed
+        self._offset = 0
+        self._partial_line = ''
+        self._closed = False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.sock.setblocking(0)
+        self._hub.register(self)
+
+    def __str__(self):
+        return 'Serial console (%s)' % self.address
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle_read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, err:
+            return err[0] == errno.EAGAIN
+        if not data:
+            return False
+        with self._cond:
+            self._output += data
+            # Trimmed by halves, rather than moved on every read once full
+            if len(self._output) > 2 * self.buffer_size:
+                trimmed = len(self._output) - self.buffer_size
+                del self._output[:trimmed]
+                self._offset += trimmed
+            self._cond.notify_all()
+        self._log_output(data)
+        return True
+
+    def handle_tick(self):
+        if self.log is not None:
+            self.log.flush()
+
+    def handle_close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._partial_line:
+            self._log_output('\n')
+
+    def _log_output(self, data):
+        if self.log is None and self.output_func is None:
+            return
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        if not lines:
+            return
+        # Lines end with '\r\n' on the serial port
+        lines = [line.rstrip('\r') for line in lines]
+        if self.log is not None:
+            timestr = time.strftime("%Y-%m-%d %H:%M:%S")
+            self.log.write(''.join('%s: %s\n' % (timestr, line)
+                                   for line in lines))
+        if self.output_func is not None:
+            for line in lines:
+                self.output_func(*(self.output_params + (line,)))
+
+    def is_alive(self):
+        return not self._closed
+
+    def send(self, data):
+        """
+        Write data to the console.
+        """
+        # The socket stays non-blocking, it is shared with the hub thread
+        while data:
+            try:
+                sent = self.sock.send(data)
+            except socket.error, err:
+                if err[0] != errno.EAGAIN:
+                    raise
+                select.select([], [self.sock], [], 1.0)
+                continue
+            data = data[sent:]
+
+    def sendline(self, line=''):
+        self.send(line + '\n')
+
+    def get_output(self):
+        """
+        Return the output received and not consumed by the read methods.
+        """
+        with self._cond:
+            return str(self._output)
+
+    def clear_output(self):
+        with self._cond:
+            self._offset += len(self._output)
+            del self._output[:]
+
+    def read_nonblocking(self, internal_timeout=0.1, timeout=None):
+        """
+        Return and consume the output received so far, after waiting
+        until no output comes for ``internal_timeout`` seconds, or for at
+        most ``timeout`` seconds.
+        """
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        with self._cond:
+            while not self._closed:
+                length = len(self._output) + self._offset
+                wait = internal_timeout
+                if end_time is not None:
+                    wait = min(wait, end_time - time.time())
+                if wait <= 0:
+                    break
+                self._cond.wait(wait)
+                if len(self._output) + self._offset == length:
+                    break
+            output = str(self._output)
+            self._offset += len(output)
+            del self._output[:]
+        return output
+
+    def _read_until(self, find, description, timeout, patterns=None):
+        """
+        Wait until ``find(output, start)`` returns the end of a match.
+
+        ``start`` is where the output may have changed since the previous
+        call: the start of the line which was the last one then, as it may
+        have been incomplete.  Only the new output is looked at, which
+        keeps waiting on chatty consoles cheap.
+
+        :return: the output up to the end of the match, which is consumed
+        """
+        end_time = time.time() + timeout
+        search_from = 0
+        with self._cond:
+            while True:
+                start = max(0, search_from - self._offset)
+                end = find(self._output, start)
+                if end is not None:
+                    text = str(self._output[:end])
+                    del self._output[:end]
+                    self._offset += end
+                    return text
+                search_from = self._offset + _last_line_start(self._output)
+                if self._closed:
+                    raise ConsoleClosedError('%s closed while waiting for '
+                                             '%s' % (self, description),
+                                             output=str(self._output),
+                                             patterns=patterns)
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    raise ConsoleTimeoutError('%s not found in %s after %s s'
+                                              % (description, self, timeout),
+                                              output=str(self._output),
+                                              patterns=patterns)
+                self._cond.wait(remaining)
+
+    def read_until(self, pattern, timeout=60.0, incremental=True):
+        """
+        Wait until the console output matches a regular expression.
+
+        :param pattern: regular expression (string or compiled)
+        :param timeout: seconds to wait
+        :param incremental: only look for matches starting in new output
+                            or in the last line of the output already
+                            looked at; False looks at the whole output
+                            every time, for patterns spanning lines
+        :return: the output up to the end of the match, which is consumed
+        :raise: ConsoleTimeoutError if there is no match in time
+        :raise: ConsoleClosedError if the console is closed first
+        """
+        regex = re.compile(pattern)
+
+        def find(output, start):
+            match = regex.search(output, start if incremental else 0)
+            if match is None:
+                return None
+            return match.end()
+
+        return self._read_until(find, repr(regex.pattern), timeout,
+                                [regex.pattern])
+
+    def read_until_last_line_matches(self, patterns, timeout=60.0):
+        """
+        Wait until the last non blank line of the output matches one of
+        some regular expressions, such as a shell prompt.
+
+        :return: (index of the matching pattern, output), the output is
+                 consumed
+        """
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        regexes = [re.compile(pattern) for pattern in patterns]
+        matched = []
+
+        def find(output, _):
+            start, end = _last_nonempty_line(output)
+            for index, regex in enumerate(regexes):
+                if regex.search(output, start, end):
+                    matched.append(index)
+                    return len(output)
+            return None
+
+        text = self._read_until(find, 'last line matching %r' %
+                                [r.pattern for r in regexes], timeout,
+                                patterns)
+        return matched[0], text
+
+    def read_until_any_line_matches(self, patterns, timeout=60.0):
+        """
+        Wait until a line of the output matches one of some regular
+        expressions.
+
+        :return: (index of the matching pattern, output up to the end of
+                 the matching line), the output is consumed
+        """
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        regexes = [re.compile(pattern, re.MULTILINE) for pattern in patterns]
+        matched = []
+
+        def find(output, start):
+            found = None
+            for index, regex in enumerate(regexes):
+                match = regex.search(output, start)
+                if match is not None and (found is None or
+                                          match.start() < found[1]):
+                    found = (index, match.start())
+            if found is None:
+                return None
+            matched.append(found[0])
+            line_end = output.find('\n', found[1])
+            if line_end < 0:
+                return len(output)
+            return line_end + 1
+
+        text = self._read_until(find, 'line matching %r' %
+                                [r.pattern for r in regexes], timeout,
+                                patterns)
+        return matched[0], text
+
+    def read_up_to_prompt(self, timeout=60.0):
+        return self.read_until_last_line_matches([self.prompt], timeout)[1]
+
+    def cmd_output(self, cmd, timeout=60.0):
+        """
+        Run a command in the guest shell and return its output.
+
+        :raise: ConsoleTimeoutError if the prompt does not come back in time
+        """
+        self.clear_output()
+        self.sendline(cmd)
+        try:
+            output = self.read_up_to_prompt(timeout).replace('\r\n', '\n')
+        except ConsoleError, details:
+            details.cmd = cmd
+            raise
+        lines = output.split('\n')
+        # Leave out the command echoed by the shell and the new prompt
+        if lines and cmd in lines[0]:
+            lines = lines[1:]
+        start, _ = _last_nonempty_line('\n'.join(lines))
+        return '\n'.join(lines)[:start]
+
+    def cmd_status_output(self, cmd, timeout=60.0):
+        """
+        :return: (exit status, output) of a command run in the guest shell
+        """
+        output = self.cmd_output(cmd, timeout)
+        status = self.cmd_output('echo $?', timeout).strip()
+        try:
+            return int(status.splitlines()[-1]), output
+        except (IndexError, ValueError):
+            raise ConsoleStatusError('Could not get the exit status of %r '
+                                     'from %r' % (cmd, status), cmd, output)
+
+    def cmd_status(self, cmd, timeout=60.0):
+        return self.cmd_status_output(cmd, timeout)[0]
+
+    def cmd(self, cmd, timeout=60.0, ok_status=(0,), ignore_all_errors=False):
+        """
+        Run a command in the guest shell, checking its exit status.
+
+        :return: the output of the command
+        :raise: ConsoleCommandError if the exit status is not in ok_status
+        """
+        try:
+            status, output = self.cmd_status_output(cmd, timeout)
+        except ConsoleError:
+            if ignore_all_errors:
+                return None
+            raise
+        if status not in ok_status and not ignore_all_errors:
+            raise ConsoleCommandError(cmd, status, output)
+        return output
+
+    def close(self):
+        self._hub.unregister(self)
+        self.handle_close()
+        self.sock.close()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
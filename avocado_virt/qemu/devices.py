@@ -18,9 +18,24 @@
 # Author: Stefan Hajnoczi <stefanha@redhat.com>
 # Author: Ruda Moura <rmoura@redhat.com>
 
+import os
+import json
+import shlex
+import pipes
+import errno
+import fcntl
+import atexit
+import socket
+import tempfile
+import threading
+
+from avocado.core import data_dir
 from avocado.utils import network
+from avocado.utils import path as utils_path
 from avocado.utils.data_structures import Borg
 from . import path
+from . import capabilities
+from ..utils import image
 
 
 class UnsupportedMigrationProtocol(Exception):
@@ -31,46 +46,190 @@ class UnknownQemuDevice(Exception):
     pass
 
 
+#: Default range of the ports handed out to VMs (both ends included)
+DEFAULT_START_PORT = 5000
+DEFAULT_END_PORT = 65535
+
+#: Default number of ports reserved at once by a process
+DEFAULT_PORT_BLOCK_SIZE = 16
+
+
+class PortTrackerError(Exception):
+    pass
+
+
 class PortTracker(Borg):
 
     """
     Tracks ports used in the host machine.
+
+    Ports are handed out from blocks of consecutive ports reserved by the
+    current process in a table shared by all the avocado processes of the
+    host, in the avocado data dir and updated under a lock, so parallel
+    jobs never probe nor take the same ports.  Blocks of processes that are
+    gone are reclaimed.  A port is only probed when it is handed out, to
+    skip the ones other programs listen on.
     """
 
     def __init__(self):
         Borg.__init__(self)
-        self.address = 'localhost'
-        self.start_port = 5000
         if not hasattr(self, 'retained_ports'):
-            self._reset_retained_ports()
+            self.address = 'localhost'
+            self.start_port = DEFAULT_START_PORT
+            self.end_port = DEFAULT_END_PORT
+            self.block_size = DEFAULT_PORT_BLOCK_SIZE
+            self.retained_ports = set()
+            self._foreign_ports = set()
+            self._lock = threading.Lock()
+        # Forked processes reserve blocks of their own, the ports retained
+        # by their parent stay retained
+        if getattr(self, '_pid', None) != os.getpid():
+            self._pid = os.getpid()
+            self._blocks = set()
+            atexit.register(self._release_blocks)
 
     def __str__(self):
-        return 'Ports tracked: %r' % self.retained_ports
+        return 'Ports tracked: %r' % sorted(self.retained_ports)
+
+    def configure(self, start_port=None, end_port=None, block_size=None):
+        """
+        Change the range ports are handed out from, for the blocks reserved
+        from now on.
+        """
+        if start_port is not None:
+            self.start_port = int(start_port)
+        if end_port is not None:
+            self.end_port = int(end_port)
+        if block_size is not None:
+            self.block_size = max(1, int(block_size))
 
     def _reset_retained_ports(self):
-        self.retained_ports = []
+        self.retained_ports = set()
+
+    @staticmethod
+    def _table_path():
+        return os.path.join(utils_path.init_dir(data_dir.get_data_dir(),
+                                                'ports'), 'blocks.json')
+
+    def _update_table(self, update_func):
+        """
+        Call ``update_func(blocks)`` with the shared table locked, blocks
+        being a dict of first ports (as strings) to {'pid', 'size'} dicts,
+        without the blocks of processes that are gone.
+        """
+        table_path = self._table_path()
+        with open(table_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(table_path) as table_file:
+                    blocks = json.load(table_file)
+            except (IOError, ValueError):
+                blocks = {}
+            for first, block in blocks.items():
+                try:
+                    os.kill(block['pid'], 0)
+                except OSError, details:
+                    if details.errno == errno.ESRCH:
+                        del blocks[first]
+            result = update_func(blocks)
+            tmp_path = '%s.%s' % (table_path, os.getpid())
+            with open(tmp_path, 'w') as table_file:
+                json.dump(blocks, table_file)
+            os.rename(tmp_path, table_path)
+        return result
+
+    def _reserve_block(self, start_port):
+        """
+        Reserve the first free block holding ports from start_port on.
+
+        :return: first port of the block
+        """
+        def reserve(blocks):
+            taken = [(int(first), int(first) + block['size'])
+                     for first, block in blocks.items()]
+            # Blocks are aligned on the start of the range
+            first = (start_port -
+                     (start_port - self.start_port) % self.block_size)
+            while first <= self.end_port:
+                last = first + self.block_size
+                if not [1 for begin, end in taken
+                        if begin < last and first < end]:
+                    blocks[str(first)] = {'pid': os.getpid(),
+                                          'size': self.block_size}
+                    return first
+                first = last
+            raise PortTrackerError('No free block of %d ports between %d '
+                                   'and %d' % (self.block_size, start_port,
+                                               self.end_port))
+
+        first = self._update_table(reserve)
+        self._blocks.add((first, self.block_size))
+        return first
+
+    def _release_blocks(self):
+        if self._pid != os.getpid() or not self._blocks:
+            return
+
+        def release(blocks):
+            for first, block in blocks.items():
+                if block['pid'] == os.getpid():
+                    del blocks[first]
+
+        try:
+            self._update_table(release)
+        except (IOError, OSError):
+            pass
+        self._blocks = set()
+
+    def _find_in_block(self, first, size, start_port):
+        for port in xrange(max(first, start_port),
+                           min(first + size, self.end_port + 1)):
+            if port in self.retained_ports or port in self._foreign_ports:
+                continue
+            if network.is_port_free(port, self.address):
+                return port
+            self._foreign_ports.add(port)
+        return None
 
     def register_port(self, port):
-        if ((port not in self.retained_ports) and
-                (network.is_port_free(port, self.address))):
-            self.retained_ports.append(port)
-        else:
-            raise ValueError('Port %d in use' % port)
+        with self._lock:
+            if ((port not in self.retained_ports) and
+                    (network.is_port_free(port, self.address))):
+                self.retained_ports.add(port)
+            else:
+                raise ValueError('Port %d in use' % port)
         return port
 
     def find_free_port(self, start_port=None):
+        """
+        Hand out a free port.
+
+        :param start_port: lowest acceptable port, the start of the range
+                           by default
+        :raise: PortTrackerError if the range is exhausted
+        """
         if start_port is None:
             start_port = self.start_port
-        port = start_port
-        while ((port in self.retained_ports) or
-               (not network.is_port_free(port, self.address))):
-            port += 1
-        self.retained_ports.append(port)
+        start_port = max(start_port, self.start_port)
+        with self._lock:
+            for first, size in sorted(self._blocks):
+                if first + size <= start_port:
+                    continue
+                port = self._find_in_block(first, size, start_port)
+                if port is not None:
+                    break
+            else:
+                port = None
+            while port is None:
+                first = self._reserve_block(start_port)
+                port = self._find_in_block(first, self.block_size, start_port)
+                start_port = max(start_port, first + self.block_size)
+            self.retained_ports.add(port)
         return port
 
     def release_port(self, port):
-        if port in self.retained:
-            self.retained.remove(port)
+        with self._lock:
+            self.retained_ports.discard(port)
 
 
 class QemuDevice(object):
@@ -88,8 +247,14 @@ class QemuDevice(object):
 
     def __init__(self):
         self._args = []
+        self._argv = None
         self.ports = PortTracker()
 
+    def __setattr__(self, name, value):
+        # Setting any attribute may change the arguments of the device
+        self.__dict__['_argv'] = None
+        object.__setattr__(self, name, value)
+
     def __repr__(self):
         return '%s(name=%r)' % (self.__class__.__name__, self.name)
 
@@ -100,6 +265,22 @@ class QemuDevice(object):
         # pylint: disable=E1124
         return ' '.join(self._args).format(self=self)
 
+    def get_args(self):
+        """
+        Arguments of the device, as a list ready to be executed.
+
+        The ``_args`` templates are split the way a shell would, then each
+        argument is formatted, so values containing spaces or quotes stay
+        in one argument.  The list is built once, and built again only
+        after an attribute of the device is set.
+        """
+        if self._argv is None:
+            # pylint: disable=E1124
+            self.__dict__['_argv'] = [arg.format(self=self)
+                                      for template in self._args
+                                      for arg in shlex.split(template)]
+        return self._argv
+
     def clone(self):
         return self
 
@@ -111,7 +292,7 @@ class QemuDeviceGeneric(QemuDevice):
     def __init__(self, cmdline):
         QemuDevice.__init__(self)
         self.cmdline = cmdline
-        self._args = cmdline.split()
+        self._args = [cmdline]
 
 
 class QemuBinary(QemuDevice):
@@ -183,7 +364,7 @@ class QemuDeviceVNC(QemuDevice):
         self._args = ['-vnc :{self.port}']
 
     def clone(self):
-        self.port = self.ports.find_free_port(self.port + 5900) - 5900
+        self.port = self.ports.find_free_port(5900) - 5900
         return self
 
 
@@ -245,9 +426,14 @@ class QemuDeviceDrive(QemuDevice):
     name = 'drive'
 
     def __init__(self, drive_file, device_type='virtio-blk-pci',
-                 device_id='avocado_image', drive_id='device_avocado_image'):
+                 device_id='avocado_image', drive_id='device_avocado_image',
+                 overlay=False):
         QemuDevice.__init__(self)
         self.drive_file = drive_file
+        #: The image the drive was added with, drive_file may point to an
+        #: overlay of it
+        self.image_file = drive_file
+        self.overlay = overlay
         self.device_type = device_type
         self.device_id = device_id
         self.drive_id = drive_id
@@ -273,10 +459,11 @@ class QemuDeviceNetwork(QemuDevice):
         self.device_id = device_id
         self.nic_id = nic_id
         self._args = ['-device {self.device_type},id={self.device_id},netdev={self.nic_id}',
-                      '-netdev {self.netdev_type},id={self.nic_id},hostfwd=tcp::{self.ports.redir_port}-:22']
+                      '-netdev {self.netdev_type},id={self.nic_id},hostfwd=tcp::{self.redir_port}-:22']
 
     def clone(self):
-        self.ports.redir_port = self.ports.find_free_port(self.ports.redir_port)
+        # Ports released by former migration sources are reused
+        self.ports.redir_port = self.ports.find_free_port()
         self.redir_port = self.ports.redir_port
         return self
 
@@ -289,11 +476,123 @@ class QemuDeviceIncoming(QemuDevice):
 
     name = 'incoming'
 
-    def __init__(self, protocol='tcp', port=5000):
+    def __init__(self, protocol='tcp', port=5000, command=None, path=None,
+                 fd=None, defer=False):
         QemuDevice.__init__(self)
         self.protocol = protocol
         self.port = port
-        self._args = ['-incoming {self.protocol}:0:{self.port}']
+        self.command = command
+        self.path = path
+        self.fd = fd
+        self.defer = defer
+        if defer:
+            # The migration is started with 'migrate-incoming', once the
+            # capabilities are set
+            self._args = ['-incoming defer']
+        elif protocol == 'exec':
+            self._args = ['-incoming "{self.uri}"']
+        else:
+            self._args = ['-incoming {self.uri}']
+
+    @property
+    def uri(self):
+        if self.protocol == 'exec':
+            return 'exec:%s' % self.command
+        elif self.protocol == 'unix':
+            return 'unix:%s' % self.path
+        elif self.protocol == 'fd':
+            return 'fd:%d' % self.fd
+        return '%s:0:%s' % (self.protocol, self.port)
+
+
+def _subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for subsubclass in _subclasses(subclass):
+            yield subsubclass
+
+
+#: QemuDevice subclasses by name, see get_device_class()
+_DEVICE_CLASSES = {}
+
+
+def get_device_class(name_or_class):
+    """
+    Return the QemuDevice subclass of a name.
+
+    Subclasses at any depth are found.  The registry is built on first use,
+    and built again when a name is not in it, for device classes defined
+    since then.
+
+    :param name_or_class: device name, or QemuDevice subclass (returned
+                          as is)
+    :raise: UnknownQemuDevice
+    """
+    if isinstance(name_or_class, type):
+        if issubclass(name_or_class, QemuDevice):
+            return name_or_class
+        raise UnknownQemuDevice(name_or_class)
+    cls = _DEVICE_CLASSES.get(name_or_class)
+    if cls is None:
+        _DEVICE_CLASSES.clear()
+        for subclass in _subclasses(QemuDevice):
+            # Subclasses which do not set a name are variants of their
+            # parent, which keeps the name
+            if 'name' in subclass.__dict__:
+                _DEVICE_CLASSES.setdefault(subclass.name, subclass)
+        cls = _DEVICE_CLASSES.get(name_or_class)
+        if cls is None:
+            raise UnknownQemuDevice(name_or_class)
+    return cls
+
+
+#: Options QEMU can read from a -readconfig file, and the name of the
+#: value they take without a name, if any
+READCONFIG_OPTIONS = {'-chardev': 'backend',
+                      '-device': 'driver',
+                      '-drive': None,
+                      '-mon': None,
+                      '-netdev': 'type',
+                      '-object': 'qom-type'}
+
+
+def _config_section(option, value):
+    """
+    Turn an option of the command line into a -readconfig section.
+
+    :return: the section, as text, or None if the value can not be written
+             in a configuration file (quotes, escaped commas)
+    """
+    if '"' in value or ',,' in value:
+        return None
+    implied = READCONFIG_OPTIONS[option]
+    section_id = None
+    opts = []
+    for index, opt in enumerate(value.split(',')):
+        if not opt:
+            continue
+        if '=' in opt:
+            key, opt_value = opt.split('=', 1)
+        elif index == 0 and implied is not None:
+            key, opt_value = implied, opt
+        elif opt.startswith('no'):
+            # QEMU reads 'nowait' as 'wait=off'
+            key, opt_value = opt[2:], 'off'
+        else:
+            key, opt_value = opt, 'on'
+        if key == 'id':
+            section_id = opt_value
+        else:
+            opts.append('  %s = "%s"' % (key, opt_value))
+    if section_id is None:
+        header = '[%s]' % option[1:]
+    else:
+        header = '[%s "%s"]' % (option[1:], section_id)
+    return '\n'.join([header] + opts)
+
+
+#: Devices of a QEMU process not carried over to its clones
+CLONE_EXCLUDED_DEVICES = ('qmp', 'serial', 'fd', 'incoming')
 
 
 class QemuDevices(object):
@@ -303,54 +602,171 @@ class QemuDevices(object):
         self.qemu_bin = path.get_qemu_binary(params)
         self.devices = [QemuBinary(self.qemu_bin)]
         self.ports = PortTracker()
-        self._qemu_device_classes = list(cls for cls in QemuDevice.__subclasses__())
+        if params:
+            self.ports.configure(
+                params.get('start', '/plugins/virt/qemu/ports/*',
+                           default=DEFAULT_START_PORT),
+                params.get('end', '/plugins/virt/qemu/ports/*',
+                           default=DEFAULT_END_PORT),
+                params.get('block_size', '/plugins/virt/qemu/ports/*',
+                           default=DEFAULT_PORT_BLOCK_SIZE))
+        #: Drive overlays created for the VM, removed by remove_overlays()
+        self.overlays = []
+        #: Socket inherited by QEMU for an 'fd' incoming migration, to be
+        #: closed once QEMU is started
+        self.incoming_socket = None
+        #: Ports retained for this QEMU process, see release_ports()
+        self.owned_ports = []
+        #: Devices by name
+        self._index = {}
+        self._reindex()
 
     def __str__(self):
         return self.get_cmdline()
 
+    def get_capabilities(self):
+        """
+        Return what the QEMU binary supports, from the capabilities cache.
+
+        :rtype: :class:`avocado_virt.qemu.capabilities.QemuCapabilities`
+        """
+        return capabilities.get_capabilities(self.qemu_bin)
+
+    def has_device_type(self, device_type):
+        """
+        Whether the QEMU binary supports a -device type, such as
+        'virtio-blk-pci'.
+        """
+        return self.get_capabilities().has_device_type(device_type)
+
+    def _reindex(self):
+        self._index = {}
+        for dev in self.devices:
+            self._index.setdefault(dev.name, []).append(dev)
+
     def add_device(self, name_or_class, **kwargs):
-        dev = None
-        for cls in self._qemu_device_classes:
-            if name_or_class == cls.name or name_or_class == cls:
-                dev = cls(**kwargs)
-                self.devices.append(dev)
-        if dev is None:
-            raise UnknownQemuDevice(name_or_class)
+        """
+        Add a device, by name or QemuDevice subclass.
+
+        :return: the new device
+        :raise: UnknownQemuDevice
+        """
+        dev = get_device_class(name_or_class)(**kwargs)
+        self.devices.append(dev)
+        self._index.setdefault(dev.name, []).append(dev)
+        return dev
+
+    def _find_device(self, name_or_class):
+        if isinstance(name_or_class, type):
+            for dev in self._index.get(name_or_class.name, []):
+                if dev.__class__ == name_or_class:
+                    return dev
+            return None
+        devs = self._index.get(name_or_class)
+        if devs:
+            return devs[0]
+        return None
 
     def remove_device(self, name_or_class):
-        not_found = True
-        for dev in list(self.devices):
-            if dev.name == name_or_class or dev.__class__ == name_or_class:
-                self.devices.remove(dev)
-                not_found = False
-                break
-        if not_found:
+        dev = self._find_device(name_or_class)
+        if dev is None:
             raise ValueError('%s not in devices' % name_or_class)
+        self.devices.remove(dev)
+        self._index[dev.name].remove(dev)
 
     def has_device(self, name_or_class):
-        not_found = False
-        for dev in self.devices:
-            if dev.name == name_or_class or dev.__class__ == name_or_class:
-                not_found = True
-                break
-        return not_found
+        return self._find_device(name_or_class) is not None
+
+    def get_devices(self, name):
+        """
+        Return the devices of a name, in the order they were added.
+        """
+        return list(self._index.get(name, []))
 
     def get_cmdline(self):
         devices = [str(dev) for dev in self.devices]
         return ' '.join(devices)
 
+    def get_args(self):
+        """
+        Return the QEMU command line, as a list of arguments.
+
+        Only the devices changed since the last call format their
+        arguments again.
+        """
+        args = []
+        for dev in self.devices:
+            args.extend(dev.get_args())
+        return args
+
+    def get_readconfig_args(self, config_path):
+        """
+        Return the QEMU command line, as a list of arguments, with the
+        options QEMU can read from a configuration file (see
+        READCONFIG_OPTIONS) written to config_path and given to QEMU with
+        -readconfig.
+
+        Keeps the command line of VMs with hundreds of devices short.
+        """
+        all_args = self.get_args()
+        args = all_args[:1] + ['-readconfig', config_path]
+        sections = []
+        index = 1
+        while index < len(all_args):
+            option = all_args[index]
+            if option in READCONFIG_OPTIONS and index + 1 < len(all_args):
+                section = _config_section(option, all_args[index + 1])
+                if section is not None:
+                    sections.append(section)
+                    index += 2
+                    continue
+            args.append(option)
+            index += 1
+        with open(config_path, 'w') as config_file:
+            config_file.write('# Written by avocado-virt\n\n')
+            config_file.write('\n\n'.join(sections) + '\n')
+        return args
+
+    @staticmethod
+    def args_to_cmdline(args):
+        """
+        Quote a list of arguments into a command line which splits back
+        into the same arguments.
+        """
+        return ' '.join(pipes.quote(arg) for arg in args)
+
     def clone(self, params=None):
         new_qemu_devices = QemuDevices(params)
-        new_qemu_devices.devices = list(self.devices)
-        for exclude in ['qmp', 'serial', 'fd', 'incoming']:
-            try:
-                new_qemu_devices.remove_device(exclude)
-            except ValueError:
-                pass
+        new_qemu_devices.devices = [dev for dev in self.devices
+                                    if dev.name not in CLONE_EXCLUDED_DEVICES]
+        new_qemu_devices._reindex()
+        # The clone runs on the same drives, and overlays
+        new_qemu_devices.overlays = self.overlays
         for dev in new_qemu_devices.devices:
             dev.clone()
+            if dev.name == 'network':
+                new_qemu_devices.owned_ports.append(dev.redir_port)
+            elif dev.name == 'vnc':
+                new_qemu_devices.owned_ports.append(dev.port + 5900)
         return new_qemu_devices
 
+    def set_qemu_binary(self, qemu_bin):
+        """
+        Run another QEMU binary, such as for migrations between versions.
+        """
+        self.qemu_bin = qemu_bin
+        self.devices[0] = QemuBinary(qemu_bin)
+        self._reindex()
+
+    def release_ports(self):
+        """
+        Give the ports of this QEMU process back, once it is shut down for
+        good, such as after it migrated away.
+        """
+        for port in self.owned_ports:
+            self.ports.release_port(port)
+        self.owned_ports = []
+
     def add_nodefaults(self):
         self.add_device('nodefaults')
 
@@ -364,7 +780,8 @@ class QemuDevices(object):
         if port is None:
             port = self.ports.find_free_port(5900)
         else:
-            self._port.register_port(port)
+            self.ports.register_port(port)
+        self.owned_ports.append(port)
         self.add_device('vnc', port=port - 5900)    # vnc :0 == port 5900
 
     def add_qmp_monitor(self, monitor_socket):
@@ -374,7 +791,8 @@ class QemuDevices(object):
         self.add_device('fd', fd=fd, fdset=fdset, opaque=opaque, opts=opts)
 
     def add_drive(self, drive_file=None, device_type='virtio-blk-pci',
-                  device_id='avocado_image', drive_id='device_avocado_image'):
+                  device_id='avocado_image', drive_id='device_avocado_image',
+                  overlay=False):
         """
         Add a drive device to the VM.
 
@@ -384,15 +802,61 @@ class QemuDevices(object):
         :param device_type: Type of the drive path added (ide, virtio, scsi).
         :param device_id: String identifying the newly added device.
         :param drive_id: String identifying the newly added drive.
+        :param overlay: Whether the VM should run on a qcow2 overlay of the
+                        drive file, created when the VM is powered on and
+                        removed when it is powered off, leaving the drive
+                        file untouched.
         """
         if drive_file is None:
             drive_file = self.params.get('image_path', '/plugins/virt/guest/*')
         self.add_device('drive', drive_file=drive_file, device_type=device_type,
-                        device_id=device_id, drive_id=drive_id)
+                        device_id=device_id, drive_id=drive_id,
+                        overlay=overlay)
+
+    def create_overlay(self, drive, backing_file=None, backing_format=None):
+        """
+        Point a drive to a new qcow2 overlay, removed by remove_overlays().
+
+        :param drive: :class:`QemuDeviceDrive`
+        :param backing_file: Image the overlay is on top of (by default, the
+                             image the drive was added with).
+        :param backing_format: Format of the backing file (detected if None).
+        :return: Path of the overlay.
+        """
+        if backing_file is None:
+            backing_file = drive.image_file
+        overlay = tempfile.mktemp(suffix='.qcow2', dir=data_dir.get_tmp_dir())
+        image.create_overlay(path.get_qemu_img_binary(self.params),
+                             backing_file, overlay, backing_format)
+        drive.drive_file = overlay
+        self.overlays.append(overlay)
+        return overlay
+
+    def prepare_overlays(self):
+        """
+        Create the overlays of the drives added with overlay=True.
+        """
+        for dev in self.get_devices('drive'):
+            if dev.overlay and dev.drive_file == dev.image_file:
+                self.create_overlay(dev)
+
+    def remove_overlays(self):
+        """
+        Remove the drive overlays and point the drives back to their images.
+        """
+        for overlay in self.overlays:
+            try:
+                os.remove(overlay)
+            except OSError:
+                pass
+        del self.overlays[:]
+        for dev in self.get_devices('drive'):
+            dev.drive_file = dev.image_file
 
     def add_net(self, netdev_type='user', device_type='virtio-net-pci',
                 device_id='avocado_nic', nic_id='device_avocado_nic'):
-        self.ports.redir_port = self.ports.find_free_port(5000)
+        self.ports.redir_port = self.ports.find_free_port()
+        self.owned_ports.append(self.ports.redir_port)
         self.add_device('network', redir_port=self.ports.redir_port,
                         netdev_type=netdev_type, device_type=device_type,
                         device_id=device_id, nic_id=nic_id)
@@ -400,10 +864,46 @@ class QemuDevices(object):
     def add_serial(self, serial_socket, device_id='avocado_serial'):
         self.add_device('serial', socket=serial_socket, device_id=device_id)
 
-    def add_incoming(self, protocol):
-        if protocol == 'tcp':
-            self.ports.migration_tcp_port = self.ports.find_free_port(5000)
-            self.add_device('incoming', protocol=protocol, port=self.ports.migration_tcp_port)
+    def add_incoming(self, protocol, command=None, defer=False):
+        """
+        Make the VM wait for an incoming migration.
+
+        :param protocol: 'tcp', 'unix' (unix socket), 'fd' (socket pair,
+                         one end inherited by QEMU) or 'exec' to read the
+                         migration stream from the output of a shell command
+        :param command: shell command, for the 'exec' protocol
+        :param defer: wait for 'migrate-incoming' to start the migration,
+                      so migration capabilities can be set first (the URI
+                      to give it is the ``uri`` of the 'incoming' device)
+        :return: the TCP port for the 'tcp' protocol, the socket path for
+                 the 'unix' protocol, the other end of the socket pair for
+                 the 'fd' protocol (to be passed to the source QEMU) and
+                 None for the 'exec' protocol
+        """
+        if protocol == 'exec':
+            self.add_device('incoming', protocol=protocol, command=command,
+                            defer=defer)
+            return None
+        elif protocol == 'unix':
+            sock_path = tempfile.mktemp(prefix='migrate-',
+                                        dir=data_dir.get_tmp_dir())
+            self.add_device('incoming', protocol=protocol, path=sock_path,
+                            defer=defer)
+            return sock_path
+        elif protocol == 'fd':
+            src_sock, dst_sock = socket.socketpair()
+            # Only the destination QEMU must inherit its end
+            flags = fcntl.fcntl(src_sock, fcntl.F_GETFD)
+            fcntl.fcntl(src_sock, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+            self.add_device('incoming', protocol=protocol,
+                            fd=dst_sock.fileno(), defer=defer)
+            self.incoming_socket = dst_sock
+            return src_sock
+        elif protocol == 'tcp':
+            self.ports.migration_tcp_port = self.ports.find_free_port()
+            self.owned_ports.append(self.ports.migration_tcp_port)
+            self.add_device('incoming', protocol=protocol,
+                            port=self.ports.migration_tcp_port, defer=defer)
         else:
             msg = 'Migration %s still unsupported' % protocol
             raise UnsupportedMigrationProtocol(msg)
@@ -0,0 +1,404 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Fake QEMU monitor replaying QMP traffic recorded by
+:class:`avocado_virt.qemu.monitor.QMPRecorder`.
+
+Commands are answered with the recorded reply of the next recorded
+command with the same name, and the events QEMU sent after that reply are
+sent again, so VM.power_on, VM.migrate and the event handling can be
+exercised and benchmarked without KVM or a QEMU binary.
+
+It can serve a monitor socket directly::
+
+    python -m avocado_virt.qemu.fake_monitor --replay qmp.jsonl \\
+        --connect /tmp/monitor.sock
+
+or stand in for the QEMU binary itself, taking the recording from the
+``QMP_REPLAY`` environment variable, by pointing the ``qemu_bin`` param to
+the ``avocado-virt-fake-qemu`` script.  In that case the monitor and serial
+chardevs of the QEMU command line are served, everything else is ignored.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+#: Greeting sent when the recording does not have one
+DEFAULT_GREETING = {'QMP': {'version': {'qemu': {'major': 2, 'minor': 0,
+                                                 'micro': 0},
+                                        'package': ''},
+                            'capabilities': []}}
+
+
+def load_recording(path):
+    """
+    Read a QMP recording.
+
+    :param path: file written by :class:`avocado_virt.qemu.monitor.QMPRecorder`
+    :return: list of dicts with the 't', 'dir' and 'msg' keys
+    """
+    entries = []
+    with open(path) as recording:
+        for line in recording:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+class QMPExchange(object):
+
+    """
+    A recorded command, its reply and the events that followed the reply.
+    """
+
+    def __init__(self, cmd, sent_at):
+        self.cmd = cmd
+        self.name = cmd.get('execute')
+        self.sent_at = sent_at
+        self.reply = None
+        self.replied_at = None
+        #: list of (seconds after the reply, event) tuples
+        self.events = []
+
+    def __repr__(self):
+        return '%s(execute=%r, events=%d)' % (self.__class__.__name__,
+                                              self.name, len(self.events))
+
+    @property
+    def latency(self):
+        return max(0.0, self.replied_at - self.sent_at)
+
+
+class QMPReplay(object):
+
+    """
+    Answers QMP commands from a recording.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: recording, as returned by :func:`load_recording`
+        """
+        self.greeting = DEFAULT_GREETING
+        #: list of (seconds after the greeting, event) tuples
+        self.initial_events = []
+        self.exchanges = []
+        self._next = 0
+        greeting_at = 0.0
+        unanswered = []
+        last = None
+        for entry in entries:
+            direction, msg, when = entry['dir'], entry['msg'], entry['t']
+            if direction == 'greeting':
+                self.greeting = msg
+                greeting_at = when
+            elif direction == 'cmd':
+                exchange = QMPExchange(msg, when)
+                self.exchanges.append(exchange)
+                unanswered.append(exchange)
+            elif direction == 'reply':
+                exchange = self._pop_unanswered(unanswered, msg.get('id'))
+                if exchange is None:
+                    continue
+                exchange.reply = msg
+                exchange.replied_at = when
+                last = exchange
+            elif direction == 'event':
+                if last is None:
+                    self.initial_events.append((when - greeting_at, msg))
+                else:
+                    last.events.append((when - last.replied_at, msg))
+        self.exchanges = [answered for answered in self.exchanges
+                          if answered.reply is not None]
+
+    @staticmethod
+    def _pop_unanswered(unanswered, qmp_id):
+        for exchange in unanswered:
+            if qmp_id is not None and exchange.cmd.get('id') == qmp_id:
+                unanswered.remove(exchange)
+                return exchange
+        if unanswered:
+            return unanswered.pop(0)
+        return None
+
+    def answer(self, cmd):
+        """
+        Find the reply to a command.
+
+        The recording is searched from the command after the last one
+        replayed, wrapping around, so commands sent repeatedly (such as
+        'query-migrate' while polling) get their recorded replies in order.
+
+        :param cmd: QMP command as a Python dict
+        :return: (latency, reply, events) tuple, where events is a list of
+                 (seconds after the reply, event) tuples.  Unknown commands
+                 get an empty successful reply.
+        """
+        name = cmd.get('execute')
+        count = len(self.exchanges)
+        exchange = None
+        for offset in xrange(count):
+            index = (self._next + offset) % count
+            if self.exchanges[index].name == name:
+                exchange = self.exchanges[index]
+                self._next = index + 1
+                break
+        if exchange is None:
+            latency, reply, events = 0.0, {'return': {}}, []
+        else:
+            latency = exchange.latency
+            reply = dict(exchange.reply)
+            events = exchange.events
+        reply.pop('id', None)
+        if 'id' in cmd:
+            reply['id'] = cmd['id']
+        return latency, reply, events
+
+
+class FakeQEMUMonitor(object):
+
+    """
+    Serves one QMP connection from a :class:`QMPReplay`.
+    """
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, replay, speed=0.0):
+        """
+        :param replay: :class:`QMPReplay`
+        :param speed: replay speed relative to the recording: 1.0 keeps the
+                      recorded reply latencies and event delays, 0 sends
+                      everything as fast as possible
+        """
+        self.replay = replay
+        self.speed = speed
+
+    def _sleep(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    @staticmethod
+    def _send(sock, msg):
+        sock.sendall(json.dumps(msg) + '\r\n')
+
+    def _send_events(self, sock, events):
+        elapsed = 0.0
+        for delay, event in events:
+            self._sleep(delay - elapsed)
+            elapsed = max(elapsed, delay)
+            event = dict(event)
+            now = time.time()
+            event['timestamp'] = {'seconds': int(now),
+                                  'microseconds': int(now % 1 * 1000000)}
+            self._send(sock, event)
+
+    def _commands(self, sock):
+        data = ''
+        while True:
+            received = sock.recv(65536)
+            if not received:
+                return
+            # Clients do not terminate commands, they can arrive back to
+            # back or split across reads
+            data += received
+            idx = 0
+            while True:
+                while idx < len(data) and data[idx].isspace():
+                    idx += 1
+                if idx == len(data):
+                    break
+                try:
+                    cmd, idx = self._decoder.raw_decode(data, idx)
+                except ValueError:
+                    break
+                yield cmd
+            data = data[idx:]
+
+    def serve(self, sock):
+        """
+        Replay the recording over a connected socket, until the client
+        disconnects or sends 'quit'.
+        """
+        self._send(sock, self.replay.greeting)
+        self._send_events(sock, self.replay.initial_events)
+        try:
+            for cmd in self._commands(sock):
+                latency, reply, events = self.replay.answer(cmd)
+                self._sleep(latency)
+                self._send(sock, reply)
+                self._send_events(sock, events)
+                if cmd.get('execute') == 'quit':
+                    break
+        except socket.error:
+            pass
+        sock.close()
+
+    def connect(self, address):
+        """
+        Connect to a monitor socket, the way QEMU does with a client chardev.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        self.serve(sock)
+
+    def listen(self, address):
+        """
+        Wait for a client on a unix socket and serve it.
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        listener.listen(1)
+        try:
+            sock, _ = listener.accept()
+        finally:
+            listener.close()
+            os.unlink(address)
+        self.serve(sock)
+
+
+def _sink(listener):
+    # Accept serial console clients and discard what they write
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except socket.error:
+            return
+        thread = threading.Thread(target=_drain, args=(sock,))
+        thread.daemon = True
+        thread.start()
+
+
+def _drain(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except socket.error:
+        pass
+    sock.close()
+
+
+def _parse_readconfig(path):
+    """
+    :return: list of dicts with the options of the chardev sections of a
+             -readconfig file
+    """
+    chardevs = []
+    opts = None
+    with open(path) as config_file:
+        for line in config_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('['):
+                opts = None
+                if line[1:].split(None, 1)[0].rstrip(']') == 'chardev':
+                    opts = {}
+                    chardevs.append(opts)
+            elif opts is not None and '=' in line:
+                key, _, val = line.partition('=')
+                opts[key.strip()] = val.strip().strip('"')
+    return chardevs
+
+
+def _parse_chardevs(qemu_args):
+    """
+    :return: list of dicts with the options of the socket chardevs, given
+             with -chardev or in -readconfig files
+    """
+    chardevs = []
+    for option, value in zip(qemu_args, qemu_args[1:]):
+        if option == '-readconfig':
+            chardevs.extend(opts for opts in _parse_readconfig(value)
+                            if opts.get('backend') == 'socket')
+        elif option == '-chardev' and value.startswith('socket,'):
+            opts = {}
+            for item in value.split(',')[1:]:
+                key, _, val = item.partition('=')
+                opts[key] = val
+            chardevs.append(opts)
+    return chardevs
+
+
+def run_as_qemu(qemu_args, replay, speed=0.0):
+    """
+    Stand in for a QEMU process started with ``qemu_args``.
+
+    Server chardevs (serial consoles) are listened on before connecting to
+    the client chardev (the QMP monitor), as QEMU does.
+
+    :return: exit status
+    """
+    if '-device' in qemu_args and 'help' in qemu_args:
+        return 0
+    monitor_path = None
+    for chardev in _parse_chardevs(qemu_args):
+        if chardev.get('server', 'off') != 'off':
+            # QEMU replaces stale sockets too
+            if os.path.exists(chardev['path']):
+                os.unlink(chardev['path'])
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(chardev['path'])
+            listener.listen(1)
+            thread = threading.Thread(target=_sink, args=(listener,))
+            thread.daemon = True
+            thread.start()
+        else:
+            monitor_path = chardev['path']
+    if monitor_path is None:
+        sys.stderr.write('No QMP monitor chardev in the command line\n')
+        return 1
+    FakeQEMUMonitor(replay, speed).connect(monitor_path)
+    return 0
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and not argv[0].startswith('--'):
+        # Started as a QEMU binary
+        recording = os.environ.get('QMP_REPLAY')
+        if recording is None:
+            sys.stderr.write('QMP_REPLAY is not set\n')
+            return 1
+        speed = float(os.environ.get('QMP_REPLAY_SPEED', 0))
+        return run_as_qemu(argv, QMPReplay(load_recording(recording)), speed)
+
+    parser = argparse.ArgumentParser(description='Replay a QMP recording')
+    parser.add_argument('--replay', required=True,
+                        help='Recording written by QMPRecorder')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='Replay speed relative to the recording '
+                             '(0 replays as fast as possible)')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--connect', metavar='PATH',
+                       help='Connect to a monitor listening on PATH')
+    group.add_argument('--listen', metavar='PATH',
+                       help='Listen on PATH for a QMP client')
+    args = parser.parse_args(argv)
+    fake = FakeQEMUMonitor(QMPReplay(load_recording(args.replay)), args.speed)
+    if args.connect:
+        fake.connect(args.connect)
+    else:
+        fake.listen(args.listen)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
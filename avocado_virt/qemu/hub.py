@@ -0,0 +1,228 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Single event loop serving the monitors and consoles of many VMs.
+
+Without the hub, every VM has its own QMP reader thread and screendump
+thread.  With the hub, all of them are served by one thread polling all
+the sockets, which keeps the per-VM overhead low when many VMs run on the
+same host.  The serial consoles are served by the hub in any case.
+"""
+
+import os
+import time
+import heapq
+import errno
+import select
+import logging
+import threading
+import itertools
+
+from avocado.utils.data_structures import Borg
+
+log = logging.getLogger("avocado.test")
+
+
+class _Poller(object):
+
+    """
+    Thin wrapper over epoll, with a poll fallback.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+            self._poll = None
+        else:
+            self._epoll = None
+            self._poll = select.poll()
+
+    def register(self, fd):
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+        else:
+            self._poll.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        try:
+            if self._epoll is not None:
+                self._epoll.unregister(fd)
+            else:
+                self._poll.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # Already closed
+            pass
+
+    def poll(self, timeout):
+        """
+        :param timeout: seconds (None waits forever)
+        :return: list of (fd, event mask) tuples
+        """
+        try:
+            if self._epoll is not None:
+                if timeout is None:
+                    timeout = -1
+                return self._epoll.poll(timeout)
+            if timeout is not None:
+                timeout *= 1000
+            return self._poll.poll(timeout)
+        except (IOError, OSError, select.error), details:
+            if details.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class VMHub(Borg):
+
+    """
+    Event loop shared by all the VMs of a process.
+
+    Handlers are objects providing:
+
+    * ``fileno()``: the file descriptor to watch for input;
+    * ``handle_read()``: called when there is input, returns False once the
+      peer closed the connection;
+    * ``handle_tick()``: called periodically, every :attr:`tick` seconds;
+    * ``handle_close()``: called once the handler is removed from the hub.
+
+    Timers can be scheduled with :meth:`call_later`.  Every callback runs
+    in the hub thread, so callbacks must not block.
+    """
+
+    #: Seconds between calls to the handlers' handle_tick()
+    tick = 0.5
+
+    def __init__(self):
+        Borg.__init__(self)
+        # The hub thread does not survive a fork, start over in the child
+        if getattr(self, '_pid', None) != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._handlers = {}
+            self._timers = []
+            self._timer_seq = itertools.count()
+            self._poller = None
+            self._wake_r = None
+            self._wake_w = None
+            self._thread = None
+
+    def __str__(self):
+        return 'VM hub (%d handlers, %d timers)' % (len(self._handlers),
+                                                    len(self._timers))
+
+    def _ensure_running(self):
+        # Must be called with self._lock held
+        if self._thread is not None:
+            return
+        self._poller = _Poller()
+        self._wake_r, self._wake_w = os.pipe()
+        self._poller.register(self._wake_r)
+        self._thread = threading.Thread(target=self._loop, name='VMHub')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError:
+            pass
+
+    def in_hub_thread(self):
+        """
+        Whether the caller is running in the hub thread.
+        """
+        return (self._thread is not None and
+                self._thread is threading.current_thread())
+
+    def register(self, handler):
+        """
+        Start serving a handler.
+        """
+        with self._lock:
+            self._ensure_running()
+            fd = handler.fileno()
+            self._handlers[fd] = handler
+            self._poller.register(fd)
+        self._wake()
+
+    def unregister(self, handler):
+        """
+        Stop serving a handler, without calling its handle_close().
+        """
+        with self._lock:
+            self._remove(handler)
+
+    def _remove(self, handler):
+        # Must be called with self._lock held
+        for fd, registered in self._handlers.items():
+            if registered is handler:
+                del self._handlers[fd]
+                self._poller.unregister(fd)
+                return True
+        return False
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call ``callback(*args)`` from the hub thread after ``delay`` seconds.
+        """
+        with self._lock:
+            self._ensure_running()
+            heapq.heappush(self._timers, (time.time() + delay,
+                                          next(self._timer_seq),
+                                          callback, args))
+        self._wake()
+
+    def _run(self, callback, *args):
+        try:
+            return callback(*args)
+        except Exception, details:
+            log.error('VM hub: %s failed: %s', callback, details)
+            return None
+
+    def _close_handler(self, handler):
+        with self._lock:
+            removed = self._remove(handler)
+        if removed:
+            self._run(handler.handle_close)
+
+    def _loop(self):
+        next_tick = time.time() + self.tick
+        while True:
+            with self._lock:
+                timeout = next_tick
+                if self._timers:
+                    timeout = min(timeout, self._timers[0][0])
+            timeout = max(0, timeout - time.time())
+            for fd, _ in self._poller.poll(timeout):
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    continue
+                handler = self._handlers.get(fd)
+                if handler is None:
+                    continue
+                if not self._run(handler.handle_read):
+                    self._close_handler(handler)
+
+            now = time.time()
+            while True:
+                with self._lock:
+                    if not self._timers or self._timers[0][0] > now:
+                        break
+                    _, _, callback, args = heapq.heappop(self._timers)
+                self._run(callback, *args)
+
+            if now >= next_tick:
+                next_tick = now + self.tick
+                for handler in list(self._handlers.values()):
+                    self._run(handler.handle_tick)
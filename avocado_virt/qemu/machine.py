@@ -14,6 +14,8 @@
 
 
 import os
+import json
+import time
 import socket
 import string
 import logging
@@ -28,11 +30,19 @@ from avocado.core import exceptions
 from avocado.core import data_dir
 from avocado.utils import genio
 from avocado.utils import process
-from avocado.utils import wait
 from avocado.utils import path as utils_path
 from . import monitor
 from . import devices
+from . import hub
+from . import console
+from . import migration
+from . import path
+from . import state_cache
+from . import template as qemu_template
 from ..utils import image
+from ..utils import log_sink
+from ..utils import stats as utils_stats
+from ..utils import video_support
 
 try:
     from avocado_runner_remote import Remote
@@ -40,11 +50,6 @@ except ImportError:
     # Old location of the Remoter not available since avocado-46.0
     from avocado.core.remoter import Remote
 
-try:
-    from ..utils import video
-    VIDEO_ENCODING_SUPPORT = True
-except ImportError:
-    VIDEO_ENCODING_SUPPORT = False
 
 log = logging.getLogger("avocado.test")
 
@@ -57,6 +62,10 @@ class VM(object):
 
     def __init__(self, uuid=None, params=None, logdir=None):
         self._popen = None
+        #: QEMU configuration file of the devices, see power_on()
+        self._readconfig_file = None
+        #: Writes the serial console log and the QMP recording
+        self._log_sink = None
         self.pid = None
         if params is None:
             params = {}
@@ -75,6 +84,12 @@ class VM(object):
         self._screendump_terminate = None
         self._screendump_thread = None
         self._video_enable = False
+        self._hub = None
+        self._screendump_index = 1
+        self._qmp_recorder = None
+        #: Statistics of the migrations of this VM, oldest first, as dicts
+        #: (see :meth:`avocado_virt.qemu.migration.MigrationStats.to_dict`)
+        self.migration_stats = []
 
     def __str__(self):
         if self.pid is None:
@@ -82,29 +97,38 @@ class VM(object):
         else:
             return 'QEMU VM (%s PID: %s)' % (self.short_id, self.pid)
 
-    def log(self, msg):
-        log.info('%s %s' % (self, msg))
+    def log(self, msg, *args):
+        """
+        Log a message about the VM, formatted with args only if the log
+        level lets it through.
+        """
+        if args:
+            log.info('%s ' + msg, self, *args)
+        else:
+            log.info('%s %s', self, msg)
 
-    def _template_build_tags(self):
-        only_devices = ' '.join([str(x) for x in self.devices.devices[1:]])
-        tags = {'avocado_defaults': self.devices,
-                'avocado_devices': only_devices}
+    def _template_build_tags(self, names=None):
+        """
+        :param names: tags to build (all of them if None)
+        """
+        tags = {'avocado_defaults': self.devices}
+        if names is None or 'avocado_devices' in names:
+            tags['avocado_devices'] = ' '.join([str(x) for x in
+                                                self.devices.devices[1:]])
         for dev in self.devices.devices:
             tags['avocado_%s' % dev.name] = dev
         return tags
 
-    def _template_apply(self, template, tags):
-        cmdline = None
-        clean = False
-        while not clean:
-            try:
-                cmdline = template.format(**tags)
-            except KeyError, e:
-                tag = e.args[0]
-                self.log("On qemu template: undefined tag '%s' (ignoring)" % tag)
-                template = template.replace('{%s}' % tag, '')
-            else:
-                clean = True
+    def _template_apply(self, template, tags=None):
+        compiled = qemu_template.compile_template(template)
+        if tags is None:
+            tags = self._template_build_tags(compiled.tags)
+        missing = []
+        cmdline = compiled.render(tags, missing)
+        if missing:
+            self.log("On qemu template: undefined tags %s (ignoring)" %
+                     ', '.join("'%s'" % tag for tag in
+                               sorted(set(missing), key=missing.index)))
         return cmdline
 
     def is_on(self):
@@ -115,43 +139,226 @@ class VM(object):
 
         self.monitor_socket = tempfile.mktemp(dir=data_dir.get_tmp_dir())
         self.devices.add_qmp_monitor(self.monitor_socket)
-        self._qmp = monitor.QEMUMonitorProtocol(self.monitor_socket,
-                                                server=True)
+        event_capacity = self.params.get('event_capacity',
+                                         '/plugins/virt/qemu/monitor/*',
+                                         default=monitor.DEFAULT_EVENT_CAPACITY)
+        event_type_caps = self.params.get('event_type_caps',
+                                          '/plugins/virt/qemu/monitor/*')
+        if self.params.get('enable', '/plugins/virt/qemu/hub/*',
+                           default=False):
+            self._hub = hub.VMHub()
+        else:
+            self._hub = None
+        self._qmp = monitor.QEMUMonitorProtocolAsync(
+            self.monitor_socket, server=True,
+            event_capacity=event_capacity,
+            event_type_caps=monitor.parse_event_type_caps(event_type_caps),
+            hub=self._hub)
         self.serial_socket = tempfile.mktemp(dir=data_dir.get_tmp_dir())
         self.devices.add_serial(self.serial_socket)
         if self.params.get('kvm', '/plugins/virt/qemu/*') != "off" and \
                 os.access('/dev/kvm', os.W_OK):
             self.log('Using KVM')
-            self.devices.add_cmdline("-enable-kvm")
+            # Migration destinations get it from their source
+            if not [dev for dev in self.devices.get_devices('generic')
+                    if dev.cmdline == '-enable-kvm']:
+                self.devices.add_cmdline("-enable-kvm")
         else:
             self.log('/dev/kvm not accessible, not using KVM')
 
         tmpl = self.params.get('contents', '/plugins/virt/qemu/template/*')
 
+        saved_state = None
+        if (self.params.get('cache', '/plugins/virt/qemu/state/*',
+                            default=False) and
+                not self.devices.has_device('incoming')):
+            saved_state = self._setup_saved_state(tmpl)
+        self.devices.prepare_overlays()
+
         if tmpl is None:
-            cmdline = self.devices.get_cmdline()
+            readconfig_threshold = self.params.get(
+                'readconfig_threshold', '/plugins/virt/qemu/cmdline/*',
+                default=0)
+            if (readconfig_threshold and
+                    len(self.devices.devices) >= readconfig_threshold):
+                self._readconfig_file = tempfile.mktemp(
+                    suffix='.cfg', dir=data_dir.get_tmp_dir())
+                args = self.devices.get_readconfig_args(
+                    self._readconfig_file)
+            else:
+                args = self.devices.get_args()
+            # Quoted so that SubProcess splits it back into the same
+            # arguments
+            cmdline = self.devices.args_to_cmdline(args)
         else:
-            tags = self._template_build_tags()
-            cmdline = self._template_apply(tmpl, tags)
+            cmdline = self._template_apply(tmpl)
 
         self._popen = process.SubProcess(cmd=cmdline)
         self.pid = self._popen.start()
+        if self.devices.incoming_socket is not None:
+            # QEMU has its own copy now
+            self.devices.incoming_socket.close()
+            self.devices.incoming_socket = None
+        if self.logdir is not None:
+            self._log_sink = log_sink.LogSink()
+        if self.params.get('record', '/plugins/virt/qemu/monitor/*',
+                           default=False) and self.logdir is not None:
+            self._qmp_recorder = monitor.QMPRecorder(
+                os.path.join(self.logdir, 'qmp-%s-%s.jsonl' %
+                             (self.short_id, self.pid)),
+                sink=self._log_sink)
+            self._qmp.set_recorder(self._qmp_recorder)
         self._qmp.accept()
-        self.serial_console = aexpect.ShellSession(
-            "nc -U %s" % self.serial_socket,
-            auto_close=False,
-            output_func=genio.log_line,
-            output_params=("serial-console-%s.log" % self.short_id,),
-            prompt=self.params.get("shell_prompt",
-                                   "/plugins/virt/guest/*",
-                                   default="[\#\$]"))
+        prompt = self.params.get("shell_prompt", "/plugins/virt/guest/*",
+                                 default="[\#\$]")
+        if self.params.get('native', '/plugins/virt/qemu/console/*',
+                           default=True):
+            console_log = None
+            output_func = genio.log_line
+            if self._log_sink is not None:
+                # Written from the sink thread, not the hub thread
+                console_log = self._log_sink.open(
+                    os.path.join(self.logdir, "serial-console-%s.log" %
+                                 self.short_id),
+                    compression=self.params.get(
+                        'log_compression', '/plugins/virt/qemu/console/*'))
+                output_func = None
+            # Served by the VM hub thread even when the monitors are not
+            self.serial_console = console.SerialConsole(
+                self.serial_socket, self._hub,
+                output_func=output_func,
+                output_params=("serial-console-%s.log" % self.short_id,),
+                prompt=prompt, log=console_log)
+        else:
+            self.serial_console = aexpect.ShellSession(
+                "nc -U %s" % self.serial_socket,
+                auto_close=False,
+                output_func=genio.log_line,
+                output_params=("serial-console-%s.log" % self.short_id,),
+                prompt=prompt)
         self._screendump_thread_start()
+        if saved_state is not None:
+            if saved_state.is_saved():
+                self._resume_saved_state(saved_state)
+            else:
+                self._save_state(saved_state)
+
+    def _setup_saved_state(self, template):
+        """
+        Prepare the drives to resume the saved state of this configuration,
+        or to save it if there is none yet.
+
+        :return: :class:`avocado_virt.qemu.state_cache.VMStateCache`, or None
+                 if another VM is saving the state of this configuration
+        """
+        cache = state_cache.VMStateCache(
+            state_cache.state_key(self.devices, template))
+        drives = self.devices.get_devices('drive')
+        if cache.is_saved():
+            # Not evicted until the VM runs on the frozen overlays
+            if not cache.lock(shared=True):
+                return None
+            if not cache.is_saved():
+                cache.unlock()
+                return None
+            for drive in drives:
+                self.devices.create_overlay(
+                    drive, cache.overlay_path(drive.drive_id),
+                    backing_format='qcow2')
+            self.devices.add_incoming('exec',
+                                      command='cat %s' % cache.state_file)
+            return cache
+        if not cache.lock():
+            return None
+        qemu_img = path.get_qemu_img_binary(self.params)
+        for drive in drives:
+            overlay = cache.overlay_path(drive.drive_id)
+            image.create_overlay(qemu_img, drive.image_file, overlay)
+            drive.drive_file = overlay
+        return cache
+
+    def _resume_migrated_state(self):
+        """
+        Wait until the incoming migration is over and the guest runs.
+
+        :return: True if it does, False if the incoming migration failed
+        """
+        timeout = float(self.params.get('timeout',
+                                        '/plugins/virt/qemu/migrate/*'))
+        try:
+            resumed = self._qmp.wait_for_event('RESUME', timeout=timeout)
+        except monitor.QMPConnectError:
+            resumed = None
+        return resumed is not None
+
+    def _resume_saved_state(self, cache):
+        try:
+            if not self._resume_migrated_state():
+                # Most likely saved by a QEMU that is no longer compatible
+                cache.remove()
+                raise exceptions.TestError('%s could not resume the saved '
+                                           'state %s' % (self,
+                                                         cache.state_file))
+            cache.touch()
+        finally:
+            cache.unlock()
+        self.log('Resumed saved state %s' % cache.state_file)
+
+    def _save_state(self, cache):
+        """
+        Save the state of the VM once its guest is ready, for later VMs with
+        the same configuration to resume it.
+
+        The guest is ready once it accepts remote logins, or right away for
+        VMs without network.  The drive overlays the saved state goes with
+        are frozen, the VM carries on on new overlays.  The least recently
+        used states are then evicted past the ``quota`` param (MiB) of
+        /plugins/virt/qemu/state.
+
+        :raise: TestFail if the drive overlays cannot be frozen
+        """
+        try:
+            if self.devices.has_device('network'):
+                self.login_remote()
+            tmp_state_file = '%s.%s' % (cache.state_file, self.pid)
+            stats = self._start_migration('exec:cat > %s' % tmp_state_file)
+            self._wait_for_migration(stats)
+            for drive in self.devices.get_devices('drive'):
+                overlay = tempfile.mktemp(suffix='.qcow2',
+                                          dir=data_dir.get_tmp_dir())
+                resp = self.qmp('blockdev-snapshot-sync',
+                                device=drive.drive_id,
+                                snapshot_file=overlay, format='qcow2')
+                if resp is None or 'error' in resp:
+                    cache.remove_all()
+                    raise exceptions.TestFail('%s could not freeze the '
+                                              'overlay of %s: %s' %
+                                              (self, drive.drive_id, resp))
+                drive.drive_file = overlay
+                self.devices.overlays.append(overlay)
+            self.qmp('cont')
+            cache.commit(tmp_state_file)
+            self.log('Saved state %s' % cache.state_file)
+        finally:
+            cache.unlock()
+        state_cache.evict(int(self.params.get(
+            'quota', '/plugins/virt/qemu/state/*',
+            default=state_cache.DEFAULT_QUOTA)), keep=cache.key)
 
     def power_off(self, migrate=False):
         if self._popen is not None:
             self._screendump_thread_terminate(migrate=migrate)
             self._qmp.cmd('quit')
             self._popen.wait()
+            self._qmp.close()
+            if self._qmp_recorder is not None:
+                self._qmp_recorder.close()
+                self._qmp_recorder = None
+            events = self._qmp.get_event_store()
+            if events.dropped:
+                self.log('Dropped %d QMP events (%s)' %
+                         (events.dropped, events.dropped_by_type))
+            self._write_qmp_stats()
             if migrate:
                 self.log('Shut down (migration src)')
             else:
@@ -159,10 +366,36 @@ class VM(object):
             self._popen = None
             self.pid = None
             self.serial_console.close()
+            if self._log_sink is not None:
+                # Writes what is still queued
+                self._log_sink.close()
+                self._log_sink = None
             try:
                 os.remove(self.serial_socket)
             except:
                 pass
+            if self._readconfig_file is not None:
+                os.remove(self._readconfig_file)
+                self._readconfig_file = None
+            if not migrate:
+                self.devices.remove_overlays()
+
+    def _write_qmp_stats(self):
+        """
+        Write the QMP latency statistics of this QEMU process to the logdir.
+        """
+        if self.logdir is None:
+            return
+        qmp_stats = self._qmp.stats.to_dict()
+        events = self._qmp.get_event_store()
+        qmp_stats['events_dropped'] = events.dropped
+        qmp_stats['events_dropped_by_type'] = events.dropped_by_type
+        qmp_stats['qemu_bin'] = self.devices.qemu_bin
+        qmp_stats['pid'] = self.pid
+        stats_file = os.path.join(self.logdir, 'qmp-stats-%s-%s.json' %
+                                  (self.short_id, self.pid))
+        with open(stats_file, 'w') as stats_fd:
+            json.dump(qmp_stats, stats_fd, sort_keys=True)
 
     def __enter__(self):
         self.power_on()
@@ -172,25 +405,99 @@ class VM(object):
         self.power_off()
         return False
 
-    def qmp(self, cmd, verbose=True, **args):
+    def _qmp_args(self, cmd, args):
         qmp_args = dict()
         for k in args.keys():
             qmp_args[k.translate(string.maketrans('_', '-'))] = args[k]
+        if self.params.get('validate', '/plugins/virt/qemu/monitor/*',
+                           default=False):
+            self.devices.get_capabilities().validate_qmp(cmd, qmp_args)
+        return qmp_args
 
+    def has_qmp_command(self, cmd):
+        """
+        Whether the QEMU binary supports a QMP command.
+
+        The answer comes from the capabilities cache, so it is available
+        before the VM is powered on and costs no monitor round trip.
+        """
+        return self.devices.get_capabilities().has_command(cmd)
+
+    def qmp(self, cmd, verbose=True, **args):
+        qmp_args = self._qmp_args(cmd, args)
         if verbose:
-            self.log("-> QMP %s %s" % (cmd, qmp_args))
+            self.log("-> QMP %s %s", cmd, qmp_args)
         retval = self._qmp.cmd(cmd, args=qmp_args)
         if verbose:
-            self.log("<- QMP %s" % retval)
+            self.log("<- QMP %s", retval)
         return retval
 
+    def qmp_async(self, cmd, verbose=True, **args):
+        """
+        Send a QMP command without waiting for its reply.
+
+        Several commands can be in flight at the same time, the replies are
+        matched to the commands by their QMP ``id``.
+
+        :param cmd: QMP command name.
+        :param verbose: Whether to register the command and its reply into
+                        the test log.
+        :return: :class:`avocado_virt.qemu.monitor.QMPReply`, call its
+                 ``result()`` method to wait for the reply.
+        """
+        qmp_args = self._qmp_args(cmd, args)
+        if verbose:
+            self.log("-> QMP %s %s", cmd, qmp_args)
+        reply = self._qmp.cmd_async(cmd, args=qmp_args)
+        if verbose:
+            reply.add_done_callback(self._log_reply)
+        return reply
+
+    def _log_reply(self, reply):
+        # Called from the monitor reader, result() would raise if the
+        # monitor gave up on the reply
+        error = reply.exception()
+        if error is not None:
+            self.log("<- QMP %s", error)
+        else:
+            self.log("<- QMP %s", reply.result())
+
     def get_qmp_event(self, wait=False):
         return self._qmp.pull_event(wait=wait)
 
     def get_qmp_events(self, wait=False):
-        events = self._qmp.get_events(wait=wait)
-        self._qmp.clear_events()
-        return events
+        return self._qmp.drain_events(wait=wait)
+
+    def wait_for_qmp_event(self, name, match=None, timeout=None):
+        """
+        Wait for a QMP event without polling the monitor.
+
+        :param name: Event name, such as 'SHUTDOWN' or 'BLOCK_JOB_COMPLETED'.
+        :param match: Filter, either a dict that must be contained in the
+                      event (such as ``{'data': {'device': 'drive0'}}``) or
+                      a callable receiving the event.
+        :param timeout: Seconds to wait (None waits forever).
+        :return: The event, or None if it did not arrive in time.
+        """
+        event = self._qmp.wait_for_event(name, match=match, timeout=timeout)
+        if event is None:
+            self.log("QMP event %s not received after %s s", name, timeout)
+        else:
+            self.log("<- QMP event %s", event)
+        return event
+
+    def subscribe_qmp_event(self, callback, name=None, match=None):
+        """
+        Call ``callback(event)`` for every matching QMP event.
+
+        The callback runs in the monitor reader thread.
+
+        :return: Subscription, to be given to :meth:`unsubscribe_qmp_event`.
+        """
+        return self._qmp.subscribe(callback, name=name, match=match)
+
+    def unsubscribe_qmp_event(self, subscription):
+        self._qmp.unsubscribe(subscription)
 
     def hmp_qemu_io(self, drive, cmd):
         return self.qmp('human-monitor-command',
@@ -241,36 +548,356 @@ class VM(object):
         new_vm.devices = self.devices.clone(params)
         return new_vm
 
-    def migrate(self, protocol='tcp'):
-        def migrate_complete():
-            mig_info = self.qmp("query-migrate")
-            mig_status = mig_info['return']['status']
-            if mig_status == 'completed':
-                self.log("Migration successful")
-                return True
-            elif mig_status == 'failed':
-                raise exceptions.TestFail("Migration of %s failed" % self)
-            return False
+    def _check_migration_reply(self, cmd, resp):
+        """
+        :return: the return value of a QMP command of a migration
+        :raise: TestFail with the QMP error if the command failed
+        """
+        if resp is None:
+            raise exceptions.TestFail("Migration of %s: no reply to %s" %
+                                      (self, cmd))
+        if 'error' in resp:
+            raise exceptions.TestFail("Migration of %s: %s failed: %s" %
+                                      (self, cmd,
+                                       resp['error'].get('desc', resp)))
+        return resp['return']
+
+    def _start_migration(self, uri):
+        """
+        Start an outgoing migration, followed through migration events when
+        QEMU supports them.
+
+        :return: :class:`avocado_virt.qemu.migration.MigrationStats`, to be
+                 given to :meth:`_wait_for_migration`
+        :raise: TestFail if QEMU refuses to start the migration
+        """
+        stats = migration.MigrationStats(uri)
+        # Asked to the running QEMU, probing the binary would start another
+        resp = self.qmp('query-migrate-capabilities', verbose=False)
+        if (resp is not None and 'return' in resp and
+                'events' in [cap['capability'] for cap in resp['return']]):
+            resp = self.qmp('migrate-set-capabilities',
+                            capabilities=[{'capability': 'events',
+                                           'state': True}])
+            stats.events = resp is not None and 'return' in resp
+        if stats.events:
+            stats.subscription = self._qmp.subscribe(stats.record_pass,
+                                                     'MIGRATION_PASS')
+        stats.start()
+        try:
+            self._check_migration_reply('migrate',
+                                        self.qmp('migrate', uri=uri))
+        except exceptions.TestFail:
+            if stats.subscription is not None:
+                self._qmp.unsubscribe(stats.subscription)
+                stats.subscription = None
+            raise
+        return stats
+
+    def _wait_for_migration(self, stats, timeout=None):
+        """
+        Wait for the outgoing migration to complete.
+
+        With migration events, 'query-migrate' is only sent when the
+        MIGRATION event reporting the end arrives, or every few seconds in
+        case it was missed.  Without them, the status is polled.
+
+        :param timeout: seconds, the 'timeout' param of
+                        /plugins/virt/qemu/migrate by default
+        :raise: TestFail if the migration fails or times out
+        """
+        migrate_timeout = timeout
+        if migrate_timeout is None:
+            migrate_timeout = float(self.params.get(
+                'timeout', '/plugins/virt/qemu/migrate/*'))
+        deadline = time.time() + migrate_timeout
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise exceptions.TestFail("Migration of %s did not "
+                                              "complete after %s s" %
+                                              (self, migrate_timeout))
+                if stats.events:
+                    self._qmp.wait_for_event(
+                        'MIGRATION', match=migration.is_final,
+                        timeout=min(remaining, migration.EVENT_CHECK_INTERVAL))
+                else:
+                    time.sleep(min(remaining, migration.POLL_INTERVAL))
+                stats.update(self._check_migration_reply(
+                    'query-migrate', self.qmp('query-migrate',
+                                              verbose=False)))
+                if stats.status in migration.FINAL_STATUSES:
+                    break
+        finally:
+            if stats.subscription is not None:
+                self._qmp.unsubscribe(stats.subscription)
+                stats.subscription = None
+        self.log("<- QMP query-migrate %s", stats.info)
+        if stats.status != 'completed':
+            if 'error-desc' in stats.info:
+                raise exceptions.TestFail("Migration of %s %s: %s"
+                                          % (self, stats.status,
+                                             stats.info['error-desc']))
+            raise exceptions.TestFail("Migration of %s %s"
+                                      % (self, stats.status))
+        self.log("Migration successful")
+        return stats
+
+    def _write_migration_stats(self, stats):
+        """
+        Write the statistics of a migration of this VM to the logdir.
+        """
+        if self.logdir is None:
+            return
+        stats_file = os.path.join(self.logdir, 'migration-%s-%s.json' %
+                                  (self.short_id, self.pid))
+        with open(stats_file, 'w') as stats_fd:
+            json.dump(stats, stats_fd, sort_keys=True)
+
+    def _migration_qmp(self, cmd, **args):
+        resp = self.qmp(cmd, **args)
+        if resp is None or 'error' in resp:
+            raise migration.MigrationConfigError('%s: %s failed: %s' %
+                                                 (self, cmd, resp))
+        return resp['return']
+
+    def set_migration_config(self, config):
+        """
+        Set migration capabilities and parameters on this QEMU process.
+
+        The capabilities are checked against the ones the running process
+        reports, so VMs started from another binary than the default one
+        are checked against their own.
 
+        :param config: :class:`avocado_virt.qemu.migration.MigrationConfig`
+        :raise: MigrationConfigError if QEMU does not support them
+        """
+        caps = config.capabilities()
+        supported = set(cap['capability'] for cap in
+                        self._migration_qmp('query-migrate-capabilities'))
+        unsupported = [name for name, state in caps.items()
+                       if state and name not in supported]
+        if unsupported:
+            raise migration.MigrationConfigError(
+                '%s does not support the migration capabilities %s' %
+                (self, ', '.join(sorted(unsupported))))
+        # Capabilities turned off need not exist in this QEMU
+        caps = dict((name, state) for name, state in caps.items()
+                    if name in supported)
+        if caps:
+            self._migration_qmp('migrate-set-capabilities',
+                                capabilities=[{'capability': name,
+                                               'state': state}
+                                              for name, state in
+                                              sorted(caps.items())])
+        params = config.parameters()
+        if params:
+            self._migration_qmp('migrate-set-parameters', **params)
+
+    def _start_incoming(self, config):
+        """
+        Set the migration configuration of a VM waiting for an incoming
+        migration with ``-incoming defer``, then let the migration in.
+        """
+        if config is None:
+            return
+        self.set_migration_config(config)
+        incoming = self.devices.get_devices('incoming')[0]
+        self._migration_qmp('migrate-incoming', uri=incoming.uri)
+
+    def migrate(self, protocol='tcp', config=None, qemu_bin=None,
+                timeout=None):
+        """
+        Live migrate the VM to a new QEMU process on the same host.
+
+        :param protocol: migration transport: 'tcp' (loopback), 'unix'
+                         (unix socket), 'fd' (socket pair passed to both
+                         QEMU processes), 'exec' (named pipe, written and
+                         read by shell commands) or 'file' (the state is
+                         saved to a file, then loaded by the new QEMU
+                         process, so the migration is not live)
+        :param config: :class:`avocado_virt.qemu.migration.MigrationConfig`
+                       with the capabilities and parameters to set on both
+                       QEMU processes
+        :param qemu_bin: QEMU binary to migrate to, the one of this VM by
+                         default
+        :param timeout: seconds, the 'timeout' param of
+                        /plugins/virt/qemu/migrate by default (see
+                        :meth:`predict_migration` to pick one)
+        """
         clone_params = copy.copy(self.params)
         clone = self.clone(params=clone_params, preserve_uuid=True)
-        migration_port = clone.devices.add_incoming(protocol)
+        if qemu_bin is not None:
+            clone.devices.set_qemu_binary(qemu_bin)
         self._screendump_thread_terminate(migrate=True)
-        clone.power_on()
-        uri = "%s:localhost:%d" % (protocol, migration_port)
-        self.qmp("migrate", uri=uri)
-        migrate_timeout = self.params.get('timeout',
-                                          '/plugins/virt/qemu/migrate/*')
-        migrate_result = wait.wait_for(migrate_complete, timeout=float(migrate_timeout),
-                                       text='Waiting for migration to complete')
-        if migrate_result is None:
-            raise exceptions.TestFail("Migration of %s did not complete after %s s" %
-                                      (self, migrate_timeout))
+        if config is not None:
+            self.set_migration_config(config)
+        defer = config is not None
+        tmp_path = None
+        try:
+            if protocol == 'file':
+                tmp_path = tempfile.mktemp(prefix='migrate-',
+                                           dir=data_dir.get_tmp_dir())
+                stats = self._wait_for_migration(
+                    self._start_migration('exec:cat > %s' % tmp_path),
+                    timeout)
+                clone.devices.add_incoming('exec',
+                                           command='cat %s' % tmp_path,
+                                           defer=defer)
+                clone.power_on()
+                clone._start_incoming(config)
+                # The file must be read before it is removed
+                if not clone._resume_migrated_state():
+                    raise exceptions.TestFail('%s could not load the state '
+                                              'of %s' % (clone, self))
+            else:
+                if protocol == 'exec':
+                    tmp_path = tempfile.mktemp(prefix='migrate-',
+                                               dir=data_dir.get_tmp_dir())
+                    os.mkfifo(tmp_path)
+                    clone.devices.add_incoming('exec',
+                                               command='cat %s' % tmp_path,
+                                               defer=defer)
+                    uri = 'exec:cat > %s' % tmp_path
+                elif protocol == 'unix':
+                    tmp_path = clone.devices.add_incoming('unix', defer=defer)
+                    uri = 'unix:%s' % tmp_path
+                elif protocol == 'fd':
+                    src_sock = clone.devices.add_incoming('fd', defer=defer)
+                    uri = 'fd:migrate'
+                else:
+                    migration_port = clone.devices.add_incoming(protocol,
+                                                                defer=defer)
+                    uri = "%s:localhost:%d" % (protocol, migration_port)
+                clone.power_on()
+                clone._start_incoming(config)
+                if protocol == 'fd':
+                    resp = self._qmp.send_fd(src_sock.fileno(), 'migrate')
+                    src_sock.close()
+                    if resp is None or 'error' in resp:
+                        raise exceptions.TestError('Could not pass the '
+                                                   'migration socket to %s: '
+                                                   '%s' % (self, resp))
+                stats = self._start_migration(uri)
+                if config is not None and config.postcopy:
+                    # QEMU switches to postcopy at the end of the current
+                    # pass over the guest RAM
+                    self.qmp('migrate-start-postcopy')
+                self._wait_for_migration(stats, timeout)
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        stats_dict = stats.to_dict()
+        if config is not None:
+            stats_dict['config'] = config.name
+        self.log('Migration stats: %s', stats_dict)
+        self._write_migration_stats(stats_dict)
+        clone.migration_stats = self.migration_stats + [stats_dict]
 
         old_vm = VM()
         old_vm.__dict__ = self.__dict__
         self.__dict__ = clone.__dict__
         old_vm.power_off(migrate=True)
+        old_vm.devices.release_ports()
+
+    def calc_dirty_rate(self, calc_time=1):
+        """
+        Measure how fast the guest dirties its RAM.
+
+        :param calc_time: seconds to measure for
+        :return: return value of 'query-dirty-rate', with the rate in MiB
+                 per second as 'dirty-rate'
+        :raise: TestFail if QEMU cannot measure it
+        """
+        resp = self.qmp('calc-dirty-rate', calc_time=calc_time)
+        if resp is None or 'error' in resp:
+            raise exceptions.TestFail('%s could not measure the dirty '
+                                      'rate: %s' % (self, resp))
+        # There is no event telling the measurement is over
+        time.sleep(calc_time)
+        deadline = time.time() + calc_time + 10
+        while True:
+            resp = self.qmp('query-dirty-rate', verbose=False)
+            if resp is None or 'error' in resp:
+                raise exceptions.TestFail('%s could not tell its dirty '
+                                          'rate: %s' % (self, resp))
+            info = resp['return']
+            if info.get('status') == 'measured' and 'dirty-rate' in info:
+                self.log('Dirty rate: %s MiB/s' % info.get('dirty-rate'))
+                return info
+            if time.time() > deadline:
+                raise exceptions.TestFail('%s did not measure the dirty '
+                                          'rate: %s' % (self, info))
+            time.sleep(0.1)
+
+    def predict_migration(self, bandwidth, downtime_limit=300, calc_time=1):
+        """
+        Estimate how long migrating this VM takes right now.
+
+        :param bandwidth: bytes sent per second, such as the
+                          'max-bandwidth' migration parameter
+        :param downtime_limit: maximum downtime, in milliseconds
+        :param calc_time: seconds to measure the dirty rate for
+        :rtype: :class:`avocado_virt.qemu.migration.MigrationPrediction`,
+                whose ``timeout()`` can be given to :meth:`migrate`
+        :raise: TestFail if QEMU cannot tell its RAM size or dirty rate
+        """
+        resp = self.qmp('query-memory-size-summary')
+        if (resp is None or 'error' in resp or
+                'base-memory' not in resp.get('return', {})):
+            raise exceptions.TestFail('%s could not tell its RAM size: %s'
+                                      % (self, resp))
+        ram_size = resp['return']['base-memory']
+        dirty_rate = self.calc_dirty_rate(calc_time)['dirty-rate'] << 20
+        prediction = migration.predict_migration(ram_size, dirty_rate,
+                                                 bandwidth, downtime_limit)
+        self.log('Migration prediction: %s' % prediction)
+        return prediction
+
+    def migrate_ping_pong(self, count, protocol='tcp', config=None,
+                          alternate_binaries=False):
+        """
+        Migrate the VM back and forth, as a stress test.
+
+        The ports of each QEMU process are released once it migrated away,
+        and reused by the next ones.
+
+        :param count: number of migrations
+        :param protocol: migration transport, see :meth:`migrate`
+        :param config: :class:`avocado_virt.qemu.migration.MigrationConfig`
+        :param alternate_binaries: migrate to the QEMU binary set with the
+                                   ``qemu_dst_bin`` param and back, every
+                                   other time
+        :return: dict with the number of migrations, their stats and the
+                 distribution ('min', 'max', 'mean', 'p50', 'p90' and
+                 'p99') of their total time, downtime, wall time and
+                 transferred RAM.  It is also written to
+                 ``migration-ping-pong-<vm id>.json`` in the logdir.
+        """
+        binaries = [None, None]
+        if alternate_binaries:
+            binaries = [self.devices.qemu_bin,
+                        path.get_qemu_dst_binary(self.params)]
+        first = len(self.migration_stats)
+        for iteration in xrange(count):
+            self.migrate(protocol, config=config,
+                         qemu_bin=binaries[(iteration + 1) % 2])
+        series = self.migration_stats[first:]
+        summary = {'count': len(series), 'migrations': series}
+        for key in ('total_time_ms', 'downtime_ms', 'wall_time',
+                    'ram_transferred'):
+            summary[key] = utils_stats.summarize(
+                [mig[key] for mig in series if mig[key] is not None])
+        self.log('Ping-pong migration: total time %s, downtime %s' %
+                 (summary['total_time_ms'], summary['downtime_ms']))
+        if self.logdir is not None:
+            summary_file = os.path.join(self.logdir,
+                                        'migration-ping-pong-%s.json' %
+                                        self.short_id)
+            with open(summary_file, 'w') as summary_fd:
+                json.dump(summary, summary_fd, sort_keys=True)
+        return summary
 
     def screendump(self, filename, verbose=True):
         """
@@ -297,21 +924,59 @@ class VM(object):
             self.screendump_dir = utils_path.init_dir(
                 os.path.join(self.logdir, 'screendumps', self.short_id))
             self._screendump_terminate = threading.Event()
+            if self._hub is not None:
+                self._screendump_index = self._screendump_first_index()
+                self._hub.call_later(0, self._take_hub_screendump)
+                return
             self._screendump_thread = threading.Thread(target=self._take_screendumps,
                                                        name='VmScreendumps')
             self._screendump_thread.start()
 
+    def _screendump_first_index(self):
+        dump_list = sorted(os.listdir(self.screendump_dir))
+        if dump_list:
+            last_dump = dump_list[-1].split('.')[0]
+            return int(last_dump.split('-')[-1]) + 1
+        return 1
+
+    def _take_hub_screendump(self):
+        """
+        Take a screendump from the hub thread, without blocking it.
+
+        The next screendump is scheduled once QEMU replied to this one.
+        """
+        if self._screendump_terminate.isSet():
+            self._screendump_terminate.clear()
+            return
+        ppm_filename = os.path.join(self.screendump_dir,
+                                    '%04d.ppm' % self._screendump_index)
+        reply = self.qmp_async('screendump', verbose=False,
+                               filename=ppm_filename)
+        reply.add_done_callback(
+            lambda r: self._hub_screendump_taken(ppm_filename, r))
+
+    def _hub_screendump_taken(self, ppm_filename, reply):
+        try:
+            if reply.result() is None:
+                self.log("Screendump timer terminated: monitor closed")
+                return
+        except socket.error, details:
+            self.log("Screendump timer terminated: %s" % details)
+            return
+        if os.path.isfile(ppm_filename):
+            if image.is_ppm(ppm_filename):
+                self._screendump_index += 1
+            else:
+                self.log("Produced screendump %s is invalid" % ppm_filename)
+        interval = self.params.get('interval', '/plugins/virt/screendumps/*')
+        self._hub.call_later(interval, self._take_hub_screendump)
+
     def _take_screendumps(self):
         """
         Take screendumps on regular intervals.
         """
         timeout = self.params.get('interval', '/plugins/virt/screendumps/*')
-        dump_list = sorted(os.listdir(self.screendump_dir))
-        if dump_list:
-            last_dump = dump_list[-1].split('.')[0]
-            s_index = int(last_dump.split('-')[-1]) + 1
-        else:
-            s_index = 1
+        s_index = self._screendump_first_index()
 
         while True:
             s_ppm_basename = '%04d.ppm' % s_index
@@ -336,7 +1001,9 @@ class VM(object):
                 self._screendump_terminate.wait(timeout=timeout)
 
     def _encode_video(self):
-        if VIDEO_ENCODING_SUPPORT:
+        if video_support.is_supported():
+            # GStreamer is only imported when a video is encoded
+            from ..utils import video
             encoder = video.Encoder(params=self.params, verbose=True)
             video_file = os.path.join(self.logdir, '%s.webm' % self.short_id)
             try:
@@ -0,0 +1,417 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Live migration statistics.
+
+QEMU sends a MIGRATION event on every status change and a MIGRATION_PASS
+event at the start of every pass over the guest RAM once the 'events'
+migration capability is on.  :class:`MigrationStats` keeps track of them
+and of the final ``query-migrate`` reply, so migration throughput can be
+compared from one run to the other.
+
+:class:`MigrationConfig` holds the migration capabilities and parameters
+to set on both QEMU processes, and :func:`run_matrix` migrates a VM once
+per configuration to compare them.
+
+:func:`predict_migration` estimates how long a migration takes from the
+guest RAM size, the rate the guest dirties it at (see
+:meth:`avocado_virt.qemu.machine.VM.calc_dirty_rate`) and the bandwidth.
+"""
+
+import os
+import copy
+import json
+import time
+import logging
+
+log = logging.getLogger("avocado.test")
+
+#: Statuses a migration does not leave
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+#: Seconds between 'query-migrate' calls when QEMU has no migration events
+POLL_INTERVAL = 0.5
+
+#: Seconds between 'query-migrate' calls while waiting for the MIGRATION
+#: event, in case it was dropped
+EVENT_CHECK_INTERVAL = 5.0
+
+#: Capabilities set through the :class:`MigrationConfig` arguments
+CAPABILITIES = ('xbzrle', 'multifd', 'compress', 'auto-converge',
+                'postcopy-ram')
+
+
+def is_final(event):
+    """
+    Whether a MIGRATION event reports the end of the migration.
+    """
+    return event.get('data', {}).get('status') in FINAL_STATUSES
+
+
+def _event_time(event):
+    timestamp = event.get('timestamp')
+    if not timestamp:
+        return time.time()
+    return timestamp['seconds'] + timestamp['microseconds'] / 1000000.0
+
+
+class MigrationStats(object):
+
+    """
+    Statistics of one outgoing migration.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        #: Whether the migration is followed through events, rather than
+        #: by polling
+        self.events = False
+        self.status = None
+        self.started = None
+        self.finished = None
+        #: Times of the MIGRATION_PASS events
+        self.pass_times = []
+        #: Last 'query-migrate' reply
+        self.info = {}
+        self.subscription = None
+
+    def __repr__(self):
+        return '%s(uri=%r, status=%r, passes=%s)' % (
+            self.__class__.__name__, self.uri, self.status, self.passes)
+
+    def start(self):
+        self.started = time.time()
+
+    def record_pass(self, event):
+        """
+        Callback for MIGRATION_PASS events.
+        """
+        self.pass_times.append(_event_time(event))
+
+    def update(self, info):
+        """
+        :param info: return value of 'query-migrate'
+        """
+        self.info = info
+        self.status = info.get('status')
+        if self.status in FINAL_STATUSES and self.finished is None:
+            self.finished = time.time()
+
+    @property
+    def passes(self):
+        """
+        Number of passes over the guest RAM.
+
+        QEMUs without migration events still count the dirty bitmap syncs,
+        one per pass.
+        """
+        if self.pass_times:
+            return len(self.pass_times)
+        return self.info.get('ram', {}).get('dirty-sync-count')
+
+    def to_dict(self):
+        ram = self.info.get('ram', {})
+        wall_time = None
+        if self.started is not None and self.finished is not None:
+            wall_time = self.finished - self.started
+        return {'uri': self.uri,
+                'status': self.status,
+                'events': self.events,
+                'wall_time': wall_time,
+                'total_time_ms': self.info.get('total-time'),
+                'downtime_ms': self.info.get('downtime'),
+                'expected_downtime_ms': self.info.get('expected-downtime'),
+                'setup_time_ms': self.info.get('setup-time'),
+                'ram_total': ram.get('total'),
+                'ram_transferred': ram.get('transferred'),
+                'ram_remaining': ram.get('remaining'),
+                'ram_duplicate_pages': ram.get('duplicate'),
+                'ram_normal_pages': ram.get('normal'),
+                'dirty_pages_rate': ram.get('dirty-pages-rate'),
+                'mbps': ram.get('mbps'),
+                'passes': self.passes,
+                'pass_times': [t - self.started for t in self.pass_times]
+                if self.started is not None else []}
+
+
+class MigrationConfigError(Exception):
+    pass
+
+
+def _check_int(name, value, minimum=0):
+    if value is None:
+        return
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise MigrationConfigError('%s must be an integer, not %r' %
+                                   (name, value))
+    if value < minimum:
+        raise MigrationConfigError('%s must be at least %d, not %d' %
+                                   (name, minimum, value))
+
+
+class MigrationConfig(object):
+
+    """
+    Migration capabilities and parameters.
+
+    The capabilities have to be set on both the source and the destination
+    QEMU processes, see :meth:`avocado_virt.qemu.machine.VM.migrate`.
+    """
+
+    def __init__(self, name=None, xbzrle=False, xbzrle_cache_size=None,
+                 multifd_channels=None, compress_threads=None,
+                 compress_level=None, auto_converge=False, postcopy=False,
+                 max_bandwidth=None, downtime_limit=None, capabilities=None,
+                 parameters=None):
+        """
+        :param name: name of the configuration in reports, generated from
+                     the settings when not given
+        :param xbzrle: send the differences of pages sent already
+        :param xbzrle_cache_size: size of the xbzrle cache, in bytes
+        :param multifd_channels: migrate over this many channels (multifd)
+        :param compress_threads: compress pages with this many threads
+        :param compress_level: zlib compression level, from 0 to 9
+        :param auto_converge: throttle the guest CPUs when the migration
+                              does not converge
+        :param postcopy: switch to postcopy once the migration started
+        :param max_bandwidth: maximum bandwidth, in bytes per second
+        :param downtime_limit: maximum downtime, in milliseconds
+        :param capabilities: other capabilities, as a dict of QMP names to
+                             booleans
+        :param parameters: other parameters, as a dict of QMP names to
+                           values
+        """
+        _check_int('xbzrle_cache_size', xbzrle_cache_size)
+        _check_int('multifd_channels', multifd_channels, 1)
+        _check_int('compress_threads', compress_threads, 1)
+        _check_int('compress_level', compress_level)
+        _check_int('max_bandwidth', max_bandwidth, 1)
+        _check_int('downtime_limit', downtime_limit)
+        if compress_level is not None and compress_level > 9:
+            raise MigrationConfigError('compress_level must be at most 9, '
+                                       'not %d' % compress_level)
+        self.xbzrle = xbzrle
+        self.xbzrle_cache_size = xbzrle_cache_size
+        self.multifd_channels = multifd_channels
+        self.compress_threads = compress_threads
+        self.compress_level = compress_level
+        self.auto_converge = auto_converge
+        self.postcopy = postcopy
+        self.max_bandwidth = max_bandwidth
+        self.downtime_limit = downtime_limit
+        self.extra_capabilities = dict(capabilities or {})
+        self.extra_parameters = dict(parameters or {})
+        self.name = name or self._default_name()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+    def _default_name(self):
+        parts = sorted(name for name, state in self.capabilities().items()
+                       if state)
+        parts += ['%s=%s' % item for item in sorted(self.parameters().items())]
+        return ','.join(parts) or 'default'
+
+    def capabilities(self):
+        """
+        :return: dict of QMP capability names to booleans, with all the
+                 :data:`CAPABILITIES`, False when they are not enabled, so
+                 that a QEMU process configured before gets them off
+        """
+        caps = dict((name, False) for name in CAPABILITIES)
+        if self.xbzrle:
+            caps['xbzrle'] = True
+        if self.multifd_channels is not None:
+            caps['multifd'] = True
+        if (self.compress_threads is not None or
+                self.compress_level is not None):
+            caps['compress'] = True
+        if self.auto_converge:
+            caps['auto-converge'] = True
+        if self.postcopy:
+            caps['postcopy-ram'] = True
+        caps.update(self.extra_capabilities)
+        return caps
+
+    def parameters(self):
+        """
+        :return: dict of QMP parameter names to values
+        """
+        params = {}
+        for qmp_name, value in (('xbzrle-cache-size', self.xbzrle_cache_size),
+                                ('multifd-channels', self.multifd_channels),
+                                ('compress-threads', self.compress_threads),
+                                ('compress-level', self.compress_level),
+                                ('max-bandwidth', self.max_bandwidth),
+                                ('downtime-limit', self.downtime_limit)):
+            if value is not None:
+                params[qmp_name] = value
+        params.update(self.extra_parameters)
+        return params
+
+    def with_defaults(self, capabilities, parameters):
+        """
+        Copy of the configuration that also sets the capabilities and
+        parameters it leaves out, such as back to the values of a QEMU
+        process that was never configured.
+
+        :param capabilities: dict of QMP capability names to booleans
+        :param parameters: dict of QMP parameter names to values
+        :rtype: :class:`MigrationConfig`
+        """
+        config = copy.copy(self)
+        config.extra_capabilities = dict(capabilities)
+        config.extra_capabilities.update(self.capabilities())
+        config.extra_parameters = dict(parameters)
+        config.extra_parameters.update(self.parameters())
+        return config
+
+
+def _query_defaults(vm, configs):
+    """
+    Current values of the capabilities and parameters some of the
+    configurations set.
+    """
+    cap_names = set()
+    param_names = set()
+    for config in configs:
+        cap_names.update(config.capabilities())
+        param_names.update(config.parameters())
+    caps = {}
+    resp = vm.qmp('query-migrate-capabilities')
+    if resp is not None and 'return' in resp:
+        caps = dict((cap['capability'], cap['state'])
+                    for cap in resp['return']
+                    if cap['capability'] in cap_names)
+    params = {}
+    resp = vm.qmp('query-migrate-parameters')
+    if resp is not None and 'return' in resp:
+        params = dict((name, value) for name, value in resp['return'].items()
+                      if name in param_names)
+    return caps, params
+
+
+def run_matrix(vm, configs, protocol='tcp', prepare_func=None):
+    """
+    Migrate a VM once per configuration and compare the results.
+
+    The same VM, and so the same guest with the same load, is migrated
+    each time, from its current QEMU process to a new one.  The source
+    process was configured by the previous migration, so the capabilities
+    and parameters a configuration leaves out are set back to the values
+    they had before the first one.
+
+    :param vm: powered on :class:`avocado_virt.qemu.machine.VM`
+    :param configs: list of :class:`MigrationConfig`
+    :param protocol: migration transport, see
+                     :meth:`avocado_virt.qemu.machine.VM.migrate`
+    :param prepare_func: callable receiving the VM, called before each
+                         migration, such as to restart a load in the guest
+    :return: list of (config name, stats dict) tuples, also written to
+             ``migration-matrix-<vm id>.json`` in the logdir of the VM
+    """
+    results = []
+    default_caps, default_params = _query_defaults(vm, configs)
+    for config in configs:
+        if prepare_func is not None:
+            prepare_func(vm)
+        vm.migrate(protocol, config=config.with_defaults(default_caps,
+                                                         default_params))
+        stats = vm.migration_stats[-1]
+        results.append((config.name, stats))
+        log.info('Migration matrix: %-40s time %s ms, downtime %s ms, '
+                 '%s bytes', config.name, stats['total_time_ms'],
+                 stats['downtime_ms'], stats['ram_transferred'])
+    if vm.logdir is not None:
+        matrix_file = os.path.join(vm.logdir, 'migration-matrix-%s.json' %
+                                   vm.short_id)
+        with open(matrix_file, 'w') as matrix_fd:
+            json.dump([{'config': name, 'stats': config_stats}
+                       for name, config_stats in results], matrix_fd,
+                      sort_keys=True)
+    return results
+
+
+class MigrationPrediction(object):
+
+    """
+    Estimate of a pre-copy migration, see :func:`predict_migration`.
+    """
+
+    def __init__(self, converges, total_time, passes, bytes_sent):
+        #: Whether the remaining RAM gets small enough for the downtime
+        #: limit, without auto-converge or postcopy
+        self.converges = converges
+        #: Seconds, None if the migration does not converge
+        self.total_time = total_time
+        self.passes = passes
+        self.bytes_sent = bytes_sent
+
+    def __repr__(self):
+        return ('%s(converges=%s, total_time=%s, passes=%s)' %
+                (self.__class__.__name__, self.converges, self.total_time,
+                 self.passes))
+
+    def timeout(self, margin=3.0, minimum=30.0):
+        """
+        Migration timeout leaving room for the estimate to be wrong.
+
+        :param margin: factor applied to the estimated time
+        :param minimum: seconds, the least timeout returned
+        :return: seconds, or None if the migration does not converge
+        """
+        if not self.converges:
+            return None
+        return max(minimum, self.total_time * margin)
+
+    def to_dict(self):
+        return {'converges': self.converges,
+                'total_time': self.total_time,
+                'passes': self.passes,
+                'bytes_sent': self.bytes_sent}
+
+
+def predict_migration(ram_size, dirty_rate, bandwidth, downtime_limit=300,
+                      max_passes=100):
+    """
+    Estimate a pre-copy migration.
+
+    Every pass sends the RAM dirtied during the previous one (the whole RAM
+    for the first one), until what is left can be sent within the
+    downtime limit, with the guest stopped.
+
+    :param ram_size: guest RAM, in bytes
+    :param dirty_rate: bytes the guest dirties per second
+    :param bandwidth: bytes sent per second
+    :param downtime_limit: maximum downtime, in milliseconds (the
+                           'downtime-limit' migration parameter)
+    :param max_passes: passes after which the migration is considered not
+                       to converge
+    :rtype: :class:`MigrationPrediction`
+    """
+    if bandwidth <= 0:
+        raise ValueError('bandwidth must be positive, not %r' % bandwidth)
+    downtime_bytes = bandwidth * downtime_limit / 1000.0
+    remaining = float(ram_size)
+    total_time = 0.0
+    bytes_sent = 0.0
+    for passes in xrange(1, max_passes + 1):
+        pass_time = remaining / bandwidth
+        total_time += pass_time
+        bytes_sent += remaining
+        if remaining <= downtime_bytes:
+            return MigrationPrediction(True, total_time, passes,
+                                       int(bytes_sent))
+        remaining = min(float(ram_size), dirty_rate * pass_time)
+    return MigrationPrediction(False, None, max_passes, int(bytes_sent))
@@ -20,7 +20,27 @@ QEMU Monitor Protocol Python class
 
 import json
 import errno
+import heapq
+import time
+import logging
+import ctypes
+import struct
+import select
 import socket
+import itertools
+import threading
+import collections
+import ctypes.util
+
+from ..utils import stats
+
+try:
+    _memoryview = memoryview
+except NameError:
+    # Python 2.6
+    _memoryview = None
+
+log = logging.getLogger("avocado.test")
 
 
 class QMPError(Exception):
@@ -35,9 +55,377 @@ class QMPCapabilitiesError(QMPError):
     pass
 
 
+class QMPTimeoutError(QMPError, socket.timeout):
+    pass
+
+
+#: Default maximum number of QMP events kept pending by a monitor
+DEFAULT_EVENT_CAPACITY = 1024
+
+_SCM_RIGHTS = 1
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_char_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_char_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+_libc = None
+
+
+def _run_callback(callback, *args):
+    # Callbacks run in the monitor reader context, an error in one of them
+    # must not stop the reader
+    try:
+        callback(*args)
+    except Exception, details:
+        log.error('QMP: callback %s failed: %s', callback, details)
+
+
+def send_fd(sock, data, fd):
+    """
+    Send data over a unix socket, with a file descriptor attached to it
+    (SCM_RIGHTS), the way QMP expects it for commands such as 'getfd'.
+
+    :param sock: connected AF_UNIX socket
+    :param data: data to send, at least one byte
+    :param fd: file descriptor to pass
+    """
+    if hasattr(sock, 'sendmsg'):
+        sent = sock.sendmsg([data], [(socket.SOL_SOCKET, _SCM_RIGHTS,
+                                      struct.pack('i', fd))])
+    else:
+        global _libc
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        # struct cmsghdr is followed by the fd, padded to a multiple of
+        # the size of size_t (long on Linux)
+        header_size = struct.calcsize('@Lii')
+        cmsg_len = header_size + struct.calcsize('i')
+        space = -(-cmsg_len // struct.calcsize('L')) * struct.calcsize('L')
+        control = struct.pack('@Lii', cmsg_len, socket.SOL_SOCKET,
+                              _SCM_RIGHTS) + struct.pack('i', fd)
+        control += '\0' * (space - len(control))
+        iov = _IOVec(data, len(data))
+        msg = _MsgHdr(None, 0, ctypes.pointer(iov), 1, control, space, 0)
+        sent = _libc.sendmsg(sock.fileno(), ctypes.byref(msg), 0)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def parse_event_type_caps(text):
+    """
+    Parse per event type caps written as ``NAME:CAP[,NAME:CAP...]``.
+
+    :param text: string such as 'RTC_CHANGE:16,BLOCK_IO_ERROR:64'
+    :return: dict mapping event names to caps
+    :raise: ValueError if the string is malformed
+    """
+    type_caps = {}
+    if not text:
+        return type_caps
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, cap = item.split(':', 1)
+        type_caps[name.strip()] = int(cap)
+    return type_caps
+
+
+class QMPEventStore(object):
+
+    """
+    Bounded store of pending QMP events.
+
+    Events are kept in one deque per event type, tagged with a sequence
+    number so the arrival order across types is preserved.  When the total
+    ``capacity`` or the cap of a given type is exceeded, the oldest event
+    (of all, or of that type) is dropped and accounted for in
+    :attr:`dropped` and :attr:`dropped_by_type`, so memory stays flat no
+    matter how chatty the guest is.  Removing events from the head or by
+    type costs O(number of event types), not O(number of events).
+    """
+
+    def __init__(self, capacity=DEFAULT_EVENT_CAPACITY, type_caps=None):
+        """
+        :param capacity: maximum number of events kept (None for no limit)
+        :param type_caps: dict mapping event names to the maximum number of
+                          events of that type kept
+        """
+        self.capacity = capacity
+        self.type_caps = dict(type_caps or {})
+        self.dropped = 0
+        self.dropped_by_type = {}
+        self._seq = itertools.count()
+        self._by_type = {}
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for _, event in heapq.merge(*self._by_type.values()):
+            yield event
+
+    def _drop_oldest(self, name):
+        self._by_type[name].popleft()
+        self._len -= 1
+        self.dropped += 1
+        self.dropped_by_type[name] = self.dropped_by_type.get(name, 0) + 1
+
+    def _oldest_type(self):
+        oldest = None
+        for name, events in self._by_type.items():
+            if events and (oldest is None or events[0][0] < oldest[0]):
+                oldest = (events[0][0], name)
+        if oldest is None:
+            return None
+        return oldest[1]
+
+    def append(self, event):
+        name = event.get('event')
+        events = self._by_type.get(name)
+        if events is None:
+            events = self._by_type[name] = collections.deque()
+        events.append((next(self._seq), event))
+        self._len += 1
+        type_cap = self.type_caps.get(name)
+        if type_cap is not None and len(events) > type_cap:
+            self._drop_oldest(name)
+        if self.capacity is not None and self._len > self.capacity:
+            self._drop_oldest(self._oldest_type())
+
+    def popleft(self):
+        """
+        Remove and return the oldest event, or None if there is none.
+        """
+        name = self._oldest_type()
+        if name is None:
+            return None
+        self._len -= 1
+        return self._by_type[name].popleft()[1]
+
+    def pop_match(self, event_filter):
+        """
+        Remove and return the oldest event accepted by a filter.
+
+        :param event_filter: object with a ``name`` attribute (None for any
+                             type) and a ``matches(event)`` method, such as
+                             :class:`QMPEventFilter`
+        :return: the event, or None if no pending event matches
+        """
+        if event_filter.name is not None:
+            candidates = self._by_type.get(event_filter.name, ())
+        else:
+            candidates = heapq.merge(*self._by_type.values())
+        for item in candidates:
+            if event_filter.matches(item[1]):
+                self._by_type[item[1].get('event')].remove(item)
+                self._len -= 1
+                return item[1]
+        return None
+
+    def drain(self):
+        """
+        Remove and return all events, oldest first.
+        """
+        events = list(self)
+        self.clear()
+        return events
+
+    def clear(self):
+        self._by_type = {}
+        self._len = 0
+
+
+class QMPStreamReader(object):
+
+    """
+    Incremental reader of the QMP message stream.
+
+    Data is received straight into a reusable ``bytearray`` with
+    ``recv_into``.  Complete messages are located in place by looking for
+    the line terminators QEMU writes after each of them, and all the
+    messages that arrived in one chunk are decoded from a single string
+    with :meth:`json.JSONDecoder.raw_decode`, instead of copying every line
+    through a file object first.  The buffer only grows when a single
+    message does not fit in it.
+    """
+
+    _decoder = json.JSONDecoder()
+    _whitespace = json.decoder.WHITESPACE
+
+    def __init__(self, sock, bufsize=65536):
+        """
+        :param sock: connected socket
+        :param bufsize: initial size of the receive buffer, in bytes
+        """
+        self.sock = sock
+        self._buf = bytearray(bufsize)
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+        self._messages = collections.deque()
+
+    def _compact(self):
+        if self._start == 0:
+            return
+        pending = self._end - self._start
+        self._buf[0:pending] = self._buf[self._start:self._end]
+        self._scan -= self._start
+        self._start = 0
+        self._end = pending
+
+    def fill(self):
+        """
+        Receive whatever data is available (blocking according to the socket
+        mode) and decode the messages it completes.
+
+        :return: number of bytes received, 0 at the end of the stream
+        :raise: socket.error on socket errors, including EAGAIN in
+                non-blocking mode
+        """
+        if self._end == len(self._buf):
+            self._compact()
+            if self._end == len(self._buf):
+                self._buf.extend(bytearray(len(self._buf)))
+        if _memoryview is not None:
+            nbytes = self.sock.recv_into(_memoryview(self._buf)[self._end:])
+        else:
+            data = self.sock.recv(len(self._buf) - self._end)
+            nbytes = len(data)
+            self._buf[self._end:self._end + nbytes] = data
+        self._end += nbytes
+        self._decode()
+        return nbytes
+
+    def _decode(self):
+        last = self._buf.rfind('\n', self._scan, self._end)
+        if last < 0:
+            self._scan = self._end
+            return
+        # One copy for every message completed by the last chunk
+        chunk = str(buffer(self._buf, self._start, last + 1 - self._start))
+        self._start = self._scan = last + 1
+        if self._start > len(self._buf) // 2:
+            self._compact()
+        idx = self._whitespace.match(chunk, 0).end()
+        while idx < len(chunk):
+            msg, end = self._decoder.raw_decode(chunk, idx)
+            self._messages.append((msg, end - idx))
+            idx = self._whitespace.match(chunk, end).end()
+
+    def get_messages(self):
+        """
+        Remove and return the messages decoded so far, without receiving.
+
+        :return: list of (message, size in bytes) tuples
+        """
+        messages = list(self._messages)
+        self._messages.clear()
+        return messages
+
+    def read_message(self):
+        """
+        Return the next QMP message, receiving data as needed.
+
+        :return: the message as a Python dict, or None at the end of the
+                 stream
+        """
+        while not self._messages:
+            if not self.fill():
+                return None
+        return self._messages.popleft()[0]
+
+
+class QMPRecorder(object):
+
+    """
+    Records the QMP traffic of a monitor to a file.
+
+    Every message is written as one JSON object per line, such as::
+
+        {"t": 0.0012, "dir": "cmd", "msg": {"execute": "query-status"}}
+
+    where ``t`` is the time in seconds since the recording started and
+    ``dir`` is one of 'greeting', 'cmd', 'reply' or 'event'.  Recordings
+    can be played back by :mod:`avocado_virt.qemu.fake_monitor`.
+    """
+
+    def __init__(self, path, sink=None):
+        """
+        :param path: path of the recording
+        :param sink: :class:`avocado_virt.utils.log_sink.LogSink` writing
+                     the recording from its own thread, if any.  A
+                     recording with holes could not be replayed, so it
+                     never drops data: while the sink has ``max_pending``
+                     bytes queued, recording blocks the thread reading the
+                     monitor (its reader thread or the VM hub) until the
+                     disk catches up.  Below that, recording does not wait
+                     for the disk.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        if sink is not None:
+            self._file = sink.open(path, drop=False)
+        else:
+            self._file = open(path, 'w')
+        self._start = time.time()
+
+    def __repr__(self):
+        return '%s(path=%r)' % (self.__class__.__name__, self.path)
+
+    def record(self, direction, msg):
+        """
+        :param direction: 'greeting', 'cmd', 'reply' or 'event'
+        :param msg: QMP message as a Python dict
+        """
+        line = json.dumps({'t': round(time.time() - self._start, 6),
+                           'dir': direction, 'msg': msg})
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+
+    def record_received(self, msg):
+        """
+        Record a message coming from QEMU, telling its kind from its keys.
+        """
+        if 'event' in msg:
+            self.record('event', msg)
+        elif 'QMP' in msg:
+            self.record('greeting', msg)
+        else:
+            self.record('reply', msg)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
 class QEMUMonitorProtocol:
 
-    def __init__(self, address, server=False, timeout=60):
+    def __init__(self, address, server=False, timeout=60,
+                 event_capacity=DEFAULT_EVENT_CAPACITY, event_type_caps=None):
         """
         Create a QEMUMonitorProtocol class.
 
@@ -45,12 +433,16 @@ class QEMUMonitorProtocol:
                         or a tuple in the form ( address, port ) for a TCP
                         connection
         :param server: server mode listens on the socket (bool)
+        :param event_capacity: maximum number of pending events kept
+        :param event_type_caps: dict with the maximum number of pending
+                                events kept per event name
         :raise: socket.error on socket connection errors
         :note: No connection is established, this is done by the connect() or
                accept() methods
         """
         socket.setdefaulttimeout(timeout)
-        self.__events = []
+        self.__events = QMPEventStore(event_capacity, event_type_caps)
+        self.__recorder = None
         self.__address = address
         self.__sock = self.__get_sock()
         if server:
@@ -76,10 +468,11 @@ class QEMUMonitorProtocol:
 
     def __json_read(self, only_event=False):
         while True:
-            data = self.__sockfile.readline()
-            if not data:
+            resp = self.__reader.read_message()
+            if resp is None:
                 return
-            resp = json.loads(data)
+            if self.__recorder is not None:
+                self.__recorder.record_received(resp)
             if 'event' in resp:
                 self.__events.append(resp)
                 if not only_event:
@@ -98,7 +491,7 @@ class QEMUMonitorProtocol:
         :raise: QMPCapabilitiesError if fails to negotiate capabilities
         """
         self.__sock.connect(self.__address)
-        self.__sockfile = self.__sock.makefile()
+        self.__reader = QMPStreamReader(self.__sock)
         if negotiate:
             return self.__negotiate_capabilities()
 
@@ -112,7 +505,7 @@ class QEMUMonitorProtocol:
         :raise: QMPCapabilitiesError if fails to negotiate capabilities
         """
         self.__sock, _ = self.__sock.accept()
-        self.__sockfile = self.__sock.makefile()
+        self.__reader = QMPStreamReader(self.__sock)
         return self.__negotiate_capabilities()
 
     def cmd_obj(self, qmp_cmd):
@@ -123,6 +516,8 @@ class QEMUMonitorProtocol:
         :return: QMP response as a Python dict or None if the connection has
                 been closed
         """
+        if self.__recorder is not None:
+            self.__recorder.record('cmd', qmp_cmd)
         try:
             self.__sock.sendall(json.dumps(qmp_cmd))
         except socket.error, err:
@@ -168,8 +563,9 @@ class QEMUMonitorProtocol:
         self.__sock.setblocking(1)
         if not self.__events and wait:
             self.__json_read(only_event=True)
-        event = self.__events[0]
-        del self.__events[0]
+        event = self.__events.popleft()
+        if event is None:
+            raise IndexError('No QMP event available')
         return event
 
     def get_events(self, wait=False):
@@ -193,17 +589,30 @@ class QEMUMonitorProtocol:
                 # went wrong
                 raise QMPConnectError("Error while reading from socket")
 
-        return self.__events
+        return list(self.__events)
 
     def clear_events(self):
         """
         Clear current list of pending events.
         """
-        self.__events = []
+        self.__events.clear()
+
+    def get_event_store(self):
+        """
+        Return the :class:`QMPEventStore` holding the pending events.
+        """
+        return self.__events
+
+    def set_recorder(self, recorder):
+        """
+        Record the traffic of this monitor from now on.
+
+        :param recorder: :class:`QMPRecorder`, or None to stop recording
+        """
+        self.__recorder = recorder
 
     def close(self):
         self.__sock.close()
-        self.__sockfile.close()
 
     timeout = socket.timeout
 
@@ -215,3 +624,742 @@ class QEMUMonitorProtocol:
 
     def is_scm_available(self):
         return self.__sock.family == socket.AF_UNIX
+
+
+class QMPStats(object):
+
+    """
+    Per command QMP statistics: latency, payload sizes and event backlog.
+
+    Latencies go from sending the command to receiving its reply, and are
+    kept in microseconds, in :class:`avocado_virt.utils.stats.Log2Histogram`
+    objects so the memory used does not depend on the number of commands.
+    The event backlog is the number of pending events when the reply
+    arrived.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self.events_received = 0
+
+    def record_event(self):
+        with self._lock:
+            self.events_received += 1
+
+    def record_reply(self, name, latency, request_size, reply_size, backlog):
+        """
+        :param name: QMP command name
+        :param latency: seconds between sending and receiving the reply
+        :param request_size: size of the command, in bytes
+        :param reply_size: size of the reply, in bytes
+        :param backlog: number of pending events
+        """
+        with self._lock:
+            command = self._commands.get(name)
+            if command is None:
+                command = self._commands[name] = {
+                    'latency_us': stats.Log2Histogram(),
+                    'request_bytes': stats.Log2Histogram(),
+                    'reply_bytes': stats.Log2Histogram(),
+                    'event_backlog': stats.Log2Histogram()}
+            command['latency_us'].add(int(latency * 1000000))
+            command['request_bytes'].add(request_size)
+            command['reply_bytes'].add(reply_size)
+            command['event_backlog'].add(backlog)
+
+    def to_dict(self):
+        with self._lock:
+            commands = dict((name, dict((key, histogram.to_dict())
+                                        for key, histogram in command.items()))
+                            for name, command in self._commands.items())
+            return {'commands': commands,
+                    'events_received': self.events_received}
+
+
+class QMPReply(object):
+
+    """
+    Reply to a command sent through :class:`QEMUMonitorProtocolAsync`.
+
+    Behaves like a future: it is created when the command is sent and
+    filled in by the reader when the response with the same ``id`` arrives.
+    """
+
+    def __init__(self, qmp_cmd, deadline=None, timeout=None):
+        self.cmd = qmp_cmd
+        self.id = qmp_cmd.get('id')
+        self.deadline = deadline
+        #: Seconds the monitor waits for the response, see deadline
+        self.timeout = timeout
+        self.sent_at = None
+        self.request_size = 0
+        self._expired = False
+        self._resp = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def __repr__(self):
+        return '%s(id=%r, execute=%r, done=%s)' % (self.__class__.__name__,
+                                                   self.id,
+                                                   self.cmd.get('execute'),
+                                                   self.done())
+
+    def done(self):
+        """
+        Whether the response (or the end of the connection) arrived.
+        """
+        return self._done.is_set()
+
+    def set_result(self, resp, expired=False):
+        with self._lock:
+            self._resp = resp
+            self._expired = expired
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            _run_callback(callback, self)
+
+    def add_done_callback(self, callback):
+        """
+        Call ``callback(reply)`` once the response is available.
+
+        Callbacks of pending replies run in the monitor reader context, so
+        they should be short and must not wait for other replies.  Errors
+        they raise are logged, use :meth:`exception` to tell whether the
+        command timed out without raising.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        _run_callback(callback, self)
+
+    def exception(self):
+        """
+        Return the error :meth:`result` raises, without waiting.
+
+        :return: QMPTimeoutError if the monitor gave up on the response,
+                 None otherwise
+        """
+        if not self._expired:
+            return None
+        return QMPTimeoutError('No reply to QMP command %s (id %s) after '
+                               '%s s' % (self.cmd.get('execute'), self.id,
+                                         self.timeout))
+
+    def result(self, timeout=None):
+        """
+        Wait for the response.
+
+        The monitor gives up on replies that do not arrive before the
+        monitor timeout, so waiting without a timeout does not hang forever
+        and avoids the polling Python 2 does in timed waits.
+
+        :param timeout: seconds to wait (None waits until the reply arrives
+                        or the monitor gives up on it)
+        :return: QMP response as a Python dict or None if the connection has
+                 been closed
+        :raise: QMPTimeoutError if the response did not arrive in time
+        """
+        if timeout is None:
+            self._done.wait()
+        else:
+            self._done.wait(timeout)
+        if not self._done.is_set():
+            raise QMPTimeoutError('No reply to QMP command %s (id %s) after '
+                                  '%s s' % (self.cmd.get('execute'), self.id,
+                                            timeout))
+        error = self.exception()
+        if error is not None:
+            raise error
+        return self._resp
+
+
+def event_match(event, match=None):
+    """
+    Check whether a QMP event matches a filter.
+
+    :param event: QMP event as a Python dict
+    :param match: None (matches everything), a callable that receives the
+                  event and returns a bool, or a dict that must be a subset
+                  of the event, checked recursively, such as
+                  ``{'data': {'device': 'drive0'}}``
+    """
+    if match is None:
+        return True
+    if callable(match):
+        return bool(match(event))
+    if isinstance(match, dict):
+        if not isinstance(event, dict):
+            return False
+        for key, value in match.items():
+            if key not in event or not event_match(event[key], value):
+                return False
+        return True
+    return event == match
+
+
+class QMPEventFilter(object):
+
+    """
+    Selects QMP events by name and by an :func:`event_match` filter.
+    """
+
+    def __init__(self, name=None, match=None):
+        self.name = name
+        self.match = match
+
+    def matches(self, event):
+        if self.name is not None and event.get('event') != self.name:
+            return False
+        return event_match(event, self.match)
+
+
+class QMPEventWaiter(QMPEventFilter):
+
+    """
+    A pending :meth:`QEMUMonitorProtocolAsync.wait_for_event` call.
+    """
+
+    def __init__(self, name=None, match=None):
+        QMPEventFilter.__init__(self, name, match)
+        self.event = None
+        self.done = threading.Event()
+
+
+class QMPEventSubscription(QMPEventFilter):
+
+    """
+    A callback registered through :meth:`QEMUMonitorProtocolAsync.subscribe`.
+    """
+
+    def __init__(self, callback, name=None, match=None):
+        QMPEventFilter.__init__(self, name, match)
+        self.callback = callback
+
+
+class QEMUMonitorProtocolAsync(object):
+
+    """
+    Pipelined QMP client.
+
+    Every command is tagged with an ``id`` and written to the monitor without
+    waiting for the previous one to be answered.  A reader thread matches the
+    responses back to their :class:`QMPReply` by ``id`` and queues events
+    separately, so any number of commands can be in flight on one monitor
+    and several threads can share it safely.
+
+    The reader is also the event pump: events can be waited for with
+    :meth:`wait_for_event`, which blocks without polling the socket, or
+    delivered to callbacks registered with :meth:`subscribe`.  Events that
+    nobody is waiting for are kept until they are pulled.
+
+    Instead of a reader thread of its own, the client can be served by a
+    :class:`avocado_virt.qemu.hub.VMHub`, which reads the monitors of many
+    VMs from a single thread.
+    """
+
+    error = socket.error
+    timeout = socket.timeout
+
+    def __init__(self, address, server=False, timeout=60,
+                 event_capacity=DEFAULT_EVENT_CAPACITY, event_type_caps=None,
+                 hub=None):
+        """
+        Create a QEMUMonitorProtocolAsync class.
+
+        :param address: QEMU address, can be either a unix socket path (string)
+                        or a tuple in the form ( address, port ) for a TCP
+                        connection
+        :param server: server mode listens on the socket (bool)
+        :param timeout: seconds to wait for the connection and, by default,
+                        for each command reply
+        :param event_capacity: maximum number of pending events kept
+        :param event_type_caps: dict with the maximum number of pending
+                                events kept per event name
+        :param hub: :class:`avocado_virt.qemu.hub.VMHub` reading the monitor,
+                    or None to use a reader thread
+        :raise: socket.error on socket connection errors
+        :note: No connection is established, this is done by the connect() or
+               accept() methods
+        """
+        self._address = address
+        self._hub = hub
+        self._timeout = timeout
+        self._tick = 0.5
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_order = []
+        #: ids of the commands given up on whose replies may still come, in
+        #: the order they were sent
+        self._expired_ids = []
+        self._events = QMPEventStore(event_capacity, event_type_caps)
+        self._events_cond = threading.Condition(self._lock)
+        self._waiters = []
+        self._subscriptions = []
+        self.stats = QMPStats()
+        self._closed = False
+        self._reader = None
+        self._reader_done = threading.Event()
+        self._reading = False
+        self._stream = None
+        self._recorder = None
+        self._sock = self._get_sock()
+        self._sock.settimeout(timeout)
+        if server:
+            self._sock.bind(self._address)
+            self._sock.listen(1)
+
+    def _get_sock(self):
+        if isinstance(self._address, tuple):
+            family = socket.AF_INET
+        else:
+            family = socket.AF_UNIX
+        return socket.socket(family, socket.SOCK_STREAM)
+
+    def _start(self, negotiate):
+        self._sock.settimeout(self._timeout)
+        self._stream = QMPStreamReader(self._sock)
+        greeting = None
+        if negotiate:
+            greeting = self._stream.read_message()
+            if greeting is None or 'QMP' not in greeting:
+                raise QMPConnectError
+            if self._recorder is not None:
+                self._recorder.record('greeting', greeting)
+        if self._hub is not None:
+            self._hub.register(self)
+        else:
+            self._reader = threading.Thread(target=self._read_loop,
+                                            name='QMPReader')
+            self._reader.daemon = True
+            self._reader.start()
+        self._reading = True
+        if negotiate:
+            resp = self.cmd('qmp_capabilities')
+            if resp is None or "return" not in resp:
+                raise QMPCapabilitiesError
+        return greeting
+
+    def _read_loop(self):
+        # Replies are given up on every tick, even when a steady stream of
+        # events keeps the socket from ever being idle for a whole tick
+        next_tick = time.time() + self._tick
+        try:
+            while True:
+                timeout = max(0, next_tick - time.time())
+                try:
+                    readable = select.select([self._sock], [], [],
+                                             timeout)[0]
+                except (socket.error, select.error, ValueError):
+                    break
+                try:
+                    if readable and not self.handle_read():
+                        break
+                except Exception, details:
+                    # Such as a ValueError for a malformed message
+                    log.error('QMP: could not read from %s: %s',
+                              self._address, details)
+                    break
+                now = time.time()
+                if now >= next_tick:
+                    next_tick = now + self._tick
+                    self.handle_tick()
+        finally:
+            # Pending replies fail rather than wait forever
+            self.handle_close()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def handle_read(self):
+        """
+        Receive and dispatch the available messages.
+
+        :return: False once the connection is closed
+        """
+        try:
+            if not self._stream.fill():
+                return False
+        except socket.error, err:
+            if err[0] != errno.EAGAIN:
+                return False
+        for resp, size in self._stream.get_messages():
+            self._dispatch(resp, size)
+        return True
+
+    def handle_tick(self):
+        self._expire_replies()
+
+    def handle_close(self):
+        self._connection_closed()
+
+    def _expire_replies(self):
+        now = time.time()
+        with self._lock:
+            expired = [self._pending[qmp_id]
+                       for qmp_id in self._pending_order
+                       if (self._pending[qmp_id].deadline is not None and
+                           self._pending[qmp_id].deadline < now)]
+            for reply in expired:
+                del self._pending[reply.id]
+                self._pending_order.remove(reply.id)
+                self._expired_ids.append(reply.id)
+        for reply in expired:
+            reply.set_result(None, expired=True)
+
+    def _dispatch(self, resp, size=0):
+        if self._recorder is not None:
+            self._recorder.record_received(resp)
+        if 'event' in resp:
+            self.stats.record_event()
+            self._dispatch_event(resp)
+            return
+        with self._lock:
+            reply = self._pop_pending(resp.get('id'))
+            backlog = len(self._events)
+        if reply is not None:
+            if reply.sent_at is not None:
+                self.stats.record_reply(reply.cmd.get('execute'),
+                                        time.time() - reply.sent_at,
+                                        reply.request_size, size, backlog)
+            reply.set_result(resp)
+
+    def _dispatch_event(self, event):
+        with self._events_cond:
+            subscriptions = [subscription
+                             for subscription in self._subscriptions
+                             if subscription.matches(event)]
+            for waiter in self._waiters:
+                if waiter.event is None and waiter.matches(event):
+                    waiter.event = event
+                    waiter.done.set()
+                    break
+            else:
+                self._events.append(event)
+                self._events_cond.notify_all()
+        for subscription in subscriptions:
+            _run_callback(subscription.callback, event)
+
+    def _pop_pending(self, qmp_id):
+        # QEMU answers commands in order, so a response without id (such as
+        # the error for an unparseable command) belongs to the oldest one,
+        # which may be a command given up on.  Late replies of those are
+        # dropped, and once a command is answered, the ones sent before it
+        # will not be anymore.
+        if qmp_id is None:
+            if self._expired_ids:
+                self._expired_ids.pop(0)
+                return None
+            if not self._pending_order:
+                return None
+            qmp_id = self._pending_order[0]
+        elif qmp_id in self._expired_ids:
+            del self._expired_ids[:self._expired_ids.index(qmp_id) + 1]
+            return None
+        elif qmp_id not in self._pending:
+            return None
+        self._expired_ids = []
+        self._pending_order.remove(qmp_id)
+        return self._pending.pop(qmp_id)
+
+    def _connection_closed(self):
+        with self._events_cond:
+            self._closed = True
+            pending = [self._pending[qmp_id]
+                       for qmp_id in self._pending_order]
+            self._pending = {}
+            self._pending_order = []
+            self._expired_ids = []
+            for waiter in self._waiters:
+                waiter.done.set()
+            self._events_cond.notify_all()
+        for reply in pending:
+            reply.set_result(None)
+        self._reader_done.set()
+
+    def connect(self, negotiate=True):
+        """
+        Connect to the QMP Monitor and perform capabilities negotiation.
+
+        :return: QMP greeting dict
+        :raise: socket.error on socket connection errors
+        :raise: QMPConnectError if the greeting is not received
+        :raise: QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        self._sock.connect(self._address)
+        return self._start(negotiate)
+
+    def accept(self):
+        """
+        Await connection from QMP Monitor and perform capabilities negotiation.
+
+        :return: QMP greeting dict
+        :raise: socket.error on socket connection errors
+        :raise: QMPConnectError if the greeting is not received
+        :raise: QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        listener = self._sock
+        self._sock, _ = listener.accept()
+        listener.close()
+        return self._start(negotiate=True)
+
+    def cmd_obj_async(self, qmp_cmd, fd=None):
+        """
+        Send a QMP command to the QMP Monitor without waiting for the reply.
+
+        :param qmp_cmd: QMP command to be sent as a Python dict. An ``id`` is
+                        added to it when not present.
+        :param fd: file descriptor to pass along with the command, for
+                   commands such as 'getfd' (unix sockets only)
+        :return: :class:`QMPReply` for the command
+        """
+        qmp_cmd = dict(qmp_cmd)
+        with self._send_lock:
+            with self._lock:
+                if qmp_cmd.get('id') is None:
+                    qmp_cmd['id'] = next(self._ids)
+                deadline = None
+                if self._timeout is not None:
+                    deadline = time.time() + self._timeout
+                reply = QMPReply(qmp_cmd, deadline, self._timeout)
+                if self._closed:
+                    reply.set_result(None)
+                    return reply
+                self._pending[reply.id] = reply
+                self._pending_order.append(reply.id)
+            data = json.dumps(qmp_cmd)
+            reply.request_size = len(data)
+            if self._recorder is not None:
+                self._recorder.record('cmd', qmp_cmd)
+            reply.sent_at = time.time()
+            try:
+                if fd is None:
+                    self._sock.sendall(data)
+                else:
+                    send_fd(self._sock, data, fd)
+            except socket.error, err:
+                with self._lock:
+                    if self._pending.pop(reply.id, None) is not None:
+                        self._pending_order.remove(reply.id)
+                if err[0] != errno.EPIPE:
+                    raise
+                reply.set_result(None)
+        return reply
+
+    def cmd_async(self, name, args=None, id=None):
+        """
+        Build a QMP command and send it without waiting for the reply.
+
+        :param name: command name (string)
+        :param args: command arguments (dict)
+        :param id: command id (dict, list, string or int), generated when
+                   not given
+        :return: :class:`QMPReply` for the command
+        """
+        qmp_cmd = {'execute': name}
+        if args:
+            qmp_cmd['arguments'] = args
+        if id is not None:
+            qmp_cmd['id'] = id
+        return self.cmd_obj_async(qmp_cmd)
+
+    def cmd_obj(self, qmp_cmd):
+        """
+        Send a QMP command to the QMP Monitor and wait for the reply.
+
+        :param qmp_cmd: QMP command to be sent as a Python dict
+        :return: QMP response as a Python dict or None if the connection has
+                been closed
+        :raise: QMPTimeoutError if the response does not arrive in time
+        """
+        return self.cmd_obj_async(qmp_cmd).result()
+
+    def cmd(self, name, args=None, id=None):
+        """
+        Build a QMP command, send it to the QMP Monitor and wait for the reply.
+
+        :param name: command name (string)
+        :param args: command arguments (dict)
+        :param id: command id (dict, list, string or int)
+        """
+        return self.cmd_async(name, args, id).result()
+
+    def send_fd(self, fd, fdname):
+        """
+        Pass a file descriptor to QEMU with 'getfd', for commands that take
+        an fd name, such as 'migrate' with an ``fd:<fdname>`` URI.
+
+        :param fd: file descriptor to pass
+        :param fdname: name QEMU gives to the file descriptor
+        :return: QMP response as a Python dict
+        """
+        if not self.is_scm_available():
+            raise QMPError('File descriptors can only be passed over unix '
+                           'sockets')
+        qmp_cmd = {'execute': 'getfd', 'arguments': {'fdname': fdname}}
+        return self.cmd_obj_async(qmp_cmd, fd=fd).result()
+
+    def command(self, cmd, **kwds):
+        ret = self.cmd(cmd, kwds)
+        if 'error' in ret:
+            raise QMPError(ret['error']['desc'])
+        return ret['return']
+
+    def _wait_events(self, wait):
+        # Must be called with self._lock held
+        while wait and not self._events and not self._closed:
+            self._events_cond.wait()
+        if wait and not self._events:
+            raise QMPConnectError("Connection closed while waiting for "
+                                  "events")
+
+    def pull_event(self, wait=False):
+        """
+        Get and delete the first available QMP event.
+
+        :param wait: block until an event is available (bool)
+        :return: the event or None if no event is available
+        """
+        with self._events_cond:
+            self._wait_events(wait)
+            return self._events.popleft()
+
+    def get_events(self, wait=False):
+        """
+        Get a list of available QMP events.
+
+        :param wait: block until an event is available (bool)
+        """
+        with self._events_cond:
+            self._wait_events(wait)
+            return list(self._events)
+
+    def drain_events(self, wait=False):
+        """
+        Get and delete all available QMP events at once.
+
+        Unlike calling :meth:`get_events` and then :meth:`clear_events`,
+        events arriving in between are not lost.
+
+        :param wait: block until an event is available (bool)
+        """
+        with self._events_cond:
+            self._wait_events(wait)
+            return self._events.drain()
+
+    def clear_events(self):
+        """
+        Clear current list of pending events.
+        """
+        with self._events_cond:
+            self._events.clear()
+
+    def get_event_store(self):
+        """
+        Return the :class:`QMPEventStore` holding the pending events.
+
+        Its ``dropped`` counters tell how many events were discarded because
+        the store was full.
+        """
+        return self._events
+
+    def wait_for_event(self, name=None, match=None, timeout=None):
+        """
+        Wait for a QMP event and remove it from the pending events.
+
+        Events already received are looked at first, so an event that
+        arrived before the call is not missed.  Events that do not match
+        are left pending for other consumers.
+
+        :param name: event name, such as 'SHUTDOWN' (None matches any event)
+        :param match: filter, see :func:`event_match`
+        :param timeout: seconds to wait (None waits forever)
+        :return: the event, or None if it did not arrive in time
+        :raise: QMPConnectError if the connection is closed before the event
+                arrives
+        """
+        waiter = QMPEventWaiter(name, match)
+        with self._events_cond:
+            event = self._events.pop_match(waiter)
+            if event is not None:
+                return event
+            if self._closed:
+                raise QMPConnectError("Connection closed while waiting for "
+                                      "event %s" % name)
+            self._waiters.append(waiter)
+        try:
+            waiter.done.wait(timeout)
+        finally:
+            with self._events_cond:
+                self._waiters.remove(waiter)
+                closed = self._closed
+        if waiter.event is None and closed:
+            raise QMPConnectError("Connection closed while waiting for "
+                                  "event %s" % name)
+        return waiter.event
+
+    def subscribe(self, callback, name=None, match=None):
+        """
+        Call ``callback(event)`` for every matching QMP event received.
+
+        Callbacks run in the monitor reader context, so they should be short
+        and must not wait for command replies.  Errors they raise are
+        logged.  Subscribed events are still kept pending for
+        :meth:`pull_event` and :meth:`wait_for_event`.
+
+        :param callback: callable receiving the event dict
+        :param name: event name (None matches any event)
+        :param match: filter, see :func:`event_match`
+        :return: subscription, to be given to :meth:`unsubscribe`
+        """
+        subscription = QMPEventSubscription(callback, name, match)
+        with self._events_cond:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._events_cond:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def set_recorder(self, recorder):
+        """
+        Record the traffic of this monitor from now on.
+
+        Set the recorder before :meth:`connect` or :meth:`accept` to record
+        the greeting and the capabilities negotiation too.
+
+        :param recorder: :class:`QMPRecorder`, or None to stop recording
+        """
+        self._recorder = recorder
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        if self._hub is not None:
+            reading_here = self._hub.in_hub_thread()
+        else:
+            reading_here = self._reader is threading.current_thread()
+        if self._reading and not reading_here:
+            self._reader_done.wait()
+        self._sock.close()
+
+    def settimeout(self, timeout):
+        """
+        Set the time to wait for replies and for the socket to accept data.
+        """
+        self._timeout = timeout
+        self._sock.settimeout(timeout)
+
+    def get_sock_fd(self):
+        return self._sock.fileno()
+
+    def is_scm_available(self):
+        return self._sock.family == socket.AF_UNIX
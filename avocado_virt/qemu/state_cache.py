@@ -0,0 +1,242 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Cache of saved VM states, to resume booted guests instead of booting them.
+
+The first VM of a given configuration boots on qcow2 overlays of its disks.
+Once its guest is ready, the VM state is migrated to a file and the
+overlays are frozen: the VM carries on writing to new overlays on top of
+them.  The state file and the frozen overlays are kept in the avocado data
+dir, keyed by a hash of the VM configuration, and later VMs with the same
+configuration start from them with ``-incoming "exec:cat <state file>"``,
+each one on fresh overlays of the frozen ones, so the guest memory and
+disks always match.  When the saved states take more than the quota, the
+least recently resumed ones are removed.
+"""
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import logging
+
+from avocado.core import data_dir
+from avocado.utils import path as utils_path
+from ..utils import image_cache
+
+log = logging.getLogger("avocado.test")
+
+#: Default maximum size of the saved states and their overlays, in MiB
+DEFAULT_QUOTA = 4096
+
+#: Devices that do not affect the guest state (they only hold host side
+#: sockets and ports), left out of the configuration hash
+VOLATILE_DEVICES = ('qmp', 'serial', 'fd', 'incoming', 'vnc')
+
+
+def _cache_dir():
+    return utils_path.init_dir(os.path.join(data_dir.get_data_dir(),
+                                            'cache', 'vm-state'))
+
+
+def _file_stamp(path):
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    return [real_path, stat.st_size, stat.st_mtime]
+
+
+def _image_stamp(path):
+    # Images restored from their .xz before each test get a new
+    # modification time every time, while their contents stay the same
+    compressed_file = path + '.xz'
+    if not os.path.isfile(compressed_file):
+        return _file_stamp(path)
+    real_path = os.path.realpath(compressed_file)
+    return [real_path, os.path.getsize(real_path),
+            image_cache.ImageCache().checksum(real_path)]
+
+
+def state_key(qemu_devices, template=None):
+    """
+    Hash the parts of a VM configuration that the guest state depends on.
+
+    The QEMU binary and the disk images are identified by their path, size
+    and modification time, so updating any of them invalidates the states
+    saved with the previous version.  Images restored from an ``.xz`` are
+    identified by the path, size and SHA1 of the ``.xz`` instead.
+
+    :param qemu_devices: :class:`avocado_virt.qemu.devices.QemuDevices`
+    :param template: contents of the QEMU command line template, if any
+    :return: hex digest
+    """
+    parts = [_file_stamp(qemu_devices.qemu_bin), template]
+    for dev in qemu_devices.devices[1:]:
+        if dev.name in VOLATILE_DEVICES:
+            continue
+        if dev.name == 'drive':
+            parts.append([dev.name, dev.device_type, dev.device_id,
+                          dev.drive_id, _image_stamp(dev.image_file)])
+        elif dev.name == 'network':
+            # The forwarded host port changes from one VM to the other
+            parts.append(re.sub(r'hostfwd=tcp::\d+-', 'hostfwd=tcp::-',
+                                dev.get_cmdline()))
+        else:
+            parts.append(dev.get_cmdline())
+    return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+
+class VMStateCache(object):
+
+    """
+    Saved state of one VM configuration.
+    """
+
+    def __init__(self, key):
+        """
+        :param key: configuration hash, see :func:`state_key`
+        """
+        self.key = key
+        self.cache_dir = _cache_dir()
+        self.state_file = os.path.join(self.cache_dir, '%s.state' % key)
+        self._lock_file = None
+
+    def __repr__(self):
+        return '%s(key=%r, saved=%s)' % (self.__class__.__name__, self.key,
+                                         self.is_saved())
+
+    def overlay_path(self, drive_id):
+        """
+        Path of the frozen overlay of a drive.
+        """
+        return os.path.join(self.cache_dir,
+                            '%s-%s.qcow2' % (self.key, drive_id))
+
+    def is_saved(self):
+        """
+        Whether a VM state was saved for this configuration.
+
+        The state file is renamed into place once the state and overlays
+        are complete, so its presence is enough.
+        """
+        return os.path.isfile(self.state_file)
+
+    def lock(self, shared=False):
+        """
+        Try to take the lock of this configuration, exclusive to save or
+        evict its state, shared to resume it.
+
+        :return: True if the lock was taken, False if another process holds it
+        """
+        lock_file = open(os.path.join(self.cache_dir, '%s.lock' % self.key),
+                         'w')
+        if shared:
+            operation = fcntl.LOCK_SH
+        else:
+            operation = fcntl.LOCK_EX
+        try:
+            fcntl.flock(lock_file, operation | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def unlock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def commit(self, tmp_state_file):
+        """
+        Publish a state file once it is complete.
+        """
+        os.rename(tmp_state_file, self.state_file)
+
+    def touch(self):
+        """
+        Record that the saved state is used, the least recently used ones
+        are evicted first.
+        """
+        try:
+            os.utime(self.state_file, None)
+        except OSError:
+            pass
+
+    def remove(self):
+        """
+        Forget the saved state, such as when QEMU can no longer load it.
+        """
+        try:
+            os.remove(self.state_file)
+        except OSError:
+            pass
+
+    def remove_all(self):
+        """
+        Remove the saved state, its frozen overlays and the files of an
+        unfinished save.  The caller holds the exclusive lock.
+        """
+        for name in os.listdir(self.cache_dir):
+            if _entry_key(name) == self.key and not name.endswith('.lock'):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+
+def _entry_key(name):
+    # <key>.state, <key>.state.<pid>, <key>-<drive id>.qcow2 and <key>.lock
+    return name.split('.', 1)[0].split('-', 1)[0]
+
+
+def evict(quota, keep=None):
+    """
+    Remove the least recently used saved states, with their overlays, until
+    the quota is met.  States being saved or resumed are left alone.
+
+    :param quota: maximum size of the saved states and overlays, in MiB
+    :param keep: key of a state that must not be removed
+    """
+    cache_dir = _cache_dir()
+    sizes = {}
+    last_used = {}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.lock'):
+            continue
+        key = _entry_key(name)
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except OSError:
+            continue
+        sizes[key] = sizes.get(key, 0) + stat.st_size
+        # Overlays left without a state file are evicted first
+        last_used.setdefault(key, 0)
+        if name.endswith('.state'):
+            last_used[key] = stat.st_mtime
+    total = sum(sizes.values())
+    for _, key in sorted((used, key) for key, used in last_used.items()):
+        if total <= quota * 1024 * 1024:
+            break
+        if key == keep:
+            continue
+        cache = VMStateCache(key)
+        if not cache.lock():
+            continue
+        try:
+            log.debug('VM state cache: evicting %s', key)
+            cache.remove_all()
+        finally:
+            cache.unlock()
+        total -= sizes[key]
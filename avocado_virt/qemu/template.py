@@ -0,0 +1,126 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+QEMU command line templates.
+
+Templates use the ``str.format`` syntax, such as ``{avocado_drive}``.  A
+template is parsed once into a :class:`CompiledTemplate`, cached by the
+hash of its contents, and then rendered in a single pass, which also
+tells all the tags the template uses but which are not defined.
+"""
+
+import string
+import hashlib
+
+_FORMATTER = string.Formatter()
+
+#: Compiled templates, by SHA1 of their contents
+_CACHE = {}
+
+
+class _Field(object):
+
+    """
+    A ``{tag...}`` replacement field of a template.
+    """
+
+    def __init__(self, field_name, conversion, format_spec):
+        # pylint: disable=W0212
+        tag, rest = field_name._formatter_field_name_split()
+        self.tag = tag
+        #: (is attribute, attribute name or index) to get from the tag
+        self.path = list(rest)
+        self.conversion = conversion
+        self.format_spec = None
+        if format_spec:
+            self.format_spec = CompiledTemplate(format_spec)
+
+    def render(self, tags, missing):
+        if self.tag not in tags:
+            missing.append(self.tag)
+            return ''
+        value = tags[self.tag]
+        for is_attr, key in self.path:
+            if is_attr:
+                value = getattr(value, key)
+            else:
+                value = value[key]
+        value = _FORMATTER.convert_field(value, self.conversion)
+        format_spec = ''
+        if self.format_spec is not None:
+            format_spec = self.format_spec.render(tags, missing)
+        return format(value, format_spec)
+
+
+class CompiledTemplate(object):
+
+    """
+    A template, parsed into its literal text and replacement fields.
+    """
+
+    def __init__(self, contents):
+        self.contents = contents
+        #: Literal text (str) and replacement fields (_Field), in order
+        self._parts = []
+        for literal, field_name, format_spec, conversion in \
+                _FORMATTER.parse(contents):
+            if literal:
+                self._parts.append(literal)
+            if field_name is not None:
+                self._parts.append(_Field(field_name, conversion,
+                                          format_spec))
+        #: Tags used by the template
+        self.tags = set(part.tag for part in self._parts
+                        if isinstance(part, _Field))
+
+    def __repr__(self):
+        return '%s(tags=%r)' % (self.__class__.__name__, sorted(self.tags))
+
+    def render(self, tags, missing=None):
+        """
+        Render the template, leaving out the tags which are not defined.
+
+        :param tags: dict of tag names to values
+        :param missing: list the undefined tags are appended to, in the
+                        order they appear in the template
+        :return: the rendered template
+        """
+        if missing is None:
+            missing = []
+        parts = []
+        for part in self._parts:
+            if isinstance(part, _Field):
+                parts.append(part.render(tags, missing))
+            else:
+                parts.append(part)
+        return ''.join(parts)
+
+
+def compile_template(contents):
+    """
+    Return the compiled template of some contents, parsing them only the
+    first time.
+
+    :rtype: :class:`CompiledTemplate`
+    :raise: ValueError if the template is not valid
+    """
+    if isinstance(contents, unicode):
+        key = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+    else:
+        key = hashlib.sha1(contents).hexdigest()
+    compiled = _CACHE.get(key)
+    if compiled is None:
+        compiled = CompiledTemplate(contents)
+        _CACHE[key] = compiled
+    return compiled
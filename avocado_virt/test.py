@@ -16,8 +16,8 @@
 import os
 
 from avocado import Test
-from avocado.utils import process
 from .qemu import machine
+from .utils import image_cache
 
 
 class VirtTest(Test):
@@ -40,11 +40,11 @@ class VirtTest(Test):
             self.log.debug('Found compressed image %s and restore guest '
                            'image set. Restoring image...',
                            compressed_drive_file)
-            cwd = os.getcwd()
-            os.chdir(os.path.dirname(compressed_drive_file))
-            process.run('xz --decompress --keep --force %s' %
-                        os.path.basename(compressed_drive_file))
-            os.chdir(cwd)
+            quota = self.params.get('image_cache_quota',
+                                    '/plugins/virt/guest/*',
+                                    default=image_cache.DEFAULT_QUOTA)
+            image_cache.restore_image(compressed_drive_file, drive_file,
+                                      quota)
         else:
             self.log.debug('Restore guest image set, but could not find '
                            'compressed image %s. Skipping restore...',
@@ -57,13 +57,29 @@ class VirtTest(Test):
         By default, always restore.
         If only the test level restore is disabled, execute one restore (job).
         If both are disabled, then never restore.
+        With the 'overlay' restore mode, the image is left untouched and the
+        VM runs on a qcow2 overlay of it instead.
         """
-        if not self.params.get('disable_restore_image_test',
-                               '/plugins/virt/guest/*'):
+        restore_mode = self.params.get('restore_mode',
+                                       '/plugins/virt/guest/*', default='xz')
+        if restore_mode == 'overlay':
+            # The image is never written to, it only has to exist
+            drive_file = self.params.get('image_path',
+                                         '/plugins/virt/guest/*')
+            if not os.path.isfile(drive_file):
+                self._restore_guest_images()
+        elif not self.params.get('disable_restore_image_test',
+                                 '/plugins/virt/guest/*'):
             self._restore_guest_images()
-        self.vm = machine.VM(params=self.params, logdir=self.logdir)
-        self.vm.devices.add_nodefaults()
-        self.vm.devices.add_vga('std')
-        self.vm.devices.add_vnc()
-        self.vm.devices.add_drive()
-        self.vm.devices.add_net()
+        self.vm = self._new_vm()
+
+    def _new_vm(self):
+        restore_mode = self.params.get('restore_mode',
+                                       '/plugins/virt/guest/*', default='xz')
+        vm = machine.VM(params=self.params, logdir=self.logdir)
+        vm.devices.add_nodefaults()
+        vm.devices.add_vga('std')
+        vm.devices.add_vnc()
+        vm.devices.add_drive(overlay=(restore_mode == 'overlay'))
+        vm.devices.add_net()
+        return vm
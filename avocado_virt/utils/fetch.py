@@ -0,0 +1,189 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Streaming download of compressed guest images.
+
+The ``.xz`` is hashed and piped into ``xz`` as it is downloaded, so the
+image is verified and decompressed by the time the download ends, reading
+the data only once.  Interrupted downloads are kept aside and resumed with
+an HTTP Range request.
+"""
+
+import os
+import hashlib
+import logging
+import urllib2
+import subprocess
+
+log = logging.getLogger("avocado.app")
+
+_CHUNK_SIZE = 1 << 20
+
+
+class FetchError(Exception):
+    pass
+
+
+class IncompleteFetchError(FetchError):
+
+    """
+    The connection ended before the whole file was received.  What was
+    received is kept, and the download can be resumed.
+    """
+
+
+def _expected_size(response, offset):
+    """
+    :return: size of the whole file according to the response headers,
+             or None if unknown
+    """
+    content_range = response.info().getheader('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+    length = response.info().getheader('Content-Length')
+    if length and length.isdigit():
+        return offset + int(length)
+    return None
+
+
+class _Pipeline(object):
+
+    """
+    Hashes, stores and decompresses the data of the ``.xz``, in order.
+    """
+
+    def __init__(self, part_path, image_tmp_path, append):
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self._part = open(part_path, 'ab' if append else 'wb')
+        self._image = open(image_tmp_path, 'wb')
+        self._xz = subprocess.Popen(['xz', '--decompress', '--stdout'],
+                                    stdin=subprocess.PIPE,
+                                    stdout=self._image)
+
+    def feed(self, data, store=True):
+        self.sha1.update(data)
+        self.size += len(data)
+        if store:
+            self._part.write(data)
+        try:
+            self._xz.stdin.write(data)
+        except IOError:
+            # xz stopped reading (corrupt data), reported by finish()
+            pass
+
+    def finish(self):
+        """
+        :return: the exit status of xz
+        """
+        self._part.close()
+        self._xz.stdin.close()
+        status = self._xz.wait()
+        self._image.close()
+        return status
+
+    def abort(self):
+        self._part.close()
+        if self._xz.poll() is None:
+            self._xz.kill()
+        self._xz.wait()
+        self._image.close()
+
+
+def fetch_image(url, compressed_path, image_path, sha1=None):
+    """
+    Download a ``.xz`` image, verifying and decompressing it on the fly.
+
+    The data is downloaded to ``compressed_path + '.part'``, which is kept
+    if the download is interrupted and resumed by the next call, provided
+    the server supports HTTP Range requests.
+
+    :param url: URL of the ``.xz`` file
+    :param compressed_path: where to keep the ``.xz`` file
+    :param image_path: where to put the decompressed image
+    :param sha1: expected SHA1 of the ``.xz`` file, if known
+    :return: the SHA1 of the ``.xz`` file
+    :raise: IncompleteFetchError if the connection ends too early,
+            FetchError if the download does not match the SHA1 or does not
+            decompress
+    """
+    part_path = compressed_path + '.part'
+    image_tmp_path = image_path + '.part'
+    offset = 0
+    if os.path.isfile(part_path):
+        offset = os.path.getsize(part_path)
+
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError, details:
+        if details.code != 416:
+            raise
+        # The part is as large as the file, or larger: start over
+        os.remove(part_path)
+        return fetch_image(url, compressed_path, image_path, sha1)
+    resume = bool(offset) and response.getcode() == 206
+    if offset and not resume:
+        log.debug('Server does not support resuming downloads, '
+                  'downloading %s again', url)
+    expected_size = _expected_size(response, offset if resume else 0)
+
+    pipeline = _Pipeline(part_path, image_tmp_path, append=resume)
+    try:
+        if resume:
+            log.debug('Resuming download of %s at byte %d', url, offset)
+            # The data already downloaded still has to be hashed and
+            # decompressed, which is much faster than downloading it
+            with open(part_path, 'rb') as part:
+                while pipeline.size < offset:
+                    data = part.read(min(_CHUNK_SIZE,
+                                         offset - pipeline.size))
+                    if not data:
+                        break
+                    pipeline.feed(data, store=False)
+        while True:
+            data = response.read(_CHUNK_SIZE)
+            if not data:
+                break
+            pipeline.feed(data)
+        if expected_size is not None and pipeline.size < expected_size:
+            raise IncompleteFetchError('Download of %s interrupted at byte '
+                                       '%d of %d' % (url, pipeline.size,
+                                                     expected_size))
+    except BaseException:
+        # Keep the part for the next attempt
+        pipeline.abort()
+        if os.path.exists(image_tmp_path):
+            os.remove(image_tmp_path)
+        raise
+    finally:
+        response.close()
+
+    xz_status = pipeline.finish()
+    actual_sha1 = pipeline.sha1.hexdigest()
+    if (sha1 is not None and actual_sha1 != sha1) or xz_status != 0:
+        os.remove(part_path)
+        os.remove(image_tmp_path)
+        if xz_status != 0:
+            raise FetchError('%s could not be decompressed (xz exit status '
+                             '%s)' % (url, xz_status))
+        raise FetchError('SHA1 of %s is %s, expected %s' %
+                         (url, actual_sha1, sha1))
+    os.rename(part_path, compressed_path)
+    os.rename(image_tmp_path, image_path)
+    return actual_sha1
@@ -15,6 +15,13 @@
 Utility functions for image files.
 """
 import os
+import json
+import time
+import errno
+import fcntl
+import ctypes
+
+from avocado.utils import process
 
 
 def is_ppm(filename):
@@ -38,3 +45,161 @@ def is_ppm(filename):
         return True
     except AssertionError:
         return False
+
+
+def get_format(qemu_img, filename):
+    """
+    Return the format of an image file, such as 'raw' or 'qcow2'.
+
+    :param qemu_img: Path of the qemu-img binary.
+    :param filename: Path of the image file.
+    """
+    result = process.run('%s info --output=json %s' % (qemu_img, filename))
+    return json.loads(result.stdout)['format']
+
+
+def create_overlay(qemu_img, backing_file, overlay, backing_format=None):
+    """
+    Create a qcow2 overlay of an image file.
+
+    Writes to the overlay leave the backing file untouched, so the backing
+    file can be shared by many overlays.
+
+    :param qemu_img: Path of the qemu-img binary.
+    :param backing_file: Path of the image the overlay is on top of.
+    :param overlay: Path of the overlay to be created.
+    :param backing_format: Format of the backing file (detected if None).
+    """
+    if backing_format is None:
+        backing_format = get_format(qemu_img, backing_file)
+    process.run('%s create -q -f qcow2 -b %s -F %s %s' %
+                (qemu_img, os.path.abspath(backing_file), backing_format,
+                 overlay))
+
+
+#: ioctl sharing the extents of a file with another (reflink)
+_FICLONE = 0x40049409
+_SEEK_DATA = 3
+_SEEK_HOLE = 4
+_CHUNK_SIZE = 1 << 20
+
+# Errors telling that a copy method is not supported for the given files
+_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                       errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _get_copy_file_range():
+    try:
+        func = ctypes.CDLL(None, use_errno=True).copy_file_range
+    except (OSError, AttributeError):
+        # glibc older than 2.27
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                     ctypes.c_int, ctypes.POINTER(ctypes.c_longlong),
+                     ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+
+_copy_file_range = _get_copy_file_range()
+
+
+def _data_segments(fd, size):
+    """
+    Yield the (start, end) offsets of the data of a sparse file.
+
+    Files on filesystems without SEEK_DATA support are a single segment.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, _SEEK_DATA)
+        except OSError, details:
+            if details.errno == errno.ENXIO:
+                # Only a hole up to the end of the file
+                return
+            if details.errno in _UNSUPPORTED_ERRORS:
+                yield offset, size
+                return
+            raise
+        end = os.lseek(fd, start, _SEEK_HOLE)
+        yield start, end
+        offset = end
+
+
+def _kernel_copy(src_fd, dst_fd, size):
+    for start, end in _data_segments(src_fd, size):
+        src_offset = ctypes.c_longlong(start)
+        dst_offset = ctypes.c_longlong(start)
+        while src_offset.value < end:
+            copied = _copy_file_range(src_fd, ctypes.byref(src_offset),
+                                      dst_fd, ctypes.byref(dst_offset),
+                                      end - src_offset.value, 0)
+            if copied < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            if copied == 0:
+                break
+    os.ftruncate(dst_fd, size)
+
+
+def _stream_copy(src_fd, dst_fd, size):
+    zeros = '\0' * _CHUNK_SIZE
+    for start, end in _data_segments(src_fd, size):
+        os.lseek(src_fd, start, os.SEEK_SET)
+        offset = start
+        while offset < end:
+            data = os.read(src_fd, min(_CHUNK_SIZE, end - offset))
+            if not data:
+                break
+            # Leave all zero chunks as holes
+            if data != zeros[:len(data)]:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                os.write(dst_fd, data)
+            offset += len(data)
+    os.ftruncate(dst_fd, size)
+
+
+def clone_image(src, dst):
+    """
+    Copy an image file with the cheapest method the filesystem supports.
+
+    The methods are tried in order:
+
+    * 'reflink': the copy shares the extents of the source (XFS, btrfs),
+      which takes constant time whatever the image size;
+    * 'copy_file_range': the kernel copies the data, skipping the holes of
+      sparse images, without going through user space buffers;
+    * 'stream': the data is read and written in chunks, leaving holes where
+      the source has zeros.
+
+    :param src: Path of the image to copy.
+    :param dst: Path of the copy, overwritten if it exists.
+    :return: (method, elapsed seconds) tuple.
+    """
+    start = time.time()
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            size = os.fstat(src_fd).st_size
+            try:
+                fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+                return 'reflink', time.time() - start
+            except IOError, details:
+                if details.errno not in _UNSUPPORTED_ERRORS:
+                    raise
+            if _copy_file_range is not None:
+                try:
+                    _kernel_copy(src_fd, dst_fd, size)
+                    return 'copy_file_range', time.time() - start
+                except OSError, details:
+                    if details.errno not in _UNSUPPORTED_ERRORS:
+                        raise
+                    os.ftruncate(dst_fd, 0)
+            _stream_copy(src_fd, dst_fd, size)
+            return 'stream', time.time() - start
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
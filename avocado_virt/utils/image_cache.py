@@ -0,0 +1,289 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Cache of decompressed guest images.
+
+Restoring a guest image used to mean decompressing its ``.xz`` every time.
+Decompressed images are now kept in the avocado data dir, keyed by the
+SHA1 of the ``.xz`` they come from, so an image is only decompressed again
+when the ``.xz`` changes.  The SHA1 itself is only computed again when the
+size or modification time of the ``.xz`` change.
+
+Each cached image has a manifest with its size, modification time and a
+hash of its first and last MiB, which tells cheaply whether the image was
+modified since it was decompressed.  When the cached images take more than
+the quota, the least recently used ones are removed, except the ones
+being cloned.  The default quota holds one JeOS image.
+"""
+
+import os
+import json
+import time
+import pipes
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+from avocado.core import data_dir
+from avocado.utils import process
+from avocado.utils import path as utils_path
+from . import image
+
+log = logging.getLogger("avocado.test")
+
+#: Default maximum size of the cached images, in MiB (0: no cache)
+DEFAULT_QUOTA = 2048
+
+_PARTIAL_HASH_SIZE = 1 << 20
+
+
+def _read_json(path):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(data, tmp_file)
+    os.rename(tmp_path, path)
+
+
+def _hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as data_file:
+        while True:
+            data = data_file.read(1 << 20)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def _partial_hash(path):
+    """
+    Hash the size, the first and the last MiB of a file.
+    """
+    size = os.path.getsize(path)
+    sha1 = hashlib.sha1(str(size))
+    with open(path, 'rb') as data_file:
+        sha1.update(data_file.read(_PARTIAL_HASH_SIZE))
+        if size > _PARTIAL_HASH_SIZE:
+            data_file.seek(max(_PARTIAL_HASH_SIZE, size - _PARTIAL_HASH_SIZE))
+            sha1.update(data_file.read(_PARTIAL_HASH_SIZE))
+    return sha1.hexdigest()
+
+
+def decompress(compressed_file, image_file):
+    """
+    Decompress an ``.xz`` file with as many threads as there are CPUs.
+
+    Versions of xz without multi-threading support decompress it with a
+    single thread instead.
+    """
+    for threads in ('-T0 ', ''):
+        result = process.run('xz --decompress --stdout %s%s > %s' %
+                             (threads, pipes.quote(compressed_file),
+                              pipes.quote(image_file)),
+                             ignore_status=True, shell=True)
+        if result.exit_status == 0:
+            return
+    raise process.CmdError(result.command, result)
+
+
+class ImageCache(object):
+
+    """
+    Decompressed images, by SHA1 of the ``.xz`` they come from.
+    """
+
+    def __init__(self, quota=DEFAULT_QUOTA, cache_dir=None):
+        """
+        :param quota: maximum size of the cached images, in MiB
+        :param cache_dir: directory of the cache, by default in the avocado
+                          data dir
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(data_dir.get_data_dir(), 'cache',
+                                     'images')
+        self.cache_dir = utils_path.init_dir(cache_dir)
+        self.quota = quota
+        self._index_path = os.path.join(self.cache_dir, 'index.json')
+
+    def __repr__(self):
+        return '%s(cache_dir=%r, quota=%r)' % (self.__class__.__name__,
+                                               self.cache_dir, self.quota)
+
+    def _image_path(self, sha1):
+        return os.path.join(self.cache_dir, '%s.img' % sha1)
+
+    def _manifest_path(self, sha1):
+        return os.path.join(self.cache_dir, '%s.json' % sha1)
+
+    def _lock_image(self, sha1, shared=True):
+        """
+        Lock a cached image, shared while it is cloned, exclusive to evict
+        it.
+
+        :return: the locked file, to be closed to unlock, or None if the
+                 exclusive lock is held by someone else
+        """
+        lock_file = open(os.path.join(self.cache_dir, '%s.lock' % sha1), 'w')
+        if shared:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            return lock_file
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _checksum(self, compressed_file):
+        real_path = os.path.realpath(compressed_file)
+        stat = os.stat(real_path)
+        stamp = [stat.st_size, stat.st_mtime]
+        index = _read_json(self._index_path) or {}
+        entry = index.get(real_path)
+        if entry is not None and entry.get('stamp') == stamp:
+            return entry['sha1']
+        sha1 = _hash_file(real_path)
+        index[real_path] = {'stamp': stamp, 'sha1': sha1}
+        _write_json(self._index_path, index)
+        return sha1
+
+    def checksum(self, compressed_file):
+        """
+        Return the SHA1 of an ``.xz`` file, computed again only when its
+        size or modification time change.
+        """
+        with open(os.path.join(self.cache_dir, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            return self._checksum(compressed_file)
+
+    def _is_valid(self, sha1):
+        manifest = _read_json(self._manifest_path(sha1))
+        image_path = self._image_path(sha1)
+        if manifest is None or not os.path.isfile(image_path):
+            return False
+        stat = os.stat(image_path)
+        if [stat.st_size, stat.st_mtime] != [manifest.get('size'),
+                                             manifest.get('mtime')]:
+            return False
+        return _partial_hash(image_path) == manifest.get('partial_hash')
+
+    def _add(self, sha1, compressed_file):
+        image_path = self._image_path(sha1)
+        tmp_path = '%s.%s' % (image_path, os.getpid())
+        log.debug('Image cache: decompressing %s', compressed_file)
+        try:
+            decompress(compressed_file, tmp_path)
+            os.rename(tmp_path, image_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        stat = os.stat(image_path)
+        return {'source': os.path.realpath(compressed_file),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'partial_hash': _partial_hash(image_path)}
+
+    def _remove(self, sha1):
+        for path in (self._image_path(sha1), self._manifest_path(sha1)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used images until the quota is met.
+        Images being cloned are left alone.
+
+        :param keep: SHA1 of an image that must not be removed
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            sha1, ext = os.path.splitext(name)
+            if ext != '.json' or name == 'index.json':
+                continue
+            manifest = _read_json(os.path.join(self.cache_dir, name)) or {}
+            entries.append((manifest.get('last_used', 0), sha1,
+                            manifest.get('size', 0)))
+        total = sum(size for _, _, size in entries)
+        for _, sha1, size in sorted(entries):
+            if total <= self.quota * 1024 * 1024:
+                break
+            if sha1 == keep:
+                continue
+            lock_file = self._lock_image(sha1, shared=False)
+            if lock_file is None:
+                continue
+            try:
+                log.debug('Image cache: evicting %s', sha1)
+                self._remove(sha1)
+            finally:
+                lock_file.close()
+            total -= size
+
+    def restore(self, compressed_file, image_file):
+        """
+        Restore an image from the decompressed image of its ``.xz`` file,
+        decompressing it only if it is not cached yet.
+
+        The cached image is locked until it is cloned, so other processes
+        do not evict it in between.
+
+        :return: (method, seconds), see
+                 :func:`avocado_virt.utils.image.clone_image`
+        """
+        with open(os.path.join(self.cache_dir, 'lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            sha1 = self._checksum(compressed_file)
+            if self._is_valid(sha1):
+                manifest = _read_json(self._manifest_path(sha1))
+            else:
+                self._remove(sha1)
+                manifest = self._add(sha1, compressed_file)
+            manifest['last_used'] = time.time()
+            _write_json(self._manifest_path(sha1), manifest)
+            self.evict(keep=sha1)
+            # Evicting takes the cache lock first, so no one can evict the
+            # image before it is locked
+            image_lock = self._lock_image(sha1)
+        try:
+            return image.clone_image(self._image_path(sha1), image_file)
+        finally:
+            image_lock.close()
+
+
+def restore_image(compressed_file, image_file, quota=DEFAULT_QUOTA):
+    """
+    Restore a guest image from its ``.xz``.
+
+    :param compressed_file: path of the ``.xz`` file
+    :param image_file: path of the image to be restored
+    :param quota: maximum size of the image cache, in MiB (0 decompresses
+                  the image without caching it)
+    """
+    if not quota:
+        decompress(compressed_file, image_file)
+        return
+    method, elapsed = ImageCache(quota).restore(compressed_file, image_file)
+    log.debug('Image cache: restored %s (%s, %.3f s)', image_file, method,
+              elapsed)
@@ -0,0 +1,289 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Log files written from a background thread.
+
+The serial console and the QMP recording of a VM are written to a
+:class:`LogSink`, which queues the data and writes it in batches from its
+own thread, so a chatty guest does not slow down the thread reading its
+console.  The queue is bounded: past ``max_pending`` bytes, console data
+is dropped and a note says how much, while writers of streams that must
+be complete, such as QMP recordings, wait for the queue to drain.  Logs
+can be compressed on the fly with gzip, or with zstd when the
+``zstandard`` module is installed.
+"""
+
+import gzip
+import logging
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger("avocado.test")
+
+#: Default maximum size of the data queued and not written yet, in bytes
+DEFAULT_MAX_PENDING = 8 << 20
+
+#: Queued bytes from which the writer thread is woken up without waiting
+#: for a flush
+BATCH_SIZE = 1 << 16
+
+#: File name suffixes of the compression methods
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+class _ZstdFile(object):
+
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._compressor = zstandard.ZstdCompressor().compressobj()
+
+    def write(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def flush(self):
+        # Compressed blocks are flushed on close only, flushing them
+        # every time would hurt the compression ratio
+        pass
+
+    def close(self):
+        self._file.write(self._compressor.flush())
+        self._file.close()
+
+
+class _GzipFile(object):
+
+    def __init__(self, path):
+        self._file = gzip.open(path, 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._file.close()
+
+
+class LogStream(object):
+
+    """
+    One file of a :class:`LogSink`, with the write(), flush() and close()
+    methods of a file.
+    """
+
+    def __init__(self, sink, path, log_file, drop=True):
+        self.path = path
+        #: Whether data is dropped, rather than waited for, when too much
+        #: is queued
+        self.drop = drop
+        #: Bytes dropped because too much data was queued
+        self.dropped = 0
+        self._sink = sink
+        self._file = log_file
+        #: Bytes dropped since the last note about it
+        self._dropping = 0
+
+    def __repr__(self):
+        return '%s(path=%r)' % (self.__class__.__name__, self.path)
+
+    def write(self, data):
+        self._sink.write(self, data)
+
+    def flush(self):
+        """
+        Have the queued data written, without waiting for it.
+        """
+        self._sink.flush()
+
+    def close(self):
+        """
+        Close the file once the data queued before is written.
+        """
+        self._sink.write(self, None)
+
+
+class LogSink(object):
+
+    """
+    Writes the log files of a VM from a background thread.
+    """
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        """
+        :param max_pending: maximum size of the data queued and not
+                            written yet, in bytes
+        """
+        self.max_pending = max_pending
+        self._batch_size = min(BATCH_SIZE, max_pending // 2)
+        self._cond = threading.Condition()
+        #: (stream, data) to write, data is None to close the stream
+        self._pending = []
+        self._pending_size = 0
+        self._flush = False
+        self._closed = False
+        self._thread = None
+        self._streams = []
+
+    def __repr__(self):
+        return '%s(pending=%d)' % (self.__class__.__name__,
+                                   self._pending_size)
+
+    def open(self, path, compression=None, drop=True):
+        """
+        Open a log file.
+
+        :param path: path of the file, to which the suffix of the
+                     compression method is added
+        :param compression: None, 'gzip' or 'zstd' (gzip is used instead
+                            when the zstandard module is not installed)
+        :param drop: whether data written while ``max_pending`` bytes are
+                     queued is dropped, False blocks the writer until the
+                     queue drains, for files that must be complete
+        :rtype: :class:`LogStream`
+        """
+        if compression == 'zstd' and zstandard is None:
+            log.warning('zstandard module not installed, compressing %s '
+                        'with gzip', path)
+            compression = 'gzip'
+        if compression == 'zstd':
+            path += COMPRESSION_SUFFIXES[compression]
+            log_file = _ZstdFile(path)
+        elif compression == 'gzip':
+            path += COMPRESSION_SUFFIXES[compression]
+            log_file = _GzipFile(path)
+        elif not compression:
+            log_file = open(path, 'w')
+        else:
+            raise ValueError('Unknown log compression %r' % compression)
+        stream = LogStream(self, path, log_file, drop)
+        with self._cond:
+            self._streams.append(stream)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='LogSink')
+                self._thread.daemon = True
+                self._thread.start()
+        return stream
+
+    def write(self, stream, data):
+        """
+        Queue data to be written to a stream, None closes the stream.
+
+        When too much data is queued, the data is dropped or the call
+        waits for the queue to drain, depending on the ``drop`` argument
+        the stream was opened with.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            if data is not None:
+                # pylint: disable=W0212
+                while (not stream.drop and self._pending and
+                       self._pending_size + len(data) > self.max_pending):
+                    self._flush = True
+                    self._cond.notify_all()
+                    self._cond.wait()
+                    if self._closed:
+                        return
+                if (stream.drop and
+                        self._pending_size + len(data) > self.max_pending):
+                    stream.dropped += len(data)
+                    stream._dropping += len(data)
+                    return
+                if stream._dropping:
+                    note = '\n[%d bytes of log dropped]\n' % stream._dropping
+                    self._pending.append((stream, note))
+                    self._pending_size += len(note)
+                    stream._dropping = 0
+                self._pending_size += len(data)
+            self._pending.append((stream, data))
+            if data is None:
+                self._flush = True
+            if self._flush or self._pending_size >= self._batch_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        """
+        Have the queued data written, without waiting for it.
+        """
+        with self._cond:
+            if self._pending:
+                self._flush = True
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._closed or self._flush or
+                           self._pending_size >= self._batch_size):
+                    self._cond.wait()
+                pending = self._pending
+                self._pending = []
+                self._pending_size = 0
+                self._flush = False
+                closed = self._closed
+                # Wake up the writers waiting for the queue to drain
+                self._cond.notify_all()
+            self._write(pending)
+            if closed:
+                for stream in self._streams:
+                    _write_stream(stream, [], close=True)
+                return
+
+    @staticmethod
+    def _write(pending):
+        # One write per stream and batch
+        chunks = {}
+        for stream, data in pending:
+            if data is not None:
+                chunks.setdefault(stream, []).append(data)
+            else:
+                _write_stream(stream, chunks.pop(stream, []), close=True)
+        for stream, stream_chunks in chunks.items():
+            _write_stream(stream, stream_chunks)
+
+    def close(self):
+        """
+        Write the queued data, close the files and stop the thread.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+def _write_stream(stream, chunks, close=False):
+    # pylint: disable=W0212
+    log_file = stream._file
+    if log_file is None:
+        return
+    try:
+        if chunks:
+            log_file.write(''.join(chunks))
+        if close:
+            log_file.close()
+            stream._file = None
+        else:
+            log_file.flush()
+    except (IOError, OSError), details:
+        log.error('Could not write log %s: %s', stream.path, details)
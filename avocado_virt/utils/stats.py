@@ -0,0 +1,111 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Small helpers to summarize measurements taken during tests.
+"""
+
+
+def percentile(values, pct):
+    """
+    Compute a percentile, interpolating between the closest ranks.
+
+    :param values: sequence of numbers
+    :param pct: percentile, between 0 and 100
+    :return: the percentile, or None if there are no values
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(values, percentiles=(50, 90, 99)):
+    """
+    Summarize a series of measurements.
+
+    :return: dict with count, min, max, mean and the requested percentiles
+             (as 'p50', 'p90'...)
+    """
+    values = list(values)
+    summary = {'count': len(values)}
+    if not values:
+        return summary
+    summary['min'] = min(values)
+    summary['max'] = max(values)
+    summary['mean'] = sum(values) / float(len(values))
+    for pct in percentiles:
+        summary['p%s' % pct] = percentile(values, pct)
+    return summary
+
+
+class Log2Histogram(object):
+
+    """
+    Histogram with power of two buckets.
+
+    Keeps a constant amount of memory whatever the number of samples:
+    bucket ``n`` counts the values in ``[2 ** (n - 1), 2 ** n)``, bucket 0
+    the values below 1.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = 0
+        value = int(value)
+        while value:
+            value >>= 1
+            bucket += 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, pct):
+        """
+        Estimate a percentile as the upper bound of the bucket holding it.
+        """
+        if not self.count:
+            return None
+        threshold = self.count * pct / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= threshold:
+                return min(2 ** bucket, self.max)
+        return self.max
+
+    def to_dict(self, percentiles=(50, 90, 99)):
+        data = {'count': self.count,
+                'total': self.total,
+                'min': self.min,
+                'max': self.max,
+                'buckets': dict(('<%d' % 2 ** bucket, count)
+                                for bucket, count in self.buckets.items())}
+        if self.count:
+            data['mean'] = self.total / float(self.count)
+        for pct in percentiles:
+            data['p%s' % pct] = self.percentile(pct)
+        return data
@@ -0,0 +1,57 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Whether videos can be encoded, see :mod:`avocado_virt.utils.video`.
+
+Importing GStreamer through ``gi`` takes a good part of a second, which
+the avocado command line should not pay just to list its options.  The
+modules and the GStreamer typelib are looked for instead of imported.
+"""
+
+import os
+import glob
+import pkgutil
+
+_TYPELIB = 'Gst-1.0.typelib'
+
+_TYPELIB_DIRS = ['/usr/lib*/girepository-1.0',
+                 '/usr/lib/*/girepository-1.0',
+                 '/usr/local/lib*/girepository-1.0',
+                 '/usr/local/lib/*/girepository-1.0']
+
+_supported = None
+
+
+def _has_typelib():
+    dirs = [path for path in os.environ.get('GI_TYPELIB_PATH',
+                                            '').split(os.pathsep) if path]
+    for pattern in _TYPELIB_DIRS:
+        dirs.extend(glob.glob(pattern))
+    for typelib_dir in dirs:
+        if os.path.isfile(os.path.join(typelib_dir, _TYPELIB)):
+            return True
+    return False
+
+
+def is_supported():
+    """
+    Whether PIL, the GObject introspection bindings and GStreamer 1.0 are
+    installed, without importing them.
+    """
+    global _supported
+    if _supported is None:
+        _supported = (pkgutil.find_loader('PIL') is not None and
+                      pkgutil.find_loader('gi') is not None and
+                      _has_typelib())
+    return _supported
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Benchmark of the guest image download against a local HTTP server.
+
+Compares downloading, hashing and then decompressing an ``.xz`` file with
+the streaming pipeline of avocado_virt.utils.fetch, and checks that a
+download cut halfway through is resumed with a Range request.
+"""
+
+import BaseHTTPServer
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from avocado_virt.utils import fetch   # pylint: disable=C0413
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Serves one file, with Range support, optionally cutting the connection
+    after ``server.cut_at`` bytes of the file.
+    """
+
+    def do_GET(self):
+        data = self.server.data
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        end = len(data)
+        if self.server.cut_at is not None and start < self.server.cut_at:
+            end = self.server.cut_at
+            self.server.cut_at = None
+        self.server.ranges.append(start)
+        chunk = 1 << 16
+        for offset in xrange(start, end, chunk):
+            self.wfile.write(data[offset:min(offset + chunk, end)])
+            if self.server.rate:
+                time.sleep(chunk / self.server.rate)
+        if end < len(data):
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(data, rate=0.0):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.data = data
+    server.rate = rate
+    server.cut_at = None
+    server.ranges = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/image.xz' % server.server_port
+
+
+def make_image(tmpdir, size):
+    """
+    :return: (data of the .xz, data of the image)
+    """
+    image = os.path.join(tmpdir, 'source.img')
+    with open(image, 'wb') as image_file:
+        # Half random, half zeroes, as compressible as a guest image
+        for _ in xrange(size // (2 << 20)):
+            image_file.write(os.urandom(1 << 20))
+            image_file.write('\0' * (1 << 20))
+    subprocess.check_call(['xz', '-0', '-T0', '--keep', image])
+    with open(image, 'rb') as image_file:
+        image_data = image_file.read()
+    with open(image + '.xz', 'rb') as xz_file:
+        xz_data = xz_file.read()
+    return xz_data, image_data
+
+
+def sequential(url, compressed_path, image_path):
+    response = urllib2.urlopen(url)
+    with open(compressed_path, 'wb') as compressed_file:
+        shutil.copyfileobj(response, compressed_file, 1 << 20)
+    sha1 = hashlib.sha1()
+    with open(compressed_path, 'rb') as compressed_file:
+        for data in iter(lambda: compressed_file.read(1 << 20), ''):
+            sha1.update(data)
+    with open(image_path, 'wb') as image_file:
+        subprocess.check_call(['xz', '--decompress', '--stdout',
+                               compressed_path], stdout=image_file)
+    return sha1.hexdigest()
+
+
+def check_image(image_path, image_data):
+    with open(image_path, 'rb') as image_file:
+        if image_file.read() != image_data:
+            raise AssertionError('%s does not match the source image' %
+                                 image_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=128,
+                        help='Size of the image, in MiB')
+    parser.add_argument('--rate', type=float, default=64,
+                        help='Download rate of the server, in MiB/s '
+                             '(0 for unlimited)')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='avocado-virt-bench-')
+    try:
+        xz_data, image_data = make_image(tmpdir, args.size << 20)
+        sha1 = hashlib.sha1(xz_data).hexdigest()
+        server, url = serve(xz_data, args.rate * (1 << 20))
+        compressed_path = os.path.join(tmpdir, 'image.xz')
+        image_path = os.path.join(tmpdir, 'image.img')
+
+        start = time.time()
+        if sequential(url, compressed_path, image_path) != sha1:
+            raise AssertionError('SHA1 mismatch')
+        print('%-30s %8.3f s' % ('download, hash, decompress',
+                                 time.time() - start))
+        check_image(image_path, image_data)
+        os.remove(compressed_path)
+        os.remove(image_path)
+
+        start = time.time()
+        fetch.fetch_image(url, compressed_path, image_path, sha1)
+        print('%-30s %8.3f s' % ('streaming', time.time() - start))
+        check_image(image_path, image_data)
+        os.remove(compressed_path)
+        os.remove(image_path)
+
+        server.cut_at = len(xz_data) // 2
+        del server.ranges[:]
+        try:
+            fetch.fetch_image(url, compressed_path, image_path, sha1)
+        except fetch.IncompleteFetchError:
+            pass
+        else:
+            raise AssertionError('Cut download did not fail')
+        fetch.fetch_image(url, compressed_path, image_path, sha1)
+        check_image(image_path, image_data)
+        print('%-30s ranges requested: %s' % ('resume', server.ranges))
+        server.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Micro-benchmark of the QMP clients against a local fake QMP server.
+
+Measures how many replies per second the monitor classes can read, for
+small replies (such as 'query-status') and for large ones (such as
+'query-qmp-schema' or 'query-block' on VMs with many disks).
+
+With --replay, the commands of a QMP recording (see the 'record' param of
+/plugins/virt/qemu/monitor) are sent to a fake monitor replaying it
+instead, including the events QEMU sent while it was recorded.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from avocado_virt.qemu import monitor   # pylint: disable=C0413
+from avocado_virt.qemu import fake_monitor   # pylint: disable=C0413
+
+
+class FakeQMPServer(threading.Thread):
+
+    """
+    Answers every command with the same canned reply.
+    """
+
+    def __init__(self, address, reply_size):
+        threading.Thread.__init__(self, name='FakeQMPServer')
+        self.daemon = True
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(address)
+        self.listener.listen(1)
+        entry = {'name': 'x' * 16, 'meta-type': 'object', 'members': []}
+        count = max(1, reply_size // len(json.dumps(entry)))
+        self.payload = [entry] * count
+
+    def run(self):
+        conn, _ = self.listener.accept()
+        conn.sendall(json.dumps({'QMP': {'version': {}, 'capabilities': []}}) +
+                     '\r\n')
+        decoder = json.JSONDecoder()
+        data = ''
+        while True:
+            try:
+                received = conn.recv(65536)
+            except socket.error:
+                break
+            if not received:
+                break
+            # Commands arrive back to back, possibly split across reads
+            data += received
+            idx = 0
+            replies = []
+            while idx < len(data):
+                try:
+                    cmd, end = decoder.raw_decode(data, idx)
+                except ValueError:
+                    break
+                idx = end
+                resp = {'return': {}}
+                if cmd['execute'] != 'qmp_capabilities':
+                    resp['return'] = self.payload
+                if 'id' in cmd:
+                    resp['id'] = cmd['id']
+                replies.append(json.dumps(resp) + '\r\n')
+            data = data[idx:]
+            if replies:
+                conn.sendall(''.join(replies))
+        conn.close()
+
+
+def bench(client_class, address, count, window, reply_size):
+    server = FakeQMPServer(address, reply_size)
+    server.start()
+    client = client_class(address)
+    client.connect()
+    start = time.time()
+    if window <= 1:
+        for _ in xrange(count):
+            client.cmd('query-qmp-schema')
+    else:
+        sent = 0
+        in_flight = []
+        while sent < count or in_flight:
+            while sent < count and len(in_flight) < window:
+                in_flight.append(client.cmd_async('query-qmp-schema'))
+                sent += 1
+            in_flight.pop(0).result()
+    elapsed = time.time() - start
+    client.close()
+    os.unlink(address)
+    return count / elapsed
+
+
+def bench_replay(client_class, address, count, replay):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(1)
+    fake = fake_monitor.FakeQEMUMonitor(replay)
+
+    def serve():
+        conn, _ = listener.accept()
+        listener.close()
+        fake.serve(conn)
+
+    server = threading.Thread(target=serve, name='FakeQEMUMonitor')
+    server.daemon = True
+    server.start()
+    commands = [exchange.cmd for exchange in replay.exchanges
+                if exchange.name not in ('qmp_capabilities', 'quit')]
+    if not commands:
+        commands = [{'execute': 'query-status'}]
+    client = client_class(address)
+    client.connect()
+    start = time.time()
+    for index in xrange(count):
+        qmp_cmd = dict(commands[index % len(commands)])
+        qmp_cmd.pop('id', None)
+        client.cmd_obj(qmp_cmd)
+        client.get_events()
+        client.clear_events()
+    elapsed = time.time() - start
+    client.cmd('quit')
+    client.close()
+    os.unlink(address)
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000,
+                        help='Number of commands per run')
+    parser.add_argument('--sizes', default='64,65536,1048576',
+                        help='Comma separated reply sizes, in bytes')
+    parser.add_argument('--window', type=int, default=16,
+                        help='Commands in flight for the pipelined client')
+    parser.add_argument('--replay', metavar='RECORDING',
+                        help='Replay the commands of a QMP recording')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='avocado-virt-bench-')
+    try:
+        if args.replay:
+            entries = fake_monitor.load_recording(args.replay)
+            for name, client_class in (
+                    ('QEMUMonitorProtocol', monitor.QEMUMonitorProtocol),
+                    ('QEMUMonitorProtocolAsync',
+                     monitor.QEMUMonitorProtocolAsync)):
+                address = os.path.join(tmpdir, 'qmp.sock')
+                rate = bench_replay(client_class, address, args.count,
+                                    fake_monitor.QMPReplay(entries))
+                print('%-40s replay: %10.1f commands/s' % (name, rate))
+            return
+        runs = [('QEMUMonitorProtocol', monitor.QEMUMonitorProtocol, 1),
+                ('QEMUMonitorProtocolAsync', monitor.QEMUMonitorProtocolAsync,
+                 1),
+                ('QEMUMonitorProtocolAsync (window %d)' % args.window,
+                 monitor.QEMUMonitorProtocolAsync, args.window)]
+        for size in [int(s) for s in args.sizes.split(',')]:
+            count = max(10, args.count * 64 // max(size, 64))
+            for name, client_class, window in runs:
+                address = os.path.join(tmpdir, 'qmp.sock')
+                rate = bench(client_class, address, count, window, size)
+                print('%-40s reply %8d bytes: %10.1f replies/s' %
+                      (name, size, rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
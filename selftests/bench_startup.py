@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+"""
+Benchmark of the time the virt plugin adds to the avocado startup.
+
+Every avocado command, including 'avocado list', imports and configures
+the virt plugin.  Each run starts a new interpreter importing avocado
+alone, then one also importing the plugin and building its command line
+options, and reports the difference.  With --max, exits with an error if
+the plugin adds more than that many milliseconds (median).
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, BASE_DIR)
+
+from avocado_virt.utils import stats   # pylint: disable=C0413
+
+BASELINE = 'import avocado.core.settings'
+
+PLUGIN = '''
+import argparse
+import avocado.core.settings
+from avocado_virt.plugins import virt
+parser = argparse.ArgumentParser()
+parser.subcommands = parser.add_subparsers()
+parser.subcommands.add_parser('run')
+virt.VirtRun().configure(parser)
+'''
+
+
+def run(code):
+    """
+    :return: seconds taken by a new interpreter running code
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([BASE_DIR] +
+                                        [p for p in [env.get('PYTHONPATH')]
+                                         if p])
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Number of interpreters started for each case')
+    parser.add_argument('--max', type=float, default=None,
+                        help='Maximum time added by the plugin, in ms')
+    args = parser.parse_args()
+
+    baseline = []
+    plugin = []
+    for _ in xrange(args.runs):
+        # Interleaved, so both cases see the same system noise
+        baseline.append(run(BASELINE) * 1000)
+        plugin.append(run(PLUGIN) * 1000)
+    baseline = stats.summarize(baseline)
+    plugin = stats.summarize(plugin)
+    added = plugin['p50'] - baseline['p50']
+    line = '%-30s p50 %8.1f ms  p90 %8.1f ms'
+    print(line % ('avocado', baseline['p50'], baseline['p90']))
+    print(line % ('avocado + virt plugin', plugin['p50'], plugin['p90']))
+    print('%-30s %12.1f ms' % ('added by the virt plugin', added))
+    if args.max is not None and added > args.max:
+        sys.exit('The virt plugin adds %.1f ms to the startup, more than '
+                 '%.1f ms' % (added, args.max))
+
+
+if __name__ == '__main__':
+    main()
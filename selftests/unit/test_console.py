@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt.qemu import console   # pylint: disable=C0413
+
+
+class FakeLog(object):
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SerialConsoleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        address = os.path.join(self.tmpdir, 'serial.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        listener.listen(1)
+        self.log = FakeLog()
+        self.lines = []
+        self.console = console.SerialConsole(
+            address, output_func=lambda name, line: self.lines.append(line),
+            output_params=('serial',), buffer_size=1024, log=self.log)
+        self.guest, _ = listener.accept()
+        listener.close()
+
+    def tearDown(self):
+        self.console.close()
+        self.guest.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_rolling_buffer(self):
+        for seq in xrange(500):
+            self.guest.sendall('line %d\r\n' % seq)
+        self.console.read_until('line 499\r\n', timeout=5)
+        self.guest.sendall('login: ')
+        self.assertEqual(self.console.read_until('login: ', timeout=5),
+                         'login: ')
+        # Only the end of the output is kept
+        for _ in xrange(8):
+            self.guest.sendall('x' * 1000)
+        self.guest.sendall('END')
+        text = self.console.read_until('END', timeout=5)
+        self.assertTrue(text.endswith('xxxEND'))
+        self.assertTrue(len(text) <= 2 * 1024)
+
+    def test_log(self):
+        self.guest.sendall('hello\r\nwor')
+        self.guest.sendall('ld\r\n$ ')
+        self.assertEqual(self.console.read_up_to_prompt(timeout=5),
+                         'hello\r\nworld\r\n$ ')
+        self.assertEqual(self.lines, ['hello', 'world'])
+        logged = ''.join(self.log.writes).splitlines()
+        self.assertEqual([re.sub(r'^[\d\- :]+: ', '', line)
+                          for line in logged], ['hello', 'world'])
+
+
+if __name__ == '__main__':
+    unittest.main()
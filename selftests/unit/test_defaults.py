@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt import defaults   # pylint: disable=C0413
+
+
+class BinaryCacheTest(unittest.TestCase):
+
+    """
+    QEMU binary paths cached in the data dir.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        self.cache_path = os.path.join(self.tmpdir, 'cache', 'binaries.json')
+        self._environ = dict(os.environ)
+        self.qemu_img = self.binary('qemu-img')
+        os.environ['QEMU_IMG'] = self.qemu_img
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tmpdir)
+
+    def binary(self, name):
+        binary = os.path.join(self.tmpdir, name)
+        open(binary, 'w').close()
+        os.chmod(binary, 0755)
+        return binary
+
+    def find(self):
+        return defaults._find_binary('qemu_img_bin', self.cache_path)
+
+    def cached(self):
+        with open(self.cache_path) as cache_file:
+            return json.load(cache_file)['qemu_img_bin']['path']
+
+    def test_cached(self):
+        self.assertEqual(self.find(), self.qemu_img)
+        self.assertEqual(self.cached(), self.qemu_img)
+        # Found in the cache, even if the environment would not tell it
+        cached = self.binary('cached-qemu-img')
+        with open(self.cache_path, 'w') as cache_file:
+            json.dump({'qemu_img_bin': {'env': [os.environ.get('PATH'),
+                                                self.qemu_img],
+                                        'path': cached}}, cache_file)
+        self.assertEqual(self.find(), cached)
+
+    def test_env_changed(self):
+        self.find()
+        other = self.binary('other-qemu-img')
+        os.environ['QEMU_IMG'] = other
+        self.assertEqual(self.find(), other)
+        self.assertEqual(self.cached(), other)
+
+    def test_binary_gone(self):
+        cached = self.binary('cached-qemu-img')
+        self.find()
+        with open(self.cache_path, 'w') as cache_file:
+            json.dump({'qemu_img_bin': {'env': [os.environ.get('PATH'),
+                                                self.qemu_img],
+                                        'path': cached}}, cache_file)
+        os.remove(cached)
+        self.assertEqual(self.find(), self.qemu_img)
+        self.assertEqual(self.cached(), self.qemu_img)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt.qemu import devices   # pylint: disable=C0413
+
+START_PORT = 47000
+BLOCK_SIZE = 16
+
+
+class FakeParams(object):
+
+    """
+    Test params using the Python interpreter as the QEMU binary.
+    """
+
+    @staticmethod
+    def get(key, path=None, default=None):
+        # pylint: disable=W0613
+        if key == 'qemu_bin':
+            return sys.executable
+        return default
+
+
+class PortTrackerTest(unittest.TestCase):
+
+    """
+    Blocks of ports reserved by several processes in the shared table.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        table_path = os.path.join(self.tmpdir, 'blocks.json')
+        self._table_path = devices.PortTracker.__dict__['_table_path']
+        devices.PortTracker._table_path = staticmethod(lambda: table_path)
+        self.tracker = self.new_tracker()
+
+    def tearDown(self):
+        # pylint: disable=W0212
+        self.tracker._release_blocks()
+        devices.PortTracker._table_path = self._table_path
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def new_tracker():
+        tracker = devices.PortTracker()
+        # The state is shared by all the trackers of the process
+        tracker.__dict__.clear()
+        tracker = devices.PortTracker()
+        tracker.configure(START_PORT, START_PORT + 4 * BLOCK_SIZE - 1,
+                          BLOCK_SIZE)
+        return tracker
+
+    def in_child(self, wait):
+        """
+        Hand out a port in a child process.
+
+        :param wait: whether the child waits to be told to exit, rather
+                     than exiting right away without releasing its block
+        :return: (port, function telling the child to exit)
+        """
+        port_read, port_write = os.pipe()
+        exit_read, exit_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(port_read)
+                os.close(exit_write)
+                port = self.new_tracker().find_free_port()
+                os.write(port_write, '%d\n' % port)
+                if wait:
+                    os.read(exit_read, 1)
+            finally:
+                os._exit(0)
+        os.close(port_write)
+        os.close(exit_read)
+        port = int(os.fdopen(port_read).readline())
+
+        def stop():
+            os.close(exit_write)
+            os.waitpid(pid, 0)
+
+        if not wait:
+            stop()
+            return port, None
+        return port, stop
+
+    def test_block(self):
+        ports = [self.tracker.find_free_port() for _ in xrange(BLOCK_SIZE)]
+        self.assertEqual(ports, range(START_PORT, START_PORT + BLOCK_SIZE))
+        # The next port comes from a new block
+        self.assertEqual(self.tracker.find_free_port(),
+                         START_PORT + BLOCK_SIZE)
+
+    def test_release(self):
+        port = self.tracker.find_free_port()
+        self.tracker.release_port(port)
+        self.assertEqual(self.tracker.find_free_port(), port)
+
+    def test_other_process(self):
+        child_port, stop = self.in_child(wait=True)
+        try:
+            self.assertEqual(child_port, START_PORT)
+            ports = set(self.tracker.find_free_port()
+                        for _ in xrange(2 * BLOCK_SIZE))
+            self.assertEqual(ports,
+                             set(xrange(START_PORT + BLOCK_SIZE,
+                                        START_PORT + 3 * BLOCK_SIZE)))
+        finally:
+            stop()
+
+    def test_reclaim(self):
+        child_port, _ = self.in_child(wait=False)
+        self.assertEqual(child_port, START_PORT)
+        # The child exited without releasing its block
+        self.assertEqual(self.tracker.find_free_port(), START_PORT)
+
+    def test_exhausted(self):
+        for _ in xrange(4 * BLOCK_SIZE):
+            self.tracker.find_free_port()
+        self.assertRaises(devices.PortTrackerError,
+                          self.tracker.find_free_port)
+
+
+class ReadconfigTest(unittest.TestCase):
+
+    """
+    Options of the command line moved to a -readconfig file.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        self.config_path = os.path.join(self.tmpdir, 'qemu.cfg')
+        self.devices = devices.QemuDevices(FakeParams())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def readconfig(self, *cmdlines):
+        for cmdline in cmdlines:
+            self.devices.add_device('generic', cmdline=cmdline)
+        args = self.devices.get_readconfig_args(self.config_path)
+        with open(self.config_path) as config_file:
+            sections = config_file.read().split('\n\n')[1:]
+        return args, [section.strip() for section in sections]
+
+    def test_sections(self):
+        args, sections = self.readconfig(
+            '-chardev socket,id=qmp,path=/tmp/qmp.sock',
+            '-mon chardev=qmp,mode=control',
+            '-chardev socket,id=serial0,path=/tmp/serial.sock,server,nowait',
+            '-drive file=/tmp/disk.qcow2,if=none,id=drive0',
+            '-device virtio-blk-pci,drive=drive0,id=disk0',
+            '-m 512')
+        self.assertEqual(args, [sys.executable, '-readconfig',
+                                self.config_path, '-m', '512'])
+        self.assertEqual(sections, [
+            '[chardev "qmp"]\n'
+            '  backend = "socket"\n'
+            '  path = "/tmp/qmp.sock"',
+            '[mon]\n'
+            '  chardev = "qmp"\n'
+            '  mode = "control"',
+            '[chardev "serial0"]\n'
+            '  backend = "socket"\n'
+            '  path = "/tmp/serial.sock"\n'
+            '  server = "on"\n'
+            '  wait = "off"',
+            '[drive "drive0"]\n'
+            '  file = "/tmp/disk.qcow2"\n'
+            '  if = "none"',
+            '[device "disk0"]\n'
+            '  driver = "virtio-blk-pci"\n'
+            '  drive = "drive0"'])
+
+    def test_kept_on_cmdline(self):
+        args, sections = self.readconfig(
+            '-drive "file=/tmp/a,,b.qcow2,if=none,id=drive0"',
+            "-device 'virtio-blk-pci,serial=\"x\",id=disk0'",
+            '-netdev user,id=net0')
+        self.assertEqual(args, [sys.executable, '-readconfig',
+                                self.config_path,
+                                '-drive', 'file=/tmp/a,,b.qcow2,if=none,'
+                                'id=drive0',
+                                '-device', 'virtio-blk-pci,serial="x",'
+                                'id=disk0'])
+        self.assertEqual(sections, ['[netdev "net0"]\n'
+                                    '  type = "user"'])
+
+
+if __name__ == '__main__':
+    unittest.main()
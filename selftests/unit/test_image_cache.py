@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt.utils import image_cache   # pylint: disable=C0413
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    """
+    Decompressed images cached by SHA1 of their ``.xz``.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        self.cache = image_cache.ImageCache(
+            quota=0, cache_dir=os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compressed(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as image_file:
+            image_file.write(data)
+        subprocess.check_call(['xz', path])
+        return path + '.xz'
+
+    def restore(self, compressed_file):
+        image_file = os.path.join(self.tmpdir, 'image')
+        self.cache.restore(compressed_file, image_file)
+        with open(image_file) as restored:
+            return restored.read()
+
+    def cached(self, compressed_file):
+        sha1 = self.cache.checksum(compressed_file)
+        return os.path.isfile(os.path.join(self.cache.cache_dir,
+                                           '%s.img' % sha1))
+
+    def test_restore(self):
+        first = self.compressed('first', 'first image')
+        self.assertEqual(self.restore(first), 'first image')
+        self.assertTrue(self.cached(first))
+        with open(os.path.join(self.tmpdir, 'image'), 'w') as image_file:
+            image_file.write('modified')
+        self.assertEqual(self.restore(first), 'first image')
+
+    def test_evict(self):
+        first = self.compressed('first', 'first image')
+        second = self.compressed('second', 'second image')
+        self.restore(first)
+        self.assertEqual(self.restore(second), 'second image')
+        self.assertFalse(self.cached(first))
+        self.assertTrue(self.cached(second))
+
+    def test_evict_locked(self):
+        first = self.compressed('first', 'first image')
+        second = self.compressed('second', 'second image')
+        self.restore(first)
+        sha1 = self.cache.checksum(first)
+        # Another process cloning the first image
+        lock_file = self.cache._lock_image(sha1)   # pylint: disable=W0212
+        try:
+            self.restore(second)
+            self.assertTrue(self.cached(first))
+        finally:
+            lock_file.close()
+        self.restore(second)
+        self.assertFalse(self.cached(first))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt.utils import log_sink   # pylint: disable=C0413
+
+
+class SlowFile(object):
+
+    """
+    File taking some time to write, for the queue to fill up.
+    """
+
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        time.sleep(0.01)
+        self.data.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class LogSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        self.sink = log_sink.LogSink(max_pending=256)
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_write(self):
+        stream = self.sink.open(self.path('plain.log'))
+        stream.write('hello\n')
+        stream.close()
+        compressed = self.sink.open(self.path('compressed.log'), 'gzip')
+        compressed.write('hello\n')
+        self.sink.close()
+        self.assertEqual(open(self.path('plain.log')).read(), 'hello\n')
+        self.assertEqual(compressed.path, self.path('compressed.log.gz'))
+        self.assertEqual(gzip.open(compressed.path).read(), 'hello\n')
+
+    def test_drop(self):
+        stream = self.sink.open(self.path('console.log'))
+        stream.write('x' * 300)
+        stream.write('end\n')
+        self.sink.close()
+        self.assertEqual(stream.dropped, 300)
+        self.assertEqual(open(self.path('console.log')).read(),
+                         '\n[300 bytes of log dropped]\nend\n')
+
+    def test_back_pressure(self):
+        # The writer waits for the slow file rather than dropping data
+        stream = self.sink.open(self.path('qmp.jsonl'), drop=False)
+        stream._file = slow_file = SlowFile()   # pylint: disable=W0212
+        lines = ['%05d %s\n' % (seq, 'x' * 40) for seq in xrange(100)]
+        writer = threading.Thread(target=lambda: map(stream.write, lines))
+        writer.start()
+        writer.join(10)
+        self.assertFalse(writer.is_alive())
+        self.sink.close()
+        self.assertEqual(stream.dropped, 0)
+        self.assertEqual(''.join(slow_file.data), ''.join(lines))
+        # Too much was written for one batch
+        self.assertTrue(len(slow_file.data) > 1)
+        self.assertTrue(max(len(data) for data in slow_file.data) <= 256)
+
+
+if __name__ == '__main__':
+    unittest.main()
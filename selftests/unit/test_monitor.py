@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt.qemu import monitor   # pylint: disable=C0413
+
+
+class QMPStreamReaderTest(unittest.TestCase):
+
+    """
+    Messages split across reads, or several of them in one read.
+    """
+
+    def setUp(self):
+        self.qemu, sock = socket.socketpair()
+        self.reader = monitor.QMPStreamReader(sock, bufsize=16)
+
+    def tearDown(self):
+        self.reader.sock.close()
+        self.qemu.close()
+
+    def test_fragmented(self):
+        data = json.dumps({'return': {'status': 'running'}}) + '\r\n'
+        for char in data[:-1]:
+            self.qemu.sendall(char)
+            self.reader.fill()
+            self.assertEqual(self.reader.get_messages(), [])
+        self.qemu.sendall(data[-1])
+        self.assertEqual(self.reader.read_message(),
+                         {'return': {'status': 'running'}})
+
+    def test_several_messages(self):
+        events = [{'event': 'STOP', 'data': {'seq': seq}}
+                  for seq in xrange(10)]
+        data = ''.join(json.dumps(event) + '\r\n' for event in events)
+        self.qemu.sendall(data[:25])
+        self.qemu.sendall(data[25:])
+        self.qemu.close()
+        received = []
+        while True:
+            msg = self.reader.read_message()
+            if msg is None:
+                break
+            received.append(msg)
+        self.assertEqual(received, events)
+
+    def test_sizes(self):
+        data = json.dumps({'return': {}})
+        self.qemu.sendall(data + '\r\n' + data + '\n')
+        messages = []
+        while len(messages) < 2:
+            self.reader.fill()
+            messages.extend(self.reader.get_messages())
+        self.assertEqual(messages, [({'return': {}}, len(data))] * 2)
+
+
+class QMPEventStoreTest(unittest.TestCase):
+
+    """
+    Caps of the pending events, and the counts of the dropped ones.
+    """
+
+    @staticmethod
+    def event(name, seq):
+        return {'event': name, 'data': {'seq': seq}}
+
+    def test_order(self):
+        store = monitor.QMPEventStore()
+        events = [self.event(name, seq)
+                  for seq, name in enumerate(['STOP', 'RESUME', 'STOP'])]
+        for event in events:
+            store.append(event)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(list(store), events)
+        self.assertEqual(store.popleft(), events[0])
+        self.assertEqual(store.drain(), events[1:])
+        self.assertFalse(store)
+        self.assertEqual(store.popleft(), None)
+
+    def test_capacity(self):
+        store = monitor.QMPEventStore(capacity=3)
+        for seq in xrange(5):
+            store.append(self.event('STOP' if seq % 2 else 'RESUME', seq))
+        self.assertEqual(len(store), 3)
+        self.assertEqual([event['data']['seq'] for event in store],
+                         [2, 3, 4])
+        self.assertEqual(store.dropped, 2)
+        self.assertEqual(store.dropped_by_type, {'RESUME': 1, 'STOP': 1})
+
+    def test_type_cap(self):
+        store = monitor.QMPEventStore(capacity=None,
+                                      type_caps={'BALLOON_CHANGE': 2})
+        for seq in xrange(5):
+            store.append(self.event('BALLOON_CHANGE', seq))
+        store.append(self.event('STOP', 5))
+        self.assertEqual([event['data']['seq'] for event in store],
+                         [3, 4, 5])
+        self.assertEqual(store.dropped, 3)
+        self.assertEqual(store.dropped_by_type, {'BALLOON_CHANGE': 3})
+
+
+class AsyncMonitorTimeoutTest(unittest.TestCase):
+
+    """
+    Replies arriving after the monitor gave up on their command.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='avocado_virt_')
+        address = os.path.join(self.tmpdir, 'qmp.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        listener.listen(1)
+        self.mon = monitor.QEMUMonitorProtocolAsync(address, timeout=0.2)
+        self.mon.connect(negotiate=False)
+        self.qemu, _ = listener.accept()
+        listener.close()
+
+    def tearDown(self):
+        self.mon.close()
+        self.qemu.close()
+        shutil.rmtree(self.tmpdir)
+
+    def send(self, resp):
+        self.qemu.sendall(json.dumps(resp) + '\r\n')
+
+    def expire(self, name):
+        reply = self.mon.cmd_async(name)
+        try:
+            reply.result()
+        except monitor.QMPTimeoutError, details:
+            self.assertIn('after 0.2 s', str(details))
+        else:
+            self.fail('%s did not time out' % name)
+        return reply
+
+    def test_late_reply(self):
+        expired = self.expire('slow-command')
+        reply = self.mon.cmd_async('query-status')
+        self.send({'return': 'late', 'id': expired.id})
+        self.send({'return': 'running', 'id': reply.id})
+        self.assertEqual(reply.result(5)['return'], 'running')
+
+    def test_late_reply_without_id(self):
+        self.expire('slow-command')
+        reply = self.mon.cmd_async('query-status')
+        self.send({'error': {'class': 'GenericError', 'desc': 'late'}})
+        self.send({'return': 'running', 'id': reply.id})
+        self.assertEqual(reply.result(5)['return'], 'running')
+
+    def test_raising_callback(self):
+        expired = self.mon.cmd_async('slow-command')
+        expired.add_done_callback(lambda reply: reply.result())
+        self.assertRaises(monitor.QMPTimeoutError, expired.result)
+        self.assertTrue(isinstance(expired.exception(),
+                                   monitor.QMPTimeoutError))
+        reply = self.mon.cmd_async('query-status')
+        self.send({'return': 'running', 'id': reply.id})
+        self.assertEqual(reply.result(5)['return'], 'running')
+        self.assertEqual(reply.exception(), None)
+
+    def test_timeout_with_events(self):
+        reply = self.mon.cmd_async('slow-command')
+        start = time.time()
+        # Events keep coming faster than the monitor ticks
+        while not reply.done() and time.time() - start < 5:
+            self.send({'event': 'RTC_CHANGE', 'data': {'offset': 0}})
+            time.sleep(0.05)
+        self.assertTrue(reply.done())
+        self.assertTrue(isinstance(reply.exception(),
+                                   monitor.QMPTimeoutError))
+
+    def test_raising_subscriber(self):
+        received = []
+
+        def fail(event):
+            raise ValueError('subscriber failed on %s' % event['event'])
+
+        self.mon.subscribe(fail, 'STOP')
+        self.mon.subscribe(received.append, 'STOP')
+        self.send({'event': 'STOP'})
+        reply = self.mon.cmd_async('query-status')
+        self.send({'return': 'paused', 'id': reply.id})
+        self.assertEqual(reply.result(5)['return'], 'paused')
+        self.assertEqual(received, [{'event': 'STOP'}])
+
+    def test_malformed_message(self):
+        reply = self.mon.cmd_async('query-status')
+        self.qemu.sendall('{"return": \r\n')
+        self.assertEqual(reply.result(5), None)
+        self.assertEqual(self.mon.cmd_async('query-status').result(5), None)
+
+    def test_reply_without_id(self):
+        reply = self.mon.cmd_async('query-status')
+        self.send({'return': 'running'})
+        self.assertEqual(reply.result(5)['return'], 'running')
+
+
+if __name__ == '__main__':
+    unittest.main()
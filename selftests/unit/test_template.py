@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright (C) 2016 Red Hat Inc
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from avocado_virt.qemu import template   # pylint: disable=C0413
+
+
+class TemplateTest(unittest.TestCase):
+
+    def render(self, contents, tags):
+        missing = []
+        rendered = template.compile_template(contents).render(tags, missing)
+        # Rendering the same way as str.format when no tag is missing
+        if not missing:
+            self.assertEqual(rendered, contents.format(**tags))
+        return rendered, missing
+
+    def test_tags(self):
+        compiled = template.compile_template('{qemu_bin} -m {mem}M')
+        self.assertEqual(compiled.tags, set(['qemu_bin', 'mem']))
+        self.assertEqual(self.render('{qemu_bin} -m {mem}M',
+                                     {'qemu_bin': 'qemu', 'mem': 512}),
+                         ('qemu -m 512M', []))
+
+    def test_escapes(self):
+        contents = '-object {{"qom-type": "{qom_type}"}} {{avocado_drive}}'
+        compiled = template.compile_template(contents)
+        self.assertEqual(compiled.tags, set(['qom_type']))
+        self.assertEqual(self.render(contents, {'qom_type': 'rng-random'}),
+                         ('-object {"qom-type": "rng-random"} '
+                          '{avocado_drive}', []))
+
+    def test_missing(self):
+        self.assertEqual(self.render('{a} {b} {a} {c}', {'b': 'x'}),
+                         (' x  ', ['a', 'a', 'c']))
+
+    def test_missing_in_format_spec(self):
+        self.assertEqual(self.render('[{port:>{width}}]', {'port': 5900}),
+                         ('[5900]', ['width']))
+        self.assertEqual(self.render('[{port:>{width}}]',
+                                     {'port': 5900, 'width': 6}),
+                         ('[  5900]', []))
+
+    def test_fields(self):
+        tags = {'drive': {'file': '/tmp/disk.qcow2'}, 'ports': [5900, 5901],
+                'name': 'vm'}
+        self.assertEqual(self.render('{drive[file]} {ports[1]} {name!r}',
+                                     tags),
+                         ("/tmp/disk.qcow2 5901 'vm'", []))
+        self.assertEqual(self.render('{size.real:.0f}', {'size': 1.5 + 2j}),
+                         ('2', []))
+
+    def test_cache(self):
+        compiled = template.compile_template('{cache_test}')
+        self.assertTrue(template.compile_template('{cache_test}') is compiled)
+        self.assertTrue(template.compile_template(u'{cache_test}')
+                        is compiled)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, template.compile_template, '{unclosed')
+        self.assertRaises(ValueError, template.compile_template, 'a } b')
+
+
+if __name__ == '__main__':
+    unittest.main()
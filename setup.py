@@ -63,6 +63,9 @@ setup(name='avocado-virt',
               ],
           'avocado.plugins.cli.cmd': [
               'virt-bootstrap = avocado_virt.plugins.virt_bootstrap:VirtBootstrap',
+          ],
+          'console_scripts': [
+              'avocado-virt-fake-qemu = avocado_virt.qemu.fake_monitor:main',
           ]
           },
       )